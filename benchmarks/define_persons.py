@@ -0,0 +1,98 @@
+"""Compare the .tex written with and without --define-persons.
+
+    python benchmarks/define_persons.py example.xml [--compile]
+
+Reports the size of the .tex file for each, and with --compile, how
+long latexmk takes to make a pdf from it. The project's preamble must
+define \\defperson and a two-argument \\person for the second to compile.
+Without an input file, a synthetic edition is made in a temporary
+directory and only sizes are reported.
+"""
+
+import argparse
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from path import Path
+
+from tei_transformer.config import config
+from tei_transformer.transform import Resources, Transformer
+
+TEI = 'xmlns="http://www.tei-c.org/ns/1.0"'
+
+
+def synthetic(directory, persons=500, entries=2000, mentions=5):
+    """Write an edition and personlist in which people are mentioned
+    `mentions` times an entry, on average, into directory"""
+    rng = random.Random(0)
+    resources = directory.joinpath('resources')
+    resources.makedirs_p()
+    people = ''.join(
+        '<person xml:id="p%d"><persName><forename>First%d</forename>'
+        '<surname>Last%d</surname></persName><birth>1850</birth>'
+        '<death>1920</death><trait><p>%s</p></trait></person>'
+        % (i, i, i, ' '.join(['A description of this person.'] * 6))
+        for i in range(persons))
+    resources.joinpath('personlist.xml').write_text(
+        '<listPerson %s>%s</listPerson>' % (TEI, people))
+    resources.joinpath('references.bib').write_text('')
+    resources.joinpath('latex_preamble.tex').write_text(
+        '\\documentclass{book}\n')
+    body = ''.join(
+        '<div type="diaryentry" xml:id="e%d"><head>Entry %d</head><p>%s</p>'
+        '</div>' % (i, i, ' and '.join(
+            '<persName ref="#p%d">Name</persName>' % rng.randrange(persons)
+            for _ in range(mentions)))
+        for i in range(entries))
+    path = directory.joinpath('synthetic.xml')
+    path.write_text('<TEI %s><text><body>%s</body></text></TEI>'
+                    % (TEI, body))
+    return path
+
+
+def measure(inputpath, define_persons, compile_pdf):
+    resources = Resources(inputpath)
+    transformer = Transformer(False, *resources, pdf=False,
+                              define_persons=define_persons)
+    working_tex, working_pdf, _ = resources.workfiles
+    working_tex.write_text(transformer.latex)
+    size = working_tex.size
+    seconds = None
+    if compile_pdf:
+        if working_pdf.exists():
+            working_pdf.remove()
+        started = time.perf_counter()
+        subprocess.call(config['caller_command'].split() + [working_tex])
+        seconds = time.perf_counter() - started
+    return size, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputname', nargs='?', default=None)
+    parser.add_argument('--compile', action='store_true')
+    args = parser.parse_args()
+    tempdir = None
+    if args.inputname:
+        inputpath = Path(args.inputname)
+    else:
+        tempdir = Path(tempfile.mkdtemp())
+        inputpath = synthetic(tempdir)
+    try:
+        for define_persons in [False, True]:
+            size, seconds = measure(inputpath, define_persons, args.compile)
+            line = '%-18s %10d bytes' % (
+                'define persons' if define_persons else 'inline persons', size)
+            if seconds is not None:
+                line += ' %8.1f s' % seconds
+            print(line)
+    finally:
+        if tempdir:
+            shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
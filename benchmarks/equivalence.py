@@ -0,0 +1,343 @@
+"""Check that other ways of transforming give the same LaTeX as the
+reference, on random TEI, and how fast each is.
+
+    python benchmarks/equivalence.py [--cases 50] [--seed 0] [--size 40]
+                                     [--engines staged,stream] [--keep DIR]
+                                     [--json FILE] [--baseline FILE]
+                                     [--threshold 1.25]
+
+Each case is a random edition and personlist using the tags the
+handlers support. The reference is ParserMethods.transform_tree and
+Transformer.latexify over the whole body; every other engine must
+give byte for byte the same text. Differences are shown as a diff and
+the case is kept for rerunning; the exit status is 1 if there were
+any. The time each engine took over all cases is reported against the
+reference's; engines with a warm function have it run first, untimed.
+
+--json writes the results, with the seconds of each engine and their
+ratio to the reference's, to FILE; one kept from an earlier run can be
+given as --baseline, and any engine whose ratio has grown by more than
+--threshold times is reported as slower, with an exit status of 2
+unless cases differed. Ratios rather than seconds are compared, so that
+a baseline holds across machines.
+"""
+
+import argparse
+import difflib
+import io
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from path import Path
+
+from tei_transformer.tags import parser
+from tei_transformer.transform import (Divisions, PersDict, Resources,
+                                       Transformer)
+
+TEI = 'xmlns="http://www.tei-c.org/ns/1.0"'
+WORDS = ('the of and a to in was he it with his that for at on by we had '
+         'Paris Rome church letter morning rain &amp; 50% #3 $5 _x_ {sic} '
+         'Mr. Dr. U.S.A. Some ALLCAPS. Then').split()
+RENDS = ['italic', 'single', 'double', 'super', 'smcp', None]
+LANGUAGES = ['it', 'de', 'la', 'fr', 'gr', 'xx']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun']
+
+
+class Case():
+
+    """A random edition of about size paragraphs, and its personlist"""
+
+    def __init__(self, rng, size, persons=20):
+        self.rng = rng
+        self.persons = persons
+        self.personlist = '<listPerson %s>%s</listPerson>' % (
+            TEI, ''.join(self.person(i) for i in range(persons)))
+        years = []
+        for year in range(1915, 1915 + max(1, size // 20)):
+            months = []
+            for month in MONTHS[:rng.randint(1, 3)]:
+                entries = ''.join(self.entry(month, day, year)
+                                  for day in range(1, rng.randint(2, 4)))
+                months.append('<div type="month" n="%s">%s</div>'
+                              % (month, entries))
+            years.append('<div type="year" n="%d">%s</div>'
+                         % (year, ''.join(months)))
+        self.tei = '<TEI %s><text><body>%s</body></text></TEI>' % (
+            TEI, '<pb n="1"/>'.join(years) if rng.random() < 0.5
+            else ''.join(years))
+
+    def words(self, low=1, high=6):
+        return ' '.join(self.rng.choice(WORDS)
+                        for _ in range(self.rng.randint(low, high)))
+
+    def person(self, i):
+        rng = self.rng
+        forename = rng.choice(['Anne', '\u00c9mile', 'Joe', 'Jo\u00e3o'])
+        add = '<addName>Jo</addName>' if rng.random() < 0.2 else ''
+        trait = ''
+        if rng.random() < 0.7:
+            mention = ('<persName ref="#p%d">them</persName>'
+                       % rng.randrange(self.persons))
+            trait = '<trait><p>%s %s.</p></trait>' % (self.words(), mention)
+        indexonly = ' indexonly="true"' if rng.random() < 0.1 else ''
+        return ('<person xml:id="p%d"%s><persName><forename>%s</forename>%s'
+                '<surname>Name%d</surname></persName><birth>18%02d</birth>'
+                '<death>19%02d</death>%s</person>'
+                % (i, indexonly, forename, add, i, rng.randrange(100),
+                   rng.randrange(50), trait))
+
+    def entry(self, month, day, year):
+        rng = self.rng
+        identifier = '%s%d_%d' % (month, day, year)
+        parts = ['<head>%s</head>' % self.words(1, 3)]
+        for _ in range(rng.randint(1, 4)):
+            choice = rng.random()
+            if choice < 0.1:
+                lines = ''.join('<l>%s</l>' % self.words(2, 5)
+                                for _ in range(rng.randint(1, 4)))
+                parts.append('<lg>%s</lg>' % lines)
+            elif choice < 0.15:
+                parts.append('<pb n="%d"/>' % rng.randint(2, 300))
+            else:
+                rend = rng.choice([' rend="noindent"', ' rend="indent"', ''])
+                parts.append('<p%s>%s</p>' % (rend, self.inline()))
+        return ('<div type="diaryentry" xml:id="%s">%s</div>'
+                % (identifier, ''.join(parts)))
+
+    def inline(self):
+        rng = self.rng
+        pieces = [self.words()]
+        for _ in range(rng.randint(0, 6)):
+            pieces.append(rng.choice(self.elements)(self))
+            pieces.append(self.words(0, 4))
+        return ' '.join(pieces)
+
+    def hi(self):
+        rend = self.rng.choice(RENDS)
+        return '<hi%s>%s</hi>' % (' rend="%s"' % rend if rend else '',
+                                 self.words(1, 3))
+
+    def formatting(self):
+        name = self.rng.choice(['q', 'soCalled', 'supplied', 'bibl'])
+        return '<%s>%s</%s>' % (name, self.words(1, 3), name)
+
+    def pers_name(self):
+        ref = self.rng.choice(['??'] + ['p%d' % i
+                                        for i in range(self.persons)])
+        return '<persName ref="#%s">%s</persName>' % (ref, self.words(1, 2))
+
+    def app(self):
+        readings = ''.join('<rdg wit="#%s">%s</rdg>'
+                           % (' #'.join(self.rng.sample('ABCD', 2)),
+                              self.words(1, 2))
+                           for _ in range(self.rng.randint(1, 3)))
+        return '<app><lem>%s</lem>%s</app>' % (self.words(1, 2), readings)
+
+    def choice(self):
+        return '<choice><sic>%s</sic><corr>%s</corr></choice>' % (
+            self.words(1, 1), self.words(1, 1))
+
+    def note(self):
+        return ('<note type="annotation"/>%s<note type="annotation">%s</note>'
+                % (self.words(1, 3), self.words(2, 8)))
+
+    def page_break(self):
+        return '<pb n="%d"/>' % self.rng.randint(2, 300)
+
+    def foreign(self):
+        return '<foreign xml:lang="%s">%s</foreign>' % (
+            self.rng.choice(LANGUAGES), self.words(1, 3))
+
+    def editorial(self):
+        return self.rng.choice([
+            '<add>%s</add>' % self.words(1, 2),
+            '<del hand="#h">%s</del>' % self.words(1, 2),
+            '<space n="%s"/>' % self.rng.choice(['vertical', 'horizontal',
+                                                  'other']),
+            '<lb/>'])
+
+    elements = [hi, formatting, pers_name, app, choice, note, page_break,
+                foreign, editorial]
+
+    def write(self, directory):
+        """Write the case as a project in directory, and return the path
+           of its text"""
+        resources = directory.joinpath('resources')
+        resources.makedirs_p()
+        resources.joinpath('personlist.xml').write_text(self.personlist)
+        resources.joinpath('references.bib').write_text('')
+        resources.joinpath('latex_preamble.tex').write_text(
+            '\\documentclass{book}\n')
+        path = directory.joinpath('case.xml')
+        path.write_text(self.tei)
+        return path
+
+
+def body(inputpath):
+    return parser.parse(inputpath).getroot().find('.//{*}body')
+
+
+def reference(resources):
+    """ParserMethods.transform_tree and Transformer.latexify"""
+    inputpath, personlistpath = resources.inputpaths
+    tree = parser.transform_tree(body(inputpath), PersDict(personlistpath))
+    return Transformer.latexify(Transformer.tree_text(tree),
+                                *resources.textwraps)
+
+
+def staged(resources):
+    """Transformer, with its stages run at the same time"""
+    return Transformer(False, *resources, pdf=False, cache=False).latex
+
+
+def cached(resources):
+    """Transformer, with the text and persdict from the stage cache"""
+    return Transformer(False, *resources, pdf=False).latex
+
+
+# Fills the cache before cached is timed
+cached.warm = cached
+
+
+def person_db(resources):
+    """Transformer, looking people up in an SQLite index"""
+    return Transformer(False, *resources, pdf=False, cache=False,
+                       person_db=True).latex
+
+
+def divisions(resources):
+    """Each top-level division transformed on its own and joined"""
+    inputpath, personlistpath = resources.inputpaths
+    persdict = PersDict(personlistpath)
+    text = ''.join(Transformer.raw_text(parser.transform_tree(chunk,
+                                                              persdict))
+                   for _, chunk in Divisions(body(inputpath))).strip()
+    return Transformer.latexify(text, *resources.textwraps)
+
+
+def stream(resources):
+    """Transformer.stream, as used by --tex-only"""
+    inputpath, personlistpath = resources.inputpaths
+    out = io.StringIO()
+    Transformer.stream(inputpath, PersDict(personlistpath), out)
+    return Transformer.latexify(out.getvalue().strip(), *resources.textwraps)
+
+
+engines = OrderedDict((f.__name__, f) for f in
+                      [reference, staged, cached, person_db, divisions,
+                       stream])
+
+
+def run(engine, resources):
+    """The LaTeX engine gives for resources, and the seconds it took"""
+    if hasattr(engine, 'warm'):
+        engine.warm(resources)
+    started = time.perf_counter()
+    latex = engine(resources)
+    return latex, time.perf_counter() - started
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--cases', type=int, default=50)
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--size', type=int, default=40,
+                           help="Paragraphs in each case, roughly")
+    argparser.add_argument('--engines', type=lambda s: s.split(','),
+                           default=[name for name in engines
+                                    if name != 'reference'])
+    argparser.add_argument('--keep', default='equivalence-failures',
+                           help="Directory to keep differing cases in")
+    argparser.add_argument('--json', default=None,
+                           help="File to write the results to as JSON")
+    argparser.add_argument('--baseline', default=None,
+                           help="Results written by --json to compare with")
+    argparser.add_argument('--threshold', type=float, default=1.25,
+                           help="How many times its baseline ratio an "
+                                "engine may take before it is slower")
+    args = argparser.parse_args()
+    unknown = [name for name in args.engines if name not in engines]
+    if unknown:
+        argparser.error('No engine %s' % ', '.join(unknown))
+    rng = random.Random(args.seed)
+    seconds = OrderedDict((name, 0.0) for name in
+                          ['reference'] + args.engines)
+    differing = OrderedDict((name, 0) for name in args.engines)
+    tempdir = Path(tempfile.mkdtemp())
+    try:
+        for number in range(args.cases):
+            case = Case(rng, args.size)
+            directory = tempdir.joinpath('case%d' % number)
+            resources = Resources(case.write(directory))
+            resources = resources._replace(
+                textwraps=tuple(resources.textwraps), references=None)
+            expected, taken = run(reference, resources)
+            seconds['reference'] += taken
+            for name in args.engines:
+                latex, taken = run(engines[name], resources)
+                seconds[name] += taken
+                if latex != expected:
+                    differing[name] += 1
+                    keep(directory, args.keep, number, name,
+                         expected, latex)
+    finally:
+        shutil.rmtree(tempdir)
+    results = {'cases': args.cases, 'seed': args.seed, 'size': args.size,
+               'engines': OrderedDict(
+                   (name, {'seconds': taken,
+                           'ratio': taken / seconds['reference'],
+                           'differing': differing.get(name, 0)})
+                   for name, taken in seconds.items())}
+    for name, result in results['engines'].items():
+        line = '%-10s %8.3fs  %5.2fx' % (name, result['seconds'],
+                                         result['ratio'])
+        if name in differing:
+            line += '  %d of %d cases differ' % (differing[name], args.cases)
+        print(line)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2) + '\n')
+    slower = []
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).text())
+        slower = regressions(results, baseline, args.threshold)
+        for line in slower:
+            print(line)
+    if any(differing.values()):
+        sys.exit(1)
+    sys.exit(2 if slower else 0)
+
+
+def regressions(results, baseline, threshold):
+    """A line for each engine of results whose ratio to the reference
+    is more than threshold times what it was in baseline"""
+    lines = []
+    for name, result in results['engines'].items():
+        before = baseline['engines'].get(name)
+        if name == 'reference' or before is None:
+            continue
+        if result['ratio'] > before['ratio'] * threshold:
+            lines.append('%s is slower: %.2fx against %.2fx in the baseline'
+                         % (name, result['ratio'], before['ratio']))
+    return lines
+
+
+def keep(directory, keep_dir, number, name, expected, latex):
+    """Keep the project of a differing case, and show the difference"""
+    target = Path(keep_dir).joinpath('case%d' % number)
+    if not target.exists():
+        shutil.copytree(directory, target, ignore=shutil.ignore_patterns(
+            'working_directory'))
+    diff = difflib.unified_diff(expected.splitlines(), latex.splitlines(),
+                                'reference', name, lineterm='', n=1)
+    print('case%d: %s differs (kept in %s)' % (number, name, target))
+    for line in list(diff)[:20]:
+        print('    ' + line)
+
+
+if __name__ == '__main__':
+    main()
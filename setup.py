@@ -21,6 +21,8 @@ setup(
     entry_points={
     	'console_scripts': [
     	'tei_transformer=tei_transformer.transform:main',
+    	'tei_transformer_service=tei_transformer.service:main',
+    	'tei_transformer_batch=tei_transformer.batch:main',
     	]
     },
 
@@ -0,0 +1,65 @@
+"""Transform from Python, safely from several threads at once."""
+
+import threading
+
+from path import Path
+
+from .config import resolve_config, using_config
+from .tags import parser
+from .transform import PersDict, Resources, Transformer
+
+
+def transform(source, project, errors=None):
+    """Transform the TEI in source, a path or file object, into LaTeX,
+       using the resources and config of the project directory.
+       Reentrant: each call has its own config, parser and document,
+       and the project's people are shared read-only. If errors (an
+       ImplementationErrors) is given, problems are recorded in it
+       rather than raised."""
+    project = Project(project)
+    with using_config(project.config):
+        body = parser.parse(source).getroot().find('.//{*}body')
+        if body is None:
+            raise ValueError('No body in %s' % source)
+        tree = parser.transform_tree(body, project.persdict, errors=errors)
+        return Transformer.latexify(Transformer.tree_text(tree),
+                                    *project.textwraps)
+
+
+class Project():
+
+    """The config, resource texts and people of a project directory,
+       resolved once and shared by every transformation using them,
+       and resolved again when anything in its resources folder changes."""
+
+    _projects = {}
+    _lock = threading.Lock()
+
+    def __new__(cls, directory):
+        directory = Path(directory).abspath()
+        stamp = cls._stamp(directory)
+        with cls._lock:
+            project = cls._projects.get(directory)
+            if project is None or project.stamp != stamp:
+                project = super().__new__(cls)
+                project._resolve(directory, stamp)
+                cls._projects[directory] = project
+        return project
+
+    def _resolve(self, directory, stamp):
+        self.stamp = stamp
+        self.config = resolve_config(directory)
+        with using_config(self.config):
+            inputpath = directory.joinpath(directory.name + '.xml')
+            resources = Resources(inputpath)
+            self.textwraps = tuple(resources.textwraps)
+            self.references = resources.references
+            self.persdict = PersDict(resources.inputpaths[1])
+
+    @staticmethod
+    def _stamp(directory):
+        resource_dir = directory.joinpath('resources')
+        if not resource_dir.exists():
+            raise IOError('Resources folder does not exist')
+        paths = [resource_dir] + resource_dir.files()
+        return max(path.mtime for path in paths)
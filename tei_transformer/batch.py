@@ -0,0 +1,237 @@
+"""Build many editions at once over a fixed pool of workers, the longest
+expected first, so that the largest are not left running on their own
+at the end."""
+
+# argparse is also imported
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from path import Path
+
+from . import compression
+from .config import config, resolve_config, using_config
+from .transform import Resources, Transformer
+
+
+class Durations(dict):
+
+    """The seconds transforming and running latexmk took for each input
+       of a project when it was last built, by filename, kept in
+       durations.json in the project's work directory"""
+
+    name = 'durations.json'
+
+    def __init__(self, work_dir):
+        super().__init__()
+        self.path = Path(work_dir).joinpath(self.name)
+        try:
+            self.update(json.loads(self.path.text()))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    @classmethod
+    def of(cls, inputpaths):
+        """The Durations of the project each of inputpaths is in, one
+           for each project, by input"""
+        projects = {}
+        durations = {}
+        for path in inputpaths:
+            project = Path(path).abspath().dirname()
+            if project not in projects:
+                with using_config(resolve_config(project)):
+                    projects[project] = cls(project.joinpath(
+                        config['workdir']))
+            durations[path] = projects[project]
+        return durations
+
+    def expected(self, inputpath):
+        """The seconds inputpath took when last built, or None"""
+        durations = self.get(Path(inputpath).basename())
+        if not durations:
+            return None
+        return sum(durations.values())
+
+    def record(self, inputpath, durations):
+        """Record durations, a dict of seconds by stage, for inputpath,
+           keeping earlier ones for stages that were not run (None)"""
+        recorded = self.setdefault(Path(inputpath).basename(), {})
+        recorded.update((stage, seconds) for stage, seconds
+                        in durations.items() if seconds is not None)
+        self.path.dirname().makedirs_p()
+        fd, temp = tempfile.mkstemp(dir=self.path.dirname(), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self, f, indent=1, sort_keys=True)
+        os.replace(temp, self.path)
+
+
+def order(inputpaths, durations):
+    """inputpaths, longest expected first, and the seconds expected of
+       each. Inputs not built before are expected to take as long per
+       byte as the median of those that were, or are ordered by size
+       if none were. durations maps each input to its Durations."""
+    sizes = {path: compression.find(path).size for path in inputpaths}
+    expected = {path: durations[path].expected(path) for path in inputpaths}
+    rates = [seconds / sizes[path] for path, seconds in expected.items()
+             if seconds is not None and sizes[path]]
+    rate = statistics.median(rates) if rates else None
+    if rate is None:
+        # Nothing to go on but size
+        ranked = sorted(inputpaths, key=sizes.get, reverse=True)
+        return [(path, None) for path in ranked]
+    for path, seconds in expected.items():
+        if seconds is None:
+            expected[path] = sizes[path] * rate
+    ranked = sorted(inputpaths, key=expected.get, reverse=True)
+    return [(path, expected[path]) for path in ranked]
+
+
+def build(inputpath, force=False, standalone=False, check=True, **options):
+    """Build inputpath in a worker process. Returns the seconds taken by
+       transforming and latexmk, which is None if it was not run, and a
+       summary of the errors recorded with keep_going."""
+    started = time.perf_counter()
+    resources = Resources(inputpath, None, standalone)
+    if not check:
+        resources = resources._replace(references=None)
+    transformer = Transformer(force, *resources, **options)
+    seconds = time.perf_counter() - started
+    latexmk = None
+    if transformer.latexmk is not None:
+        latexmk = transformer.latexmk[0]
+        seconds -= latexmk
+    errors = transformer.errors.summary() if transformer.errors else None
+    return {'transform': seconds, 'latexmk': latexmk}, errors
+
+
+class Progress():
+
+    """A line on stream of how many builds are done, how fast they are
+       going, and how long those left are expected to take, rewritten
+       in place if stream is a terminal"""
+
+    def __init__(self, total, expected, workers, stream=sys.stderr):
+        self.total = total
+        self.left = sum(seconds or 0 for seconds in expected.values())
+        self.expected = expected
+        self.workers = workers
+        self.stream = stream
+        self.done = 0
+        self.started = time.perf_counter()
+        self.live = stream.isatty()
+
+    def finished(self, inputpath, message=''):
+        self.done += 1
+        self.left -= self.expected.get(inputpath) or 0
+        if not self.live:
+            self.stream.write('%s %s%s\n' % (self.line(), inputpath, message))
+        else:
+            self.stream.write('\r\x1b[K%s%s\n' % (inputpath, message))
+            self.show()
+
+    def line(self):
+        elapsed = time.perf_counter() - self.started
+        line = '[%d/%d] %.1f/min' % (self.done, self.total,
+                                     60 * self.done / elapsed if elapsed else 0)
+        if self.left > 0 and self.done < self.total:
+            line += ', about %ds left' % (self.left / self.workers)
+        return line
+
+    def show(self):
+        if self.live:
+            self.stream.write('\r\x1b[K' + self.line())
+            self.stream.flush()
+
+    def close(self):
+        if self.live:
+            self.stream.write('\n')
+
+
+def run(inputpaths, workers=None, **options):
+    """Build inputpaths over workers processes, the longest expected
+       first, recording how long each took for the next run. Returns
+       a dict of the inputs that failed, with why."""
+    workers = workers or os.cpu_count()
+    inputpaths = [Path(path) for path in inputpaths]
+    durations = Durations.of(inputpaths)
+    ranked = order(inputpaths, durations)
+    expected = dict(ranked)
+    shown = Progress(len(ranked), expected, workers)
+    failed = {}
+    with ProcessPoolExecutor(workers) as pool:
+        # Submitted in order, each free worker takes the longest left
+        pending = {pool.submit(build, path, **options): path
+                   for path, _ in ranked}
+        shown.show()
+        while pending:
+            done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    seconds, errors = future.result()
+                except Exception as err:  # Reported, and the rest built
+                    failed[path] = '%s: %s' % (type(err).__name__, err)
+                    shown.finished(path, ' failed')
+                    continue
+                durations[path].record(path, seconds)
+                if errors:
+                    failed[path] = errors
+                shown.finished(path, ' with errors' if errors else '')
+            shown.show()
+    shown.close()
+    return failed
+
+
+def main():
+    """Parse arguments and build each input."""
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputnames', nargs='+',
+                        help="TEI files to transform")
+    parser.add_argument('-j', '--jobs',
+                        help="Number of inputs to build at once; "
+                             "defaults to the number of CPUs",
+                        type=int,
+                        default=None)
+    parser.add_argument('-f', '--force',
+                        help="Force recompilation even if unchanged.",
+                        action="store_true")
+    parser.add_argument('-s', '--standalone',
+                        help="Do not include introduction or appendices",
+                        action="store_true")
+    parser.add_argument('--no-check',
+                        help="Do not check references before transforming",
+                        action="store_true")
+    parser.add_argument('--no-cache',
+                        help="Parse and transform again even if the text, "
+                             "personlist and config are unchanged",
+                        action="store_true")
+    parser.add_argument('--person-db',
+                        help="Look up people in an SQLite index of the "
+                             "personlist",
+                        action="store_true")
+    parser.add_argument('--python-index',
+                        help="Sort the index in Python instead of running "
+                             "makeindex",
+                        action="store_true")
+    parser.add_argument('-k', '--keep-going',
+                        help="Report every unimplemented tag instead of "
+                             "stopping at the first",
+                        action="store_true")
+    args = parser.parse_args(sys.argv[1:])
+    failed = run(args.inputnames, args.jobs, force=args.force,
+                 standalone=args.standalone, check=not args.no_check,
+                 cache=not args.no_cache, person_db=args.person_db,
+                 python_index=args.python_index, keep_going=args.keep_going)
+    for path, why in failed.items():
+        print('%s:\n%s' % (path, why), file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
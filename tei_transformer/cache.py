@@ -0,0 +1,309 @@
+"""Digests of what a transformation depends on, and a store of results
+kept under them."""
+
+import contextlib
+import functools
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from path import Path
+
+from . import compression
+from .config import config
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows
+    fcntl = None
+
+
+def digest(*parts):
+    """sha1 hexdigest of parts, each bytes or str, taken in order"""
+    sha1 = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        sha1.update(b'%d:' % len(part))
+        sha1.update(part)
+    return sha1.hexdigest()
+
+
+def file_digest(path, chunk=1 << 20):
+    """sha1 hexdigest of the bytes of the file at path, read a chunk
+       at a time rather than whole"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def config_digest():
+    """Digest of the config in effect"""
+    return digest(json.dumps(dict(config), sort_keys=True, default=str))
+
+
+@functools.lru_cache()
+def code_digest():
+    """Digest of the code of this package, so that results made by
+       a different version are not used"""
+    here = Path(__file__).dirname()
+    return digest(*(path.bytes() for path in sorted(here.files('*.py'))))
+
+
+@functools.lru_cache()
+def tool_digest(command):
+    """Digest of the installed program command, by where it is and its
+       size and time of change, so that results made by a different
+       version of it are not used"""
+    path = shutil.which(command)
+    if path is None:
+        return ''
+    stat = os.stat(path)
+    return digest(path, str(stat.st_size), str(stat.st_mtime_ns))
+
+
+@functools.lru_cache()
+def tool_version(command):
+    """What the installed program command gives for --version, or None
+       if it cannot be run"""
+    try:
+        return subprocess.run([command, '--version'],
+                              stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout
+    except OSError:
+        return None
+
+
+class FileCache():
+
+    """JSON-serialisable results kept in a directory, one file per key,
+       gzipped if compress. Files are written whole and renamed into
+       place, so that threads and processes can share a cache. With
+       shared, a SharedCache, results missing here are looked for there,
+       and results kept here are kept there too. With max_size, results
+       used least recently are removed once the cache holds more than
+       max_size bytes."""
+
+    entries = ['*.json', '*.json.gz']
+
+    def __init__(self, directory, compress=False, shared=None,
+                 max_size=None):
+        self.directory = Path(directory)
+        self.compress = compress
+        self.shared = shared
+        self.max_size = max_size
+        self._size = None  # Not known until first needed
+        if not self.directory.exists():
+            self.directory.makedirs_p()
+
+    @classmethod
+    def configured(cls, directory, kind):
+        """A FileCache in directory, bounded by local_cache: max_size_mb
+           in config, sharing entries of kind with the SharedCache
+           configured, if there is one"""
+        max_size_mb = (config.get('local_cache') or {}).get('max_size_mb')
+        max_size = None
+        if max_size_mb is not None:
+            max_size = int(max_size_mb * 1024 * 1024)
+        return cls(directory, config['compress_artifacts'],
+                   SharedCache.configured(kind), max_size)
+
+    def _path(self, key):
+        ext = '.json.gz' if self.compress else '.json'
+        return self.directory.joinpath(key + ext)
+
+    def get(self, key, local=False):
+        """The result kept under key, or None. If local, the shared
+           cache is not looked in."""
+        result = self._read(key)
+        if result is not None and self.max_size is not None:
+            self._touch(self._path(key))
+        if result is None and self.shared is not None and not local:
+            result = self.shared.get(key)
+            if result is not None:
+                self._kept(self._write(key, result))
+        return result
+
+    def put(self, key, result, local=False):
+        """Keep result under key, and in the shared cache too unless
+           local"""
+        self._kept(self._write(key, result))
+        if self.shared is not None and not local:
+            self.shared.put(key, result)
+
+    def _read(self, key):
+        try:
+            with compression.open_binary(self._path(key)) as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (FileNotFoundError, ValueError, EOFError, OSError):
+            return None
+
+    def _write(self, key, result):
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            if self.compress:
+                f = gzip.open(f, 'wb')
+            with f:
+                f.write(json.dumps(result).encode('utf-8'))
+        size = os.path.getsize(temp)
+        os.replace(temp, self._path(key))
+        return size
+
+    @staticmethod
+    def _touch(path):
+        """Mark path as used now"""
+        try:
+            os.utime(path)
+        except OSError:  # Removed since
+            pass
+
+    def _kept(self, size):
+        """Count size more bytes kept, and evict once over max_size.
+           The directory is only looked through when the count says
+           it may be too big."""
+        if self.max_size is None:
+            return
+        if self._size is None:
+            self._size = self._entries_size()
+        else:
+            self._size += size
+        if self._size > self.max_size:
+            self._size = self.evict()
+
+    def _entries_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """(time of last use, size, path) of each entry"""
+        entries = []
+        for pattern in self.entries:
+            for path in self.directory.files(pattern):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """Remove the entries used least recently until the rest
+           take no more than max_size, and return the size of those
+           left"""
+        entries = self._entries()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                path.remove()
+            except FileNotFoundError:  # Removed by another process
+                pass
+            size -= entry_size
+        return size
+
+
+class SharedCache(FileCache):
+
+    """A cache of results and pdfs, like ccache's, shared by every
+       checkout and user on a host: in the directory named by the
+       TEI_TRANSFORMER_CACHE environment variable, or else by
+       shared_cache: directory in config. Entries used least recently
+       are removed once it holds more than shared_cache: max_size_mb.
+       Hits and misses are counted for each kind of entry in
+       stats.json."""
+
+    environ = 'TEI_TRANSFORMER_CACHE'
+    entries = ['*.json.gz', '*.pdf']
+
+    def __init__(self, directory, kind, max_size):
+        super().__init__(directory, compress=True, max_size=max_size)
+        self.kind = kind
+
+    @classmethod
+    def configured(cls, kind):
+        """The SharedCache for entries of kind, or None if there is
+           none configured"""
+        settings = config.get('shared_cache') or {}
+        directory = os.environ.get(cls.environ) or settings.get('directory')
+        if not directory:
+            return None
+        max_size = int(settings.get('max_size_mb', 2048) * 1024 * 1024)
+        return cls(Path(directory).expanduser(), kind, max_size)
+
+    def get(self, key):
+        result = self._read(key)
+        self._used(self._path(key), result is not None)
+        return result
+
+    def put(self, key, result):
+        self._write(key, result)
+        self.evict()
+
+    def get_file(self, key, target):
+        """Copy the file kept under key to target, and return whether
+           there was one"""
+        path = self.directory.joinpath(key + '.pdf')
+        try:
+            shutil.copyfile(path, target)
+        except FileNotFoundError:
+            self._used(path, False)
+            return False
+        self._used(path, True)
+        return True
+
+    def put_file(self, key, source):
+        """Keep a copy of the file source under key"""
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(source, temp)
+        os.replace(temp, self.directory.joinpath(key + '.pdf'))
+        self.evict()
+
+    def _used(self, path, hit):
+        """Count a hit or miss, and on a hit mark path as used now"""
+        if hit:
+            self._touch(path)
+        with self._stats() as stats:
+            counts = stats.setdefault(self.kind, {'hits': 0, 'misses': 0})
+            counts['hits' if hit else 'misses'] += 1
+
+    @contextlib.contextmanager
+    def _stats(self):
+        """The counts in stats.json, written back after the body of a
+           with statement, locked against other processes meanwhile"""
+        with open(self.directory.joinpath('stats.lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            path = self.directory.joinpath('stats.json')
+            try:
+                stats = json.loads(path.text())
+            except (FileNotFoundError, ValueError):
+                stats = {}
+            yield stats
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(stats, f)
+            os.replace(temp, path)
+
+    def report(self):
+        """Hits, misses and the hit rate of each kind of entry, and the
+           size of the cache, as lines of text"""
+        with self._stats() as stats:
+            lines = ['%s: %d hits, %d misses (%.0f%%)' % (
+                         kind, counts['hits'], counts['misses'],
+                         100 * counts['hits'] /
+                         (counts['hits'] + counts['misses']))
+                     for kind, counts in sorted(stats.items())]
+        size = sum(path.size for pattern in self.entries
+                   for path in self.directory.files(pattern))
+        lines.append('%s: %.1f of %.0f MB' % (
+            self.directory, size / 2 ** 20, self.max_size / 2 ** 20))
+        return '\n'.join(lines)
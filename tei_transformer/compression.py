@@ -0,0 +1,53 @@
+"""Inputs and artifacts compressed with gzip or xz, decompressed as they
+are read rather than copied out first."""
+
+import gzip
+import lzma
+
+from lxml import etree
+from path import Path
+
+openers = {'.gz': gzip.open, '.xz': lzma.open}
+
+
+def opener(path):
+    """The function opening path, if it is a compressed file, or None"""
+    if not isinstance(path, str):  # A file object, or a path's bytes
+        return None
+    return openers.get(Path(path).ext.lower())
+
+
+def uncompressed(path):
+    """path without the extension of its compression, if any"""
+    path = Path(path)
+    return path.stripext() if opener(path) else path
+
+
+def find(path):
+    """path, or if it does not exist a compressed copy of it which does"""
+    path = Path(path)
+    if not path.exists():
+        for ext in openers:
+            if Path(path + ext).exists():
+                return Path(path + ext)
+    return path
+
+
+def open_binary(path):
+    """A binary file object reading path, decompressing it if need be"""
+    return (opener(path) or open)(path, 'rb')
+
+
+def read_text(path):
+    """The text of path, decompressing it if need be"""
+    with open_binary(path) as f:
+        return f.read().decode('utf-8')
+
+
+def parse(path, parser):
+    """Parse path with parser, decompressing it as it is read"""
+    open_ = opener(path)
+    if open_ is None:
+        return etree.parse(path, parser)
+    with open_(path, 'rb') as f:
+        return etree.parse(f, parser, base_url=str(path))
@@ -1,16 +1,96 @@
+import contextlib
+import contextvars
+import copy
+import functools
 import os
+import threading
+from collections.abc import MutableMapping
+
 import yaml
 
 with open(os.path.join(os.path.dirname(__file__), "config.yaml"), "r") as f:
-    config = yaml.load(f)
+    defaults = yaml.load(f)
+
+_active = contextvars.ContextVar('config')
+
+_custom_settings = {}
+_custom_settings_lock = threading.Lock()
+
+
+class Config(MutableMapping):
+
+    """The config in effect: that set by update_config or using_config
+    in the current thread (strictly, context), or else the defaults.
+    Each thread can so work on a different project at the same time."""
+
+    def __init__(self, base):
+        self._base = base
+
+    def _current(self):
+        return _active.get(self._base)
+
+    def __getitem__(self, key):
+        return self._current()[key]
+
+    def __setitem__(self, key, value):
+        self._current()[key] = value
+
+    def __delitem__(self, key):
+        del self._current()[key]
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __len__(self):
+        return len(self._current())
+
+
+config = Config(copy.deepcopy(defaults))
 
 
 def update_config(curdir):
-    """Update config with custom settings."""
+    """Update config with custom settings, for the current thread.
+    Settings from an earlier call are dropped, so that config can be
+    updated for one project after another."""
+    _active.set(resolve_config(curdir))
+
+
+def resolve_config(curdir):
+    """A new copy of the defaults, updated with custom settings"""
     custom_settings = os.path.join(str(curdir), 'resources', 'config.yaml')
+    resolved = copy.deepcopy(defaults)
     try:
-        with open(custom_settings) as f:
-            custom_settings = yaml.load(f)
-        config.update(custom_settings)
+        resolved.update(_read_custom_settings(custom_settings))
     except FileNotFoundError:
         pass
+    return resolved
+
+
+@contextlib.contextmanager
+def using_config(resolved):
+    """Make resolved the config in effect for the current thread
+    for the duration of a with statement"""
+    token = _active.set(resolved)
+    try:
+        yield resolved
+    finally:
+        _active.reset(token)
+
+
+def carry_config(function):
+    """Wrap function to run with the config in effect in the calling
+    thread, for handing to another thread. Wrap once per call."""
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+def _read_custom_settings(path):
+    """Read custom settings, reusing those read earlier
+    if the file has not changed since."""
+    mtime = os.stat(path).st_mtime_ns
+    with _custom_settings_lock:
+        cached = _custom_settings.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path) as f:
+                cached = mtime, yaml.load(f) or {}
+            _custom_settings[path] = cached
+    return copy.deepcopy(cached[1])
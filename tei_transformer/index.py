@@ -0,0 +1,315 @@
+"""Make the index in Python from the .idx file LaTeX writes, instead of
+running makeindex."""
+
+# argparse is also imported
+import json
+import re
+import shlex
+import sys
+import unicodedata
+from collections import OrderedDict
+
+from path import Path
+
+
+def sort_key(name):
+    """A key sorting name as a reader would look it up: symbols, then
+       numbers, then letters, ignoring accents, case and punctuation,
+       and then by accents and case, so that the order is the same
+       everywhere rather than depending on the locale"""
+    decomposed = unicodedata.normalize('NFKD', name)
+    bare = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    primary = ' '.join(''.join(c if c.isalnum() else ' '
+                               for c in bare.casefold()).split())
+    first = primary[:1]
+    group = 2 if first.isalpha() else 1 if first.isdigit() else 0
+    return [group, primary, name.casefold(), name]
+
+
+class IndexStyle(dict):
+
+    """The parameters of a makeindex style file that say how the index
+       is written, with makeindex's defaults for any it does not set"""
+
+    defaults = {'preamble': '\\begin{theindex}\n',
+                'postamble': '\n\n\\end{theindex}\n',
+                'group_skip': '\n\n  \\indexspace\n',
+                'headings_flag': 0,
+                'heading_prefix': '',
+                'heading_suffix': '',
+                'symhead_positive': 'Symbols',
+                'numhead_positive': 'Numbers',
+                'item_0': '\n  \\item ',
+                'item_1': '\n    \\subitem ',
+                'item_2': '\n      \\subsubitem ',
+                'delim_0': ', ',
+                'delim_1': ', ',
+                'delim_2': ', ',
+                'delim_n': ', ',
+                'delim_r': '--',
+                'encap_prefix': '\\',
+                'encap_infix': '{',
+                'encap_suffix': '}'}
+
+    parameter = re.compile(r'^\s*(\w+)\s+("(?:[^"\\]|\\.)*"|-?\d+)',
+                           re.MULTILINE)
+    escapes = {'n': '\n', 't': '\t', '\\': '\\', '"': '"'}
+
+    def __init__(self, path=None):
+        super().__init__(self.defaults)
+        if path is not None and Path(path).exists():
+            self.update(self.parse(Path(path).text()))
+
+    @classmethod
+    def parse(cls, text):
+        """The parameters set in text, the content of a style file"""
+        return {name: cls._value(value)
+                for name, value in cls.parameter.findall(text)}
+
+    @classmethod
+    def _value(cls, value):
+        if not value.startswith('"'):
+            return int(value)
+        return re.sub(r'\\(.)', lambda m: cls.escapes.get(m.group(1),
+                                                          m.group(0)),
+                      value[1:-1])
+
+
+class PersonIndex():
+
+    """The index, as makeindex would make it from an .idx file with a
+       style, but sorted by sort_key. keys, a dict of sort keys by index
+       entry, is made once for the people of a persdict by sort_keys;
+       entries not in it, such as those indexed by the preamble, have
+       theirs made as they are met."""
+
+    entry = re.compile(r'\\indexentry\{')
+
+    def __init__(self, keys, style=None):
+        self.keys = keys
+        self.style_path = style
+        self.style = IndexStyle(style)
+
+    def latexmk_options(self, keys_path):
+        """Options telling latexmk to make the index with main, in place
+           of makeindex, from the sort keys written to keys_path. latexmk
+           then reruns latex when the index changes, as it would for
+           makeindex."""
+        Path(keys_path).write_text(json.dumps(self.keys))
+        # Run as a script, as latexmk may run it from anywhere
+        command = [sys.executable, str(Path(__file__).abspath()),
+                   str(Path(keys_path).abspath())]
+        if self.style_path is not None:
+            command += ['--style', str(Path(self.style_path).abspath())]
+        return ['-e', '$makeindex=q{%s %%O -o %%D %%S}'
+                % ' '.join(map(shlex.quote, command))]
+
+    @staticmethod
+    def sort_keys(persdict):
+        """Sort keys for the index name of each person in persdict"""
+        return {person.indexname: sort_key(person.indexname)
+                for person in persdict.values()}
+
+    def write(self, idx, ind):
+        """Write the index of the .idx file idx to ind, unless it
+           would be the same as it is. Returns whether it was written."""
+        text = self.text(idx)
+        ind = Path(ind)
+        if ind.exists() and ind.text() == text:
+            return False
+        ind.write_text(text)
+        return True
+
+    def text(self, idx):
+        """The text of the index of the .idx file idx"""
+        style = self.style
+        entries = self.entries(Path(idx).text())
+        ordered = sorted(entries, key=lambda levels: [self._key(level)
+                                                      for level in levels])
+        out = [style['preamble']]
+        group = None
+        previous = ()
+        for levels in ordered:
+            key = self._key(levels[0])
+            heading = self._heading(key)
+            if heading != group:
+                if group is not None:
+                    out.append(style['group_skip'])
+                group = heading
+                if style['headings_flag']:
+                    out.append(style['heading_prefix'] + heading
+                               + style['heading_suffix'])
+            shared = 0
+            while shared < len(previous) and previous[shared] == levels[shared]:
+                shared += 1
+            for depth in range(min(shared, len(levels) - 1), len(levels)):
+                out.append(style['item_%d' % depth] + levels[depth][1])
+                if depth == len(levels) - 1:
+                    pages = self._pages(entries[levels])
+                    if pages:
+                        out.append(style['delim_%d' % depth] + pages)
+            previous = levels
+        out.append(style['postamble'])
+        return ''.join(out)
+
+    def _key(self, level):
+        sort, _ = level
+        key = self.keys.get(sort)
+        if key is None:
+            key = self.keys[sort] = sort_key(sort)
+        return key
+
+    def _heading(self, key):
+        group, primary = key[:2]
+        if group == 2:
+            flag = self.style['headings_flag']
+            return primary[:1].upper() if flag >= 0 else primary[:1]
+        return self.style[('symhead_positive', 'numhead_positive')[group]]
+
+    @classmethod
+    def entries(cls, text):
+        """Each entry in text, the content of an .idx file, as a tuple
+           of (sort, display) for each of its levels, with a list of the
+           (page, encap) it was indexed at"""
+        entries = OrderedDict()
+        for match in cls.entry.finditer(text):
+            key, end = cls._group(text, match.end())
+            if not text.startswith('{', end):
+                continue
+            page, _ = cls._group(text, end + 1)
+            key, _, encap = cls._split(key, '|')
+            levels = []
+            for level in cls._split_all(key, '!'):
+                sort, at, display = cls._split(level, '@')
+                display = display if at else sort
+                levels.append((cls._unquote(sort), cls._unquote(display)))
+            entries.setdefault(tuple(levels), []).append(
+                (page, cls._unquote(encap)))
+        return entries
+
+    @staticmethod
+    def _group(text, start):
+        """The text of the brace group starting at start, which is just
+           after its opening brace, and the index just after it ends"""
+        depth = 1
+        i = start
+        while i < len(text):
+            c = text[i]
+            if c == '\\':
+                i += 2
+                continue
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if not depth:
+                    return text[start:i], i + 1
+            i += 1
+        return text[start:], len(text)
+
+    @classmethod
+    def _split(cls, text, char):
+        """text before and after the first unquoted char, as
+           str.partition"""
+        i = cls._find(text, char)
+        if i < 0:
+            return text, '', ''
+        return text[:i], char, text[i + 1:]
+
+    @classmethod
+    def _split_all(cls, text, char):
+        parts = []
+        while True:
+            part, found, text = cls._split(text, char)
+            parts.append(part)
+            if not found:
+                return parts
+
+    @staticmethod
+    def _find(text, char):
+        """The index of the first char in text not quoted with " or
+           escaped with \\, or -1"""
+        i = 0
+        while i < len(text):
+            if text[i] in '"\\':
+                i += 2
+                continue
+            if text[i] == char:
+                return i
+            i += 1
+        return -1
+
+    @staticmethod
+    def _unquote(text):
+        """text without the quotes before quoted characters. Escaped
+           characters keep their backslash, as with makeindex."""
+        return re.sub(r'\\.|"(.)',
+                      lambda match: match.group(1) or match.group(0), text)
+
+    def _pages(self, pages):
+        """The pages of an entry, each with its encap, those in explicit
+           ranges or in runs of three or more joined into ranges"""
+        style = self.style
+        numbers = OrderedDict()
+        opened = {}
+        ranges = []
+        for page, encap in pages:
+            if encap.startswith('('):
+                opened[encap[1:]] = page
+            elif encap.startswith(')'):
+                start = opened.pop(encap[1:], page)
+                ranges.append((start, page, encap[1:]))
+            else:
+                numbers.setdefault(encap, set()).add(page)
+        runs = list(ranges)
+        for encap, found in numbers.items():
+            arabic = sorted(int(p) for p in found if p.isdigit())
+            others = sorted(p for p in found if not p.isdigit())
+            runs.extend((p, p, encap) for p in others)
+            start = None
+            for i, number in enumerate(arabic):
+                if start is None:
+                    start = number
+                if i + 1 < len(arabic) and arabic[i + 1] == number + 1:
+                    continue
+                if number - start >= 2:
+                    runs.append((str(start), str(number), encap))
+                else:
+                    runs.extend((str(n), str(n), encap)
+                                for n in range(start, number + 1))
+                start = None
+        runs.sort(key=lambda run: (not run[0].isdigit(),
+                                   int(run[0]) if run[0].isdigit()
+                                   else run[0]))
+        return style['delim_n'].join(
+            self._encap(start, encap) if start == end else
+            self._encap(start, encap) + style['delim_r']
+            + self._encap(end, encap)
+            for start, end, encap in runs)
+
+    def _encap(self, page, encap):
+        if not encap:
+            return page
+        style = self.style
+        return (style['encap_prefix'] + encap + style['encap_infix'] + page
+                + style['encap_suffix'])
+
+
+def main(args=None):
+    """Write the index of an .idx file, as makeindex would"""
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('keys', help="JSON file of sort keys by entry")
+    parser.add_argument('idx')
+    parser.add_argument('-o', dest='ind', default=None)
+    parser.add_argument('--style', default=None)
+    args = parser.parse_args(args)
+    with open(args.keys) as f:
+        keys = json.load(f)
+    ind = args.ind or Path(args.idx).stripext() + '.ind'
+    PersonIndex(keys, args.style).write(args.idx, ind)
+
+
+if __name__ == '__main__':
+    main()
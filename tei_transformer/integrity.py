@@ -0,0 +1,192 @@
+"""Check that everything a text refers to exists, before transforming it."""
+
+import hashlib
+import json
+import re
+from collections import defaultdict
+
+from lxml import etree
+from path import Path
+
+from . import compression
+from .cache import digest
+from .config import config
+
+
+TEI = 'http://www.tei-c.org/ns/1.0'
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class ReferenceCheck():
+
+    """Check the persName refs and ptr targets of a text and its
+       personlist against the personlist, the xml:ids of the text and
+       the keys of the bibliography, raising an IntegrityError which
+       lists every problem at once. With cache, a FileCache, what the
+       fragments the text xi:includes hold is kept there under a digest
+       of each, so that only those which changed are parsed again."""
+
+    def __init__(self, inputpath, personlistpath, bibpath, cache=None):
+        self.texts = References.of_text(inputpath, cache)
+        self.personlist = References(personlistpath)
+        self.bibkeys = BibKeys(bibpath)
+
+    def __call__(self):
+        problems = list(self.problems())
+        if problems:
+            report = '\n'.join('%s:%s: %s' % p for p in problems)
+            raise IntegrityError('%d broken references\n%s'
+                                 % (len(problems), report))
+
+    def problems(self):
+        """Yield (path, line, message) for each broken reference"""
+        ids = set().union(*(text.ids for text in self.texts))
+        checks = [('person', self.personlist.persons,
+                   'is not in the personlist'),
+                  ('crossref', ids,
+                   'is not the xml:id of anything in the text'),
+                  ('bibliog', self.bibkeys,
+                   'is not a key in the bibliography')]
+        for references in self.texts + [self.personlist]:
+            for kind, known, message in checks:
+                refs = references.refs[kind]
+                for missing in sorted(set(refs) - set(known)):
+                    for line in refs[missing]:
+                        yield (references.path, line,
+                               '%s %s %s' % (kind, missing, message))
+
+
+class References():
+
+    """The xml:ids of a document and the references made in it,
+       collected in one pass, with what it xi:includes unless not
+       xinclude"""
+
+    query = etree.XPath(' | '.join(['//@xml:id',
+                                    '//tei:label/@n',
+                                    '//tei:persName/@ref',
+                                    '//tei:ptr/@target']),
+                        namespaces={'tei': TEI})
+
+    include = '{http://www.w3.org/2001/XInclude}include'
+
+    def __init__(self, path, xinclude=True):
+        self.path = path
+        self.ids = set()
+        self.persons = set()
+        self.refs = defaultdict(lambda: defaultdict(list))
+        self.includes = None
+        if path is None:
+            return
+        parser = etree.XMLParser(**config['parser_options'])
+        tree = compression.parse(path, parser)
+        if xinclude:
+            tree.xinclude()
+        else:
+            self.includes = self._includes(tree)
+        self._collect(tree)
+
+    @classmethod
+    def of_text(cls, path, cache=None):
+        """References for the text at path and, with cache, one for each
+           fragment it xi:includes, taken from cache if it holds one
+           for the same fragment and the files that includes"""
+        if cache is None:
+            return [cls(path)]
+        text = cls(path, xinclude=False)
+        if text.includes is None:  # Includes which only xinclude can do
+            return [cls(path)]
+        from .transform import Fragments  # Which imports this module
+        found = [text]
+        for include in text.includes:
+            key = digest(*Fragments._contents(include), 'references')
+            cached = cache.get(key)
+            if cached is None:
+                references = cls(include)
+                cache.put(key, references.stored())
+            else:
+                references = cls.restored(include, cached)
+            found.append(references)
+        return found
+
+    @classmethod
+    def _includes(cls, tree):
+        """The paths of the files tree xi:includes whole, or None if
+           it includes anything else"""
+        paths = []
+        for include in tree.iter(cls.include):
+            if (include.get('parse', 'xml') != 'xml'
+                    or include.get('xpointer') is not None
+                    or not include.get('href')):
+                return None
+            base = Path(include.base or '').dirname()
+            paths.append(base.joinpath(include.get('href')).abspath())
+        return paths
+
+    def stored(self):
+        """What is needed to make these References again"""
+        return {'ids': sorted(self.ids), 'persons': sorted(self.persons),
+                'refs': self.refs}
+
+    @classmethod
+    def restored(cls, path, stored):
+        """The References of path, from what stored gave"""
+        references = cls(None)
+        references.path = path
+        references.ids.update(stored['ids'])
+        references.persons.update(stored['persons'])
+        for kind, refs in stored['refs'].items():
+            references.refs[kind].update(refs)
+        return references
+
+    def _collect(self, tree):
+        for value in self.query(tree):
+            parent = value.getparent()
+            name = etree.QName(parent).localname
+            if name == 'persName' and value != '#??':
+                self.refs['person'][value[1:]].append(parent.sourceline)
+            elif name == 'ptr':
+                kind = parent.get('type')
+                self.refs[kind][value[1:]].append(parent.sourceline)
+            elif name == 'person':
+                self.persons.add(value)
+                self.ids.add(value)
+            else:
+                self.ids.add(value)
+
+
+class BibKeys():
+
+    """The entry keys of a BibTeX file, as a set. The keys are
+       cached beside it, and only parsed again if it changes."""
+
+    entry = re.compile(r'^\s*@(\w+)\s*[{(]\s*([^,\s]+)\s*,', re.MULTILINE)
+    not_entries = ['comment', 'preamble', 'string']
+
+    def __new__(cls, bibpath):
+        bibpath = Path(bibpath)
+        text = bibpath.bytes()
+        digest = hashlib.sha1(text).hexdigest()
+        cachepath = bibpath + '.keys'
+        try:
+            cached = json.loads(cachepath.text())
+            if cached['digest'] == digest:
+                return set(cached['keys'])
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        keys = cls.parse(text.decode('utf-8'))
+        cachepath.write_text(json.dumps({'digest': digest,
+                                         'keys': sorted(keys)}))
+        return keys
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def parse(cls, text):
+        """Keys of the entries in text"""
+        return {key for kind, key in cls.entry.findall(text)
+                if kind.lower() not in cls.not_entries}
@@ -0,0 +1,109 @@
+"""Peak memory of each stage of a run, for sizing the machines that
+run it."""
+
+import contextlib
+import mmap
+import threading
+import tracemalloc
+from collections import OrderedDict
+
+from path import Path
+
+
+class MemoryReport():
+
+    """The peak memory of each stage of a run: of Python objects, such
+       as tag proxies, latexified strings, the people of the persdict
+       and the list of tags sorted for transformation, traced with
+       tracemalloc; and of the whole process, sampled from the
+       resident set size, which also takes in lxml's trees. For each
+       stage the lines that allocated most of what was still held when
+       it ended are listed. Stages must run one at a time for their
+       peaks to be told apart."""
+
+    statm = Path('/proc/self/statm')
+    page_size = mmap.PAGESIZE
+
+    def __init__(self, sites=5, interval=0.005):
+        self.sites = sites
+        self.interval = interval
+        self.stages = OrderedDict()
+        self._rss_peak = 0
+        self._sampling = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        """Start tracing and sampling"""
+        tracemalloc.start()
+        if self.statm.exists():
+            self._sampler = threading.Thread(target=self._sample,
+                                             daemon=True)
+            self._sampler.start()
+        return self
+
+    def stop(self):
+        """Stop tracing and sampling"""
+        self._sampling.set()
+        tracemalloc.stop()
+
+    def _sample(self):
+        while not self._sampling.wait(self.interval):
+            self._rss_peak = max(self._rss_peak, self.rss())
+
+    @classmethod
+    def rss(cls):
+        """The resident set size of this process, in bytes"""
+        return int(cls.statm.text().split()[1]) * cls.page_size
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Record the memory taken by the body of a with statement, at
+           its peak and when it ends, as that of the stage name"""
+        before = self._snapshot()
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        sampled = self.statm.exists()
+        rss = self._rss_peak = self.rss() if sampled else None
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            if sampled:
+                self._rss_peak = max(self._rss_peak, self.rss())
+            sites = self._snapshot().compare_to(before, 'lineno')
+            self.stages[name] = {
+                'python_peak': peak - baseline,
+                'python_held': current - baseline,
+                'rss_peak': self._rss_peak if sampled else None,
+                'rss_growth': self._rss_peak - rss if sampled else None,
+                'sites': [(str(s.traceback), s.size_diff, s.count_diff)
+                          for s in sites[:self.sites] if s.size_diff > 0]}
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def report(self):
+        """What each stage took, at its peak and when it ended, and its
+           biggest allocation sites, as lines of text"""
+        lines = []
+        for name, stage in self.stages.items():
+            rss = ('rss peak %s, up %s' % (self._size(stage['rss_peak']),
+                                           self._size(stage['rss_growth']))
+                   if stage['rss_peak'] else 'rss not sampled')
+            lines.append('%-12s python peak %s, held %s; %s'
+                         % (name, self._size(stage['python_peak']),
+                            self._size(stage['python_held']), rss))
+            for site, size, count in stage['sites']:
+                lines.append('    %10s in %7d blocks  %s'
+                             % (self._size(size), count, site))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _size(size):
+        for unit in ['B', 'KiB', 'MiB']:
+            if abs(size) < 1024:
+                return '%.1f %s' % (size, unit)
+            size /= 1024
+        return '%.1f GiB' % size
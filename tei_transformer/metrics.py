@@ -0,0 +1,97 @@
+"""Metrics of a run, for comparing many runs: written as a line of JSON
+or as OpenMetrics text."""
+
+import contextlib
+import json
+import time
+from collections import OrderedDict
+
+from path import Path
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+
+class RunMetrics(OrderedDict):
+
+    """Sizes, counts and timings of the transformation of inputpath,
+       filled in as it goes: the size of the input, the number of each
+       tag transformed, the size of the persdict and whether it was
+       already built, how long each stage took, how much LaTeX was
+       made, how long latexmk took and how many passes it made, and
+       the peak resident memory of this process and of latexmk."""
+
+    formats = ['jsonl', 'openmetrics']
+    # OpenMetrics label and metric name for each dict of metrics
+    labelled = {'stages': ('stage', 'stage_seconds'),
+                'tags': ('tag', 'tag_elements')}
+
+    def __init__(self, inputpath):
+        super().__init__()
+        self['input'] = str(inputpath)
+        self['input_bytes'] = Path(inputpath).size
+        self['stages'] = OrderedDict()
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the body of a with statement as the stage name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self['stages'][name] = time.perf_counter() - started
+
+    def finish(self):
+        """Record the total time and peak memory of the run"""
+        self['seconds'] = time.perf_counter() - self._started
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux
+            for key, who in [('peak_rss_bytes', resource.RUSAGE_SELF),
+                             ('latexmk_peak_rss_bytes',
+                              resource.RUSAGE_CHILDREN)]:
+                self[key] = resource.getrusage(who).ru_maxrss * 1024
+        return self
+
+    def write(self, path, format='jsonl'):
+        """Append a line of JSON to path, or with format openmetrics
+           replace it with an OpenMetrics exposition"""
+        if format == 'jsonl':
+            with open(path, 'a') as f:
+                f.write(json.dumps(self) + '\n')
+        elif format == 'openmetrics':
+            Path(path).write_text(self.openmetrics())
+        else:
+            raise ValueError('No metrics format %s' % format)
+
+    def openmetrics(self, prefix='tei_transformer'):
+        """The metrics as OpenMetrics text, labelled by input"""
+        lines = []
+        labels = {'input': self['input']}
+        for key, value in self.items():
+            if isinstance(value, dict):
+                label, metric = self.labelled[key]
+                name = '%s_%s' % (prefix, metric)
+                lines.append('# TYPE %s gauge' % name)
+                for item, number in sorted(value.items()):
+                    lines.append(self._sample(name, dict(labels,
+                                                         **{label: item}),
+                                              number))
+            elif isinstance(value, (bool, int, float)):
+                name = '%s_%s' % (prefix, key)
+                lines.append('# TYPE %s gauge' % name)
+                lines.append(self._sample(name, labels, value))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _sample(name, labels, value):
+        escaped = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                        .replace('"', '\\"')
+                                        .replace('\n', '\\n'))
+                           for k, v in sorted(labels.items()))
+        if isinstance(value, bool):
+            value = int(value)
+        return '%s{%s} %s' % (name, escaped, value)
@@ -0,0 +1,145 @@
+"""A persdict kept in an SQLite file, for personlists too big to hold in
+memory, with only the people looked up read from it."""
+
+import functools
+import os
+import sqlite3
+import tempfile
+import threading
+from collections.abc import Mapping
+
+from path import Path
+
+from .cache import code_digest, config_digest, digest
+from .persontable import Person
+from .tags import parser
+
+
+class PersonDatabase(Mapping):
+
+    """A read-only persdict over the SQLite file at path, made by build.
+       People are fetched by xml:id as they are looked up, and the last
+       cache_size of them kept. It is closed by close, or at the end of
+       a with statement."""
+
+    def __init__(self, path, cache_size=1024):
+        self.path = Path(path)
+        self._open(sqlite3.connect(self.path, check_same_thread=False),
+                   cache_size)
+
+    def _open(self, db, cache_size):
+        self._db = db
+        self._lock = threading.Lock()
+        self._used = set()
+        self._fetch = functools.lru_cache(cache_size)(self._fetch)
+
+    @classmethod
+    def build(cls, personlistpath, path, errors=None, cache_size=1024):
+        """A PersonDatabase of personlistpath at path, built unless it
+           already holds the same personlist, made with the same config
+           and code. The personlist is read a person at a time, twice:
+           once for names, and once to transform descriptions, which
+           may mention other people by name. Errors recorded in
+           errors leave it to be built again next time."""
+        path = Path(path)
+        source = digest(Path(personlistpath).bytes(), config_digest(),
+                        code_digest())
+        if cls._source(path) == source:
+            return cls(path, cache_size)
+        fd, temp = tempfile.mkstemp(dir=path.dirname(), suffix='.tmp')
+        os.close(fd)
+        try:
+            db = sqlite3.connect(temp)
+            try:
+                with db:
+                    cls._fill(db, personlistpath, source, errors)
+            finally:
+                db.close()
+            os.replace(temp, path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return cls(path, cache_size)
+
+    @staticmethod
+    def _source(path):
+        if not path.exists():
+            return None
+        db = sqlite3.connect(path)
+        try:
+            return db.execute('SELECT value FROM meta WHERE key = ?',
+                              ('source',)).fetchone()[0]
+        except (sqlite3.DatabaseError, TypeError):
+            return None
+        finally:
+            db.close()
+
+    @classmethod
+    def _fill(cls, db, personlistpath, source, errors):
+        db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        db.execute('CREATE TABLE person (xml_id TEXT PRIMARY KEY, '
+                   'indexname TEXT, indexonly INTEGER, description TEXT)')
+        db.executemany('INSERT OR REPLACE INTO person VALUES (?, ?, ?, NULL)',
+                       ((person.xml_id, person.indexname, person.indexonly)
+                        for person in cls._people(personlistpath)))
+        # Only names are looked up while descriptions are transformed
+        names = cls.__new__(cls)
+        names._open(db, 1024)
+        recorded = 0 if errors is None else len(errors)
+        for person in cls._people(personlistpath):
+            description = person(names, errors)[3]
+            db.execute('UPDATE person SET description = ? WHERE xml_id = ?',
+                       (description, person.xml_id))
+        if errors is not None and len(errors) > recorded:
+            # Without its source it is built again, to report them again
+            return
+        db.execute('INSERT INTO meta VALUES (?, ?)', ('source', source))
+
+    @staticmethod
+    def _people(personlistpath):
+        """A PersDict.Person for each person in personlistpath, parsed
+           one at a time, and each cleared once the next is reached"""
+        from .transform import PersDict  # Which imports this module
+        for _, tag in parser.iterparse(personlistpath, tag='{*}person'):
+            yield PersDict.Person(tag)
+            tag.clear()
+            while tag.getprevious() is not None:
+                del tag.getparent()[0]
+
+    def _fetch(self, ref):
+        with self._lock:
+            return self._db.execute(
+                'SELECT indexname, indexonly, description FROM person '
+                'WHERE xml_id = ?', (ref,)).fetchone()
+
+    def __getitem__(self, ref):
+        row = self._fetch(ref)
+        if row is None:
+            raise KeyError(ref)
+        indexname, indexonly, description = row
+        self._used.add(ref)
+        return Person(ref, indexname, bool(indexonly), description)
+
+    def __iter__(self):
+        with self._lock:
+            refs = [ref for ref, in
+                    self._db.execute('SELECT xml_id FROM person')]
+        return iter(refs)
+
+    def __len__(self):
+        with self._lock:
+            count, = self._db.execute('SELECT count(*) FROM person').fetchone()
+        return count
+
+    def used(self):
+        """The people looked up so far, by xml:id"""
+        return {ref: self[ref] for ref in sorted(self._used)}
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,116 @@
+"""A persdict kept in a file and mapped into memory read-only, so that
+any number of processes can share one copy of it."""
+
+import mmap
+import os
+import struct
+import tempfile
+from collections import namedtuple
+from collections.abc import Mapping
+
+from path import Path
+
+Person = namedtuple('Person', ['xml_id', 'indexname',
+                               'indexonly', 'description'])
+
+
+class PersonTable(Mapping):
+
+    """A read-only persdict over the file at path, written by write.
+       Pages of the file are mapped, not read, so processes attached to
+       the same table share them through the page cache, and a person
+       is only decoded when looked up.
+
+       The file is a header, a sorted index of (key offset, record
+       offset) pairs, and the keys and records, each string prefixed
+       by its length in bytes."""
+
+    magic = b'TEIPERS1'
+    header = struct.Struct('<8sI')
+    slot = struct.Struct('<II')
+    length = struct.Struct('<I')
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = self.header.unpack_from(self._map)
+        if magic != self.magic:
+            raise ValueError('%s is not a person table' % path)
+
+    @classmethod
+    def write(cls, persdict, path):
+        """Write persdict to a table at path, whole, and renamed into
+           place so that a process attaching never sees it half-written"""
+        path = Path(path)
+        refs = sorted(persdict, key=lambda ref: ref.encode('utf-8'))
+        data = bytearray()
+        slots = []
+        start = cls.header.size + cls.slot.size * len(refs)
+        for ref in refs:
+            person = persdict[ref]
+            key_offset = start + len(data)
+            data += cls._string(ref)
+            record_offset = start + len(data)
+            data += bytes([bool(person.indexonly)])
+            data += cls._string(person.indexname)
+            data += cls._string(person.description)
+            slots.append(cls.slot.pack(key_offset, record_offset))
+        fd, temp = tempfile.mkstemp(dir=path.dirname(), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(cls.header.pack(cls.magic, len(refs)))
+            f.write(b''.join(slots))
+            f.write(data)
+        os.replace(temp, path)
+        return cls(path)
+
+    @classmethod
+    def _string(cls, text):
+        encoded = text.encode('utf-8')
+        return cls.length.pack(len(encoded)) + encoded
+
+    def _read(self, offset):
+        """The string at offset, and the offset after it"""
+        size, = self.length.unpack_from(self._map, offset)
+        start = offset + self.length.size
+        return self._map[start:start + size], start + size
+
+    def _slot(self, index):
+        return self.slot.unpack_from(
+            self._map, self.header.size + self.slot.size * index)
+
+    def _find(self, key):
+        """The record offset of key, by binary search, or None"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, record_offset = self._slot(middle)
+            found, _ = self._read(key_offset)
+            if found == key:
+                return record_offset
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def __getitem__(self, ref):
+        offset = self._find(ref.encode('utf-8'))
+        if offset is None:
+            raise KeyError(ref)
+        indexonly = bool(self._map[offset])
+        indexname, offset = self._read(offset + 1)
+        description, _ = self._read(offset)
+        return Person(ref, indexname.decode('utf-8'), indexonly,
+                      description.decode('utf-8'))
+
+    def __iter__(self):
+        for index in range(self._count):
+            key, _ = self._read(self._slot(index)[0])
+            yield key.decode('utf-8')
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._map.close()
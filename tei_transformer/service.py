@@ -0,0 +1,314 @@
+"""Serve transformations over local HTTP from a pool of warm workers."""
+
+# argparse is also imported
+import hashlib
+import json
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from path import Path
+
+from . import compression
+from .config import config, resolve_config, using_config
+from .persontable import PersonTable
+from .tags import ImplementationError
+from .transform import PersDict, Resources, Transformer
+
+
+class Warm():
+
+    """What each worker process keeps between requests: PersDicts, by
+       project and personlist digest, or person tables, by path"""
+
+    persdicts = OrderedDict()
+
+    @classmethod
+    def persdict(cls, project, personlistpath, metrics):
+        key = project, hashlib.sha1(personlistpath.bytes()).hexdigest()
+        return cls._kept(key, lambda: PersDict(personlistpath), metrics)
+
+    @classmethod
+    def table(cls, path, metrics):
+        return cls._kept(path, lambda: PersonTable(path), metrics)
+
+    @classmethod
+    def _kept(cls, key, make, metrics):
+        metrics['persdict_cached'] = key in cls.persdicts
+        if key in cls.persdicts:
+            cls.persdicts.move_to_end(key)
+        else:
+            cls.persdicts[key] = make()
+            while len(cls.persdicts) > config['service']['persdicts']:
+                cls.persdicts.popitem(last=False)
+        return cls.persdicts[key]
+
+
+class Tables():
+
+    """Person tables, made by the service from the personlist of each
+       project, once for each version of it, for its workers to share.
+       Each project has a lock of its own, taken only to make a table."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __call__(self, project):
+        """The path of the person table of project"""
+        project = Path(project).abspath()
+        with using_config(resolve_config(project)):
+            name = config['resources']['personlist']['name']
+            personlistpath = compression.find(
+                project.joinpath('resources', name))
+            digest = hashlib.sha1(personlistpath.bytes()).hexdigest()
+            work_dir = project.joinpath(config['workdir'])
+            path = work_dir.joinpath('persons-%s.table' % digest[:16])
+            # Tables are renamed into place, so one there is whole
+            if path.exists():
+                return path
+            with self._project_lock(project):
+                if not path.exists():
+                    work_dir.makedirs_p()
+                    for stale in work_dir.files('persons-*.table'):
+                        stale.remove()
+                    PersonTable.write(PersDict(personlistpath), path)
+        return path
+
+    def _project_lock(self, project):
+        with self._lock:
+            return self._locks.setdefault(project, threading.Lock())
+
+
+def work(request, submitted):
+    """Carry out a request in a worker process. Returns a dict with
+       either 'latex' or 'pdf', or 'error', and 'metrics'."""
+    started = time.time()
+    metrics = {'queued': started - submitted}
+    try:
+        result = _transform(request, metrics)
+    except Exception as err:  # Reported to the client instead
+        result = {'error': _describe(err)}
+    metrics['worker'] = time.time() - started
+    result['metrics'] = metrics
+    return result
+
+
+def _transform(request, metrics):
+    project = Path(request['project']).abspath()
+    name = request.get('path')
+    if 'tei' in request:
+        # Workers run side by side, so each text gets files of its own
+        name = '%s-%s.xml' % (request.get('name', 'preview'),
+                              uuid.uuid4().hex[:12])
+    inputpath = project.joinpath(name or 'preview.xml')
+    resources = Resources(inputpath, request.get('outname'),
+                          request.get('standalone', False))
+    inputpaths = resources.inputpaths
+    if 'tei' in request:
+        inputpath = resources.workfiles[0].stripext() + '.xml'
+        inputpath.write_text(request['tei'])
+        inputpaths = (inputpath,) + inputpaths[1:]
+        try:
+            return _transformed(request, metrics, resources, inputpaths)
+        finally:
+            work_dir = resources.workfiles[0].dirname()
+            for path in work_dir.files(inputpath.namebase + '.*'):
+                path.remove_p()
+    return _transformed(request, metrics, resources, inputpaths)
+
+
+def _transformed(request, metrics, resources, inputpaths):
+    project = Path(request['project']).abspath()
+    if 'persons' in request:
+        persdict = Warm.table(request['persons'], metrics)
+    else:
+        persdict = Warm.persdict(project, inputpaths[1], metrics)
+    output = request.get('output', 'latex')
+    references = resources.references if request.get('check') else None
+    transformer = Transformer(request.get('force', False), inputpaths,
+                              resources.textwraps, resources.workfiles,
+                              references=references,
+                              keep_going=request.get('keep_going', False),
+                              persdict=persdict, pdf=output == 'pdf')
+    metrics.update(transformer.stages.durations())
+    result = {'errors': transformer.errors or []}
+    if output == 'pdf':
+        result['pdf'] = str(resources.workfiles[2])
+    else:
+        result['latex'] = transformer.latex
+    return result
+
+
+def _describe(err):
+    if isinstance(err, ImplementationError):
+        tag = err.tag
+        return 'ImplementationError: line %s: <%s> %s' % (
+            tag.sourceline, tag.localname, err.reason)
+    return '%s: %s' % (type(err).__name__, err)
+
+
+class Metrics():
+
+    """Counts and timings of the requests served"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'accepted': 0, 'rejected': 0,
+                       'failed': 0, 'in_flight': 0}
+        self.timings = {}
+
+    def start(self):
+        with self._lock:
+            self.counts['accepted'] += 1
+            self.counts['in_flight'] += 1
+
+    def reject(self):
+        with self._lock:
+            self.counts['rejected'] += 1
+
+    def finish(self, result):
+        with self._lock:
+            self.counts['in_flight'] -= 1
+            if 'error' in result:
+                self.counts['failed'] += 1
+            for stage, seconds in result['metrics'].items():
+                if isinstance(seconds, bool):
+                    continue
+                count, total, most = self.timings.get(stage, (0, 0, 0))
+                self.timings[stage] = (count + 1, total + seconds,
+                                       max(most, seconds))
+
+    def report(self):
+        with self._lock:
+            timings = {stage: {'count': count, 'mean': total / count,
+                               'max': most}
+                       for stage, (count, total, most)
+                       in self.timings.items()}
+            return {'counts': dict(self.counts), 'timings': timings}
+
+
+class Service():
+
+    """A pool of worker processes taking at most workers + queue
+       requests at once; any more are turned away rather than queued.
+       With shared_persons, each project's people are put in a person
+       table once, which the workers map rather than each building or
+       holding a persdict of their own."""
+
+    def __init__(self, workers, queue, shared_persons=False):
+        self.pool = ProcessPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.metrics = Metrics()
+        self.tables = Tables() if shared_persons else None
+
+    def __call__(self, request):
+        """Result of request, or None if the service is too busy"""
+        if not self.slots.acquire(blocking=False):
+            self.metrics.reject()
+            return None
+        self.metrics.start()
+        submitted = time.time()
+        try:
+            result = self._submit(request, submitted)
+        finally:
+            self.slots.release()
+        result['metrics']['total'] = time.time() - submitted
+        self.metrics.finish(result)
+        return result
+
+    def _submit(self, request, submitted):
+        if self.tables is not None:
+            try:
+                persons = self.tables(request['project'])
+            except Exception as err:  # Reported to the client instead
+                return {'error': _describe(err), 'metrics': {}}
+            request = dict(request, persons=persons)
+        return self.pool.submit(work, request, submitted).result()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    """POST /transform with a json request; GET /metrics"""
+
+    service = None
+
+    def do_POST(self):
+        if self.path != '/transform':
+            return self._respond(404, {'error': 'Not found'})
+        try:
+            length = int(self.headers['Content-Length'])
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+        except (TypeError, ValueError) as err:
+            return self._respond(400, {'error': 'Bad request: %s' % err})
+        if not isinstance(request, dict) or 'project' not in request:
+            return self._respond(400, {'error': 'No project given'})
+        result = self.service(request)
+        if result is None:
+            return self._respond(503, {'error': 'Busy'},
+                                 {'Retry-After': '1'})
+        self._respond(422 if 'error' in result else 200, result)
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self._respond(404, {'error': 'Not found'})
+        self._respond(200, self.service.metrics.report())
+
+    def _respond(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for header in (headers or {}).items():
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(host, port, workers, queue, shared_persons=False):
+    """Serve until interrupted"""
+    RequestHandler.service = Service(workers, queue, shared_persons)
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        RequestHandler.service.shutdown()
+
+
+def main():
+    """Parse arguments and serve."""
+    import argparse
+
+    settings = config['service']
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=settings['host'],
+                        help="Address to listen on")
+    parser.add_argument('-p', '--port', type=int, default=settings['port'],
+                        help="Port to listen on")
+    parser.add_argument('-w', '--workers', type=int,
+                        default=settings['workers'],
+                        help="Number of worker processes")
+    parser.add_argument('-q', '--queue', type=int, default=settings['queue'],
+                        help="Requests to queue before turning more away")
+    parser.add_argument('--shared-persons', action='store_true',
+                        default=settings['shared_persons'],
+                        help="Build each project's people once into a "
+                             "table that all workers map read-only")
+    args = parser.parse_args(sys.argv[1:])
+    serve(args.host, args.port, args.workers, args.queue,
+          args.shared_persons)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Run the stages of a transformation at the same time where they allow."""
+
+import contextlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import carry_config
+
+
+class Stages():
+
+    """Stages of work, each run on a thread of its own as soon as the
+       stages it comes after are done, and given their results in order.
+       The time each takes is recorded, and with it the critical path:
+       the chain of stages that decided how long the whole took. At most
+       jobs stages run at once, if given, and each runs inside the
+       context manager around(name), if given."""
+
+    def __init__(self, jobs=None, around=None):
+        self.jobs = jobs
+        self.around = around or (lambda name: contextlib.nullcontext())
+        self.stages = OrderedDict()
+        self.times = {}
+        self.started = self.finished = None
+
+    def add(self, name, function, after=()):
+        """Add a stage, to run function with the results of the
+           stages named in after, which must already have been added"""
+        unknown = [a for a in after if a not in self.stages]
+        if unknown:
+            raise KeyError('No stage %s' % ', '.join(unknown))
+        self.stages[name] = function, tuple(after)
+
+    def run(self):
+        """Run every stage, and return their results by name. If a stage
+           fails, so do those after it, and once all have finished the
+           first failure is raised."""
+        self.started = time.perf_counter()
+        futures = OrderedDict()
+        # Stages come after stages added before them, and so are
+        # started after them, so any number of jobs cannot deadlock
+        jobs = self.jobs or len(self.stages) or 1
+        with ThreadPoolExecutor(jobs) as pool:
+            for name, (function, after) in self.stages.items():
+                waits = [futures[a] for a in after]
+                futures[name] = pool.submit(carry_config(self._run),
+                                            name, function, waits)
+        self.finished = time.perf_counter()
+        return OrderedDict((name, future.result())
+                           for name, future in futures.items())
+
+    def _run(self, name, function, waits):
+        args = [future.result() for future in waits]
+        start = time.perf_counter()
+        try:
+            with self.around(name):
+                return function(*args)
+        finally:
+            self.times[name] = (start - self.started,
+                                time.perf_counter() - self.started)
+
+    def durations(self):
+        """Seconds taken by each stage that ran"""
+        return {name: end - start
+                for name, (start, end) in self.times.items()}
+
+    def critical_path(self):
+        """Names of the stages on the critical path, in order"""
+        if not self.times:
+            return []
+        path = [max(self.times, key=lambda n: self.times[n][1])]
+        while True:
+            after = [a for a in self.stages[path[-1]][1] if a in self.times]
+            if not after:
+                return path[::-1]
+            path.append(max(after, key=lambda n: self.times[n][1]))
+
+    def report(self):
+        """When each stage ran and how long it took, and the critical
+           path, as lines of text"""
+        durations = self.durations()
+        lines = ['%-12s %8.3fs  (%.3fs to %.3fs)' % (name, durations[name],
+                                                     start, end)
+                 for name, (start, end) in sorted(self.times.items(),
+                                                  key=lambda t: t[1])]
+        path = self.critical_path()
+        lines.append('critical path: %s, %.3fs of %.3fs'
+                     % (' > '.join(path), sum(durations[n] for n in path),
+                        self.finished - self.started))
+        return '\n'.join(lines)
@@ -1,24 +1,72 @@
 import calendar
+import json
+import threading
 from functools import partial
 
 from latexfixer.fix import LatexText
 
 from lxml import etree
 
+from . import compression
 from .config import config
 from .etreemethods import EtreeMethods
 
 
 class ImplementationError(Exception):
-    pass
+
+    @property
+    def tag(self):
+        return self.args[0]
+
+    @property
+    def reason(self):
+        return ' '.join(map(str, self.args[1:])) or 'not implemented'
+
+
+class ImplementationErrors(list):
+
+    """ImplementationErrors recorded instead of raised, so that a
+       whole text can be transformed and its problems reported at once"""
+
+    def record(self, tag, error):
+        """Record error and return a placeholder for tag"""
+        self.append({'file': tag.getroottree().docinfo.URL,
+                     'line': tag.sourceline,
+                     'tag': tag.localname,
+                     'attributes': dict(tag.attrib),
+                     'reason': error.reason})
+        return config['error_placeholder'] % {
+            'tag': tag.localname,
+            'line': tag.sourceline,
+            'text': ''.join(tag.itertext())}
+
+    def write(self, path):
+        """Write the errors recorded to path as json"""
+        with open(path, 'w') as f:
+            json.dump(self, f, indent=1)
+
+    def summary(self):
+        return '\n'.join('{file}:{line}: <{tag}> {reason}'.format(**e)
+                         for e in self)
 
 
 class TagProcessor():
 
-    def __init__(self, tag, persdict=None, in_body=True):
+    def __init__(self, tag, persdict=None, in_body=True, errors=None,
+                 witnesses=None):
+        try:
+            self._process(tag, persdict, in_body, witnesses)
+        except ImplementationError as error:
+            if errors is None:
+                raise
+            tag.string_replace(errors.record(tag, error))
+
+    def _process(self, tag, persdict, in_body, witnesses):
         self._check_no_children(tag)
         if tag.localname == 'persName':
             self._handle_persname(tag, persdict, in_body)
+        elif tag.localname == 'app':
+            tag.witnesses = witnesses
         replacement = self._get_replacement(tag)
         self._handle_replacement(tag, replacement)
 
@@ -26,7 +74,7 @@ class TagProcessor():
     def _check_no_children(tag):
         not_good_children = tag.localname not in ['choice', 'app']
         if not len(tag) == 0 and not_good_children:
-            tag.raise_()
+            tag.raise_('unexpected children')
 
     @staticmethod
     def _handle_persname(tag, persdict, in_body):
@@ -37,8 +85,8 @@ class TagProcessor():
     def _get_replacement(tag):
         try:
             return tag.get_replacement()
-        except (KeyError, AttributeError):
-            tag.raise_()
+        except (KeyError, AttributeError) as err:
+            tag.raise_('%s: %s' % (type(err).__name__, err))
 
     @staticmethod
     def _handle_replacement(tag, replacement):
@@ -46,7 +94,7 @@ class TagProcessor():
             return tag.string_replace(replacement)
         elif replacement is None: # Deferred processing
             return
-        tag.raise_()
+        tag.raise_('replacement is not a string')
 
 
 class TEITag(etree.ElementBase, EtreeMethods):
@@ -66,7 +114,7 @@ class TEITag(etree.ElementBase, EtreeMethods):
 
     def get_replacement(self):
         """Called to get a string replacement for a tag"""
-        raise NotImplementedError(self)
+        self.raise_('no handler for %s' % self.localname)
 
     def raise_(self, *args):
         """Raise an implementation error with self as argument"""
@@ -291,6 +339,10 @@ class PersName(TEITag, InBodyCheck):
             return '\\indexperson{%s}{%s}' % t
 
         def _person():
+            define = getattr(self.persdict, 'define', None)
+            if define is not None:
+                define(ref)
+                return '\\person{%s}{%s}' % (ref, self.text)
             t = (ref, person.indexname, person.description, self.text)
             return '\\person{%s}{%s}{%s}{%s}' % t
 
@@ -545,11 +597,24 @@ class FilterTag(TEITag):
         return '\\correction{%s}{%s}' % tuple(kids)
 
     def _app(self):
-        rdgs = self.iterchildren('{*}rdg')
-        witmaker = lambda tag: '\\wit{%s}{%s}' % (tag.text, tag.attrib['wit'])
-        witnesses = ' '.join([witmaker(x) for x in rdgs])
-        lem = self.textfinder('{*}lem')
-        return '\\variants{%s}{%s}' % (lem, witnesses)
+        lem = None
+        readings = []
+        for child in self.iterchildren('{*}lem', '{*}rdg'):
+            if child.localname == 'rdg':
+                readings.append(self._reading(child))
+            elif lem is None:
+                lem = child
+        if lem is None:
+            self.raise_()
+        return '\\variants{%s}{%s}' % (lem.text, ' '.join(readings))
+
+    def _reading(self, rdg):
+        """\\wit{text}{@wit}, or with witnesses \\cwit{text}{aliases}"""
+        witnesses = getattr(self, 'witnesses', None)
+        if witnesses is None:
+            return '\\wit{%s}{%s}' % (rdg.text, rdg.attrib['wit'])
+        return '\\cwit{%s}{%s}' % (rdg.text,
+                                    witnesses.aliases(rdg.attrib['wit']))
 
     def textfinder(self, term):
         x = self.find(term)
@@ -597,41 +662,86 @@ class PageBreak(TEITag):
 # END OF TAGS
 
 class ParserMethods():
-    """Methods for parsing and transforming XML."""
+    """Methods for parsing and transforming XML.
+       Each thread gets a parser of its own."""
 
     def __init__(self):
-        self._parser = None
+        self._local = threading.local()
 
     @staticmethod
-    def transform_tree(tree, persdict, in_body=True):
-        """Transform a tree."""
-        for tag in sorted(list(tree.getiterator('*'))):
+    def transform_tree(tree, persdict, in_body=True, errors=None,
+                       counts=None, witnesses=None):
+        """Transform a tree. If errors is given, ImplementationErrors
+           are recorded in it rather than raised. If counts (a Counter)
+           is given, the tags transformed are counted in it by name.
+           If witnesses is given, readings name witnesses by its
+           aliases."""
+        tags = sorted(list(tree.getiterator('*')))
+        if counts is not None:
+            counts.update(tag.localname for tag in tags)
+        for tag in tags:
             if tag.localname == 'persName':
-                tag.process(persdict, in_body=in_body)
+                tag.process(persdict, in_body=in_body, errors=errors)
             else:
-                tag.process()
+                tag.process(errors=errors, witnesses=witnesses)
         return tree
 
     @property
     def parser(self):
         """Return a parser. A property not an attribute
            so that the parser can be constructed w/r/t
-           a config that takes account of user settings.
+           a config that takes account of user settings,
+           and made again if those settings change.
         """
-        if not self._parser:
-            self._parser = self.make_parser()
-        return self._parser
+        local = self._local
+        options = config['parser_options']
+        if getattr(local, 'options', None) != options:
+            local.parser = self.make_parser()
+            local.options = dict(options)
+        return local.parser
+
+    def parse(self, textpath, xinclude=False):
+        """Parse textpath, resolving any xi:includes if xinclude.
+           A path ending .gz or .xz is decompressed as it is read."""
+        tree = compression.parse(textpath, self.parser)
+        if xinclude:
+            tree.xinclude()
+        return tree
+
+    def iterparse(self, textpath, events=('end',), tag=None, handlers=True):
+        """Iteratively parse textpath, with the same options
+           and tag handling as parse. Only elements matching
+           tag are yielded, and so given proxies. If not handlers,
+           elements are plain, and their text left as it is."""
+        # iterparse has no ns_clean option
+        options = {k: v for k, v in config['parser_options'].items()
+                   if k != 'ns_clean'}
+        open_ = compression.opener(textpath)
+        source = textpath if open_ is None else open_(textpath, 'rb')
+        context = etree.iterparse(source, events=events, tag=tag,
+                                  **options)
+        if handlers:
+            context.set_element_class_lookup(self.make_lookup())
+        if open_ is None:
+            return context
+        return self._closing(context, source)
 
-    def parse(self, textpath):
-        """Parse textpath"""
-        return etree.parse(textpath, self.parser)
+    @staticmethod
+    def _closing(context, source):
+        with source:
+            yield from context
 
     @classmethod
     def make_parser(cls):
         """Create a parser with custom tag handling."""
         parser = etree.XMLParser(**config['parser_options'])
+        parser.set_element_class_lookup(cls.make_lookup())
+        return parser
+
+    @staticmethod
+    def make_lookup():
+        """Create a lookup assigning tags to their handlers."""
         lookup = etree.ElementNamespaceClassLookup()
-        parser.set_element_class_lookup(lookup)
         namespace = lookup.get_namespace('http://www.tei-c.org/ns/1.0')
         namespace[None] = TEITag
 
@@ -646,6 +756,6 @@ class ParserMethods():
 
         for handler, target in _handlers(TEITag):
             namespace[target] = handler
-        return parser
+        return lookup
 
 parser = ParserMethods()
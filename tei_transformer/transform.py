@@ -1,58 +1,1137 @@
 """Transform a tei file."""
 
 # argparse is also imported
+import contextlib
+import copy
+import hashlib
+import json
 import os
 import re
+import signal
 import subprocess
 import sys
-from collections import namedtuple
+import tempfile
+import time
+from collections import Counter, namedtuple, OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 from lxml import etree
 from path import Path
 
-from .tags import parser
-from .config import config, update_config
+from . import compression
+from .cache import (FileCache, SharedCache, code_digest, config_digest,
+                    digest, file_digest, tool_digest, tool_version)
+from .index import PersonIndex
+from .integrity import ReferenceCheck
+from .memory import MemoryReport
+from .metrics import RunMetrics
+from .persondb import PersonDatabase
+from .stages import Stages
+from .tags import parser, ImplementationErrors
+from .config import config, update_config, carry_config
+
+
+class LatexError(Exception):
+
+    """A run of latex that failed: the lines of output about it, the
+       .tex file and line it was at, if known, and once located the
+       xml:id and line in the TEI of the division it was in"""
+
+    label = re.compile(r'\\label\{([^}]*)\}')
+
+    def __init__(self, excerpt, tex=None, line=None):
+        super().__init__(excerpt, tex, line)
+        self.excerpt = excerpt
+        self.tex = tex
+        self.line = line
+        self.identifier = None
+        self.tei = None
+
+    def locate(self, inputpath):
+        """Find the division of inputpath the error was in, by the last
+        \\label before its line"""
+        if self.line is None or not Path(self.tex or '').isfile():
+            return
+        before = self.tex.lines()[:self.line]
+        labels = self.label.findall(''.join(before))
+        if not labels:
+            return
+        self.identifier = labels[-1]
+        root = parser.parse(inputpath).getroot()
+        found = root.xpath('//*[@xml:id=$id]', id=self.identifier)
+        if found:
+            self.tei = '%s:%s' % (inputpath, found[0].sourceline)
+
+    def __str__(self):
+        where = []
+        if self.line is not None:
+            where.append('%s:%s' % (self.tex, self.line))
+        if self.identifier is not None:
+            where.append('in xml:id %s' % self.identifier)
+        if self.tei is not None:
+            where.append('(%s)' % self.tei)
+        return '\n'.join([' '.join(where)] + self.excerpt).lstrip()
 
 
 class Transformer():
 
     """Transform resources, latexify the text produced, and make a pdf"""
 
-    def __init__(self, force, inputpaths, textwraps, workfiles):
+    def __init__(self, force, inputpaths, textwraps, workfiles,
+                 references=None, split=False, only=None, selection=None,
+                 keep_going=False, persdict=None, pdf=True,
+                 define_persons=False, preamble_format=False,
+                 separate=False, jobs=None, join=False, metrics=None,
+                 memory=None, define_witnesses=False, cache=True,
+                 python_index=False, person_db=False):
+        self.check_modes(split, only, separate, join)
+        self.selection = selection
+        self.errors = ImplementationErrors() if keep_going else None
+        self.persdict = persdict
+        self.define_persons = define_persons
+        self.define_witnesses = define_witnesses
+        self.witnesses = None
+        self.preamble_format = preamble_format
+        self.python_index = python_index
+        self.jobs = jobs
+        self.fragment_cache = workfiles[0].dirname().joinpath('fragments')
+        self.stage_cache = self.reference_cache = None
+        if cache:
+            self.stage_cache = FileCache.configured(
+                workfiles[0].dirname().joinpath('stages'), 'stages')
+            self.reference_cache = FileCache.configured(
+                workfiles[0].dirname().joinpath('references'), 'references')
+        self.references = references
+        self.has_includes = False
+        self.stages = None
+        self.metrics = metrics
+        self.memory = memory
+        self.counts = None if metrics is None else Counter()
+        self.persdict_given = persdict is not None
+        self.person_db = self.person_database = None
+        if person_db:
+            self.person_db = workfiles[0].dirname().joinpath('persons.sqlite')
+        # What is opened while making the output, closed once it is made
+        self._opened = contextlib.ExitStack()
+        self.latex = self.latexmk = self.index = None
+        before, after = textwraps
+        if preamble_format:
+            before = self.before_document(before, PreambleFormat.marker)
+        with self._opened:
+            if separate:
+                self.make_separate(force, inputpaths, before, workfiles,
+                                   pdf, only, join)
+            elif split or only:
+                self.make_split(force, inputpaths, (before, after),
+                                workfiles, pdf, only)
+            else:
+                self.make_whole(force, inputpaths, (before, after),
+                                workfiles, pdf)
+
+    @staticmethod
+    def check_modes(split=False, only=None, separate=False, join=False):
+        """Raise ValueError if the ways of making the output asked for
+        cannot be used together"""
+        if separate and split:
+            raise ValueError('--split and --separate cannot be used together')
+        if join and not separate:
+            raise ValueError('--join needs --separate')
+
+    def make_whole(self, force, inputpaths, textwraps, workfiles, pdf):
+        """Make the LaTeX, and a pdf, of the whole text at once"""
         bare_text = self.transform(*inputpaths)
-        latex = self.latexify(bare_text, *textwraps)
-        self.make_pdf(latex, force, *workfiles)
+        before = self._transformed(textwraps[0], inputpaths, workfiles)
+        self._make(bare_text, force, inputpaths, (before, textwraps[1]),
+                   workfiles, pdf)
+        self._measure([self.latex])
+
+    def make_split(self, force, inputpaths, textwraps, workfiles, pdf,
+                   only=None):
+        """Write each top-level division to its own file, and make the
+        LaTeX, and a pdf, that \\include them, or only those in only"""
+        parts = self.transform_parts(*inputpaths)
+        before = self._transformed(textwraps[0], inputpaths, workfiles)
+        names = self.write_parts(parts, workfiles[0])
+        before = self.includeonly(before, names.only(only))
+        self._make(self.includes(names), force or names.changed, inputpaths,
+                   (before, textwraps[1]), workfiles, pdf)
+        self._measure([self.latex] + [text for _, text in parts])
+
+    def make_separate(self, force, inputpaths, before, workfiles, pdf,
+                      only=None, join=False):
+        """Make a document, and a pdf, of each top-level division, or of
+        only those in only, and if join, a pdf of them all put together"""
+        parts = self.transform_parts(*inputpaths)
+        before = self._transformed(before, inputpaths, workfiles)
+        if only:
+            parts = self.only_parts(parts, only)
+        wrap = self.division_wrap(before)
+        self.documents = [(identifier, self.latexify(text, *wrap))
+                          for identifier, text in parts]
+        if pdf:
+            with self._locating(inputpaths[0]):
+                self.latexmk = self.make_pdfs(self.documents, force,
+                                              self.jobs, join, *workfiles)
+        self._measure([latex for _, latex in self.documents])
+
+    @staticmethod
+    def only_parts(parts, identifiers):
+        """The (identifier, text) pairs of parts for the given identifiers"""
+        found = [part for part in parts if part[0] in identifiers]
+        unknown = set(identifiers).difference(i for i, _ in found)
+        if unknown:
+            raise KeyError('No top-level division with xml:id %s'
+                           % ', '.join(i for i in identifiers
+                                       if i in unknown))
+        return found
+
+    def _transformed(self, before, inputpaths, workfiles):
+        """Once the text is transformed, add what it defined to before,
+        which is returned, write the errors and make the index"""
+        if self.define_persons:
+            definitions = self.persdict.definitions()
+            before = self.before_document(before, definitions)
+        if self.define_witnesses:
+            definitions = self.witnesses.definitions()
+            before = self.before_document(before, definitions)
+        if self.errors is not None:
+            self.errors.write(workfiles[0].stripext() + '.errors.json')
+        if self.python_index:
+            self.index = PersonIndex(self._sort_keys(inputpaths[1]),
+                                     workfiles[0].stripext() + '.mst')
+        return before
+
+    def _make(self, bare_text, force, inputpaths, textwraps, workfiles, pdf):
+        """Latexify bare_text and, if pdf, make the pdf"""
+        with self._measuring_memory('latexify'):
+            latex = self.latexify(bare_text, *textwraps)
+        self.latex = latex
+        if pdf:
+            if self.preamble_format:
+                latex = PreambleFormat(latex, workfiles[0])
+            with self._locating(inputpaths[0]):
+                self.latexmk = self.make_pdf(latex, force, *workfiles,
+                                             index=self.index)
 
     def transform(self, inputpath, personlistpath):
         """Transform xml to tex"""
-        body = parser.parse(inputpath).getroot().find('.//{*}body')
-        assert body is not None
-        tree = parser.transform_tree(body, PersDict(personlistpath))
-        return '\n'.join(tree.itertext()).strip()
+        return self._staged(inputpath, personlistpath, self._transform)
+
+    def transform_parts(self, inputpath, personlistpath):
+        """Transform xml to tex, giving a separate text for each
+        top-level division as a list of (identifier, text) pairs"""
+        return self._staged(inputpath, personlistpath, self._transform_parts)
+
+    def _staged(self, inputpath, personlistpath, transform):
+        """Check references, parse the body and make the persdict at
+        the same time, and then transform the body with transform.
+        The result is kept in the stage cache, and if the inputs it was
+        made from are unchanged it is taken from there instead."""
+        if self.memory is None:
+            stages = self.stages = Stages()
+        else:
+            # One at a time, so that the peak of each can be told apart
+            stages = self.stages = Stages(1, self.memory.stage)
+        key = self._stage_key(inputpath, personlistpath, transform)
+        cached = None if key is None else self.stage_cache.get(key)
+        if cached is not None:
+            stages.add('persdict', partial(self._persdict, personlistpath))
+            stages.add('transform', partial(self._restore, cached),
+                       ['persdict'])
+            return stages.run()['transform']
+        stages.add('parse', partial(self._body, inputpath))
+        stages.add('persdict', partial(self._persdict, personlistpath))
+        after = ['parse', 'persdict']
+        if self.references is not None:
+            references = self.references
+            cache = self.reference_cache
+            stages.add('check', lambda: ReferenceCheck(
+                inputpath, personlistpath, references, cache)())
+            after.append('check')
+        if self.define_witnesses:
+            stages.add('witnesses', self._witnesses, ['parse'])
+            after.append('witnesses')
+
+        def transform_body(body, persdict, *checked):
+            return transform(body, persdict, personlistpath)
+
+        stages.add('transform', transform_body, after)
+        result = stages.run()['transform']
+        # What texts with xi:includes include is not in the key:
+        # fragments have a cache of their own
+        if key is not None and not self.errors and not self.has_includes:
+            self.stage_cache.put(key, self._stored(result))
+        return result
+
+    def _stage_key(self, inputpath, personlistpath, transform):
+        """Digest of everything the transformed text depends on, or None
+        if it is not to be cached. The input is hashed as it is stored,
+        a chunk at a time."""
+        if self.stage_cache is None:
+            return None
+        references = Path(self.references or '')
+        checked = file_digest(references) if references.isfile() else ''
+        options = [transform.__name__, self.selection, self.define_persons,
+                   self.define_witnesses, self.counts is not None]
+        return digest(file_digest(inputpath), file_digest(personlistpath),
+                      checked, config_digest(), code_digest(),
+                      json.dumps(options))
+
+    def _stored(self, result):
+        """What is needed to give result again without transforming"""
+        witnesses = self.witnesses
+        return {'result': result,
+                'defined': list(getattr(self.persdict, 'defined', [])),
+                'counts': self.counts,
+                'witnesses': None if witnesses is None else
+                [list(witnesses.numbered.items()),
+                 list(witnesses.unnumbered.items())]}
+
+    def _restore(self, cached, persdict):
+        """The result stored in cached, noting the people and witnesses
+        it used as transforming would have done"""
+        for ref in cached['defined']:
+            persdict.define(ref)
+        if self.counts is not None:
+            self.counts.update(cached['counts'])
+        if cached['witnesses'] is not None:
+            self.witnesses = WitnessDefinitions()
+            numbered, unnumbered = cached['witnesses']
+            self.witnesses.numbered.update(numbered)
+            self.witnesses.unnumbered.update(unnumbered)
+        result = cached['result']
+        if isinstance(result, list):
+            return [tuple(part) for part in result]
+        return result
+
+    def _witnesses(self, body):
+        self.witnesses = WitnessDefinitions(body.getroottree())
+
+    def _transform(self, body, persdict, personlistpath):
+        if Fragments.includes(body):
+            fragments = self._fragments(personlistpath)
+            return '\n'.join(text for _, text in fragments(body))
+        tree = parser.transform_tree(body, persdict, errors=self.errors,
+                                     counts=self.counts,
+                                     witnesses=self.witnesses)
+        return self.tree_text(tree)
+
+    def _transform_parts(self, body, persdict, personlistpath):
+        if Fragments.includes(body):
+            fragments = self._fragments(personlistpath)
+            return fragments(body, divisions=True)
+        return [(identifier, self.tree_text(
+                    parser.transform_tree(chunk, persdict,
+                                          errors=self.errors,
+                                          counts=self.counts,
+                                          witnesses=self.witnesses)))
+                for identifier, chunk in Divisions(body)]
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _locating(inputpath):
+        """Find where in inputpath a LatexError raised in the body of a
+        with statement was"""
+        try:
+            yield
+        except LatexError as err:
+            err.locate(inputpath)
+            raise
+
+    def _measuring_memory(self, stage):
+        if self.memory is None:
+            return contextlib.nullcontext()
+        return self.memory.stage(stage)
+
+    def _measure(self, texts):
+        """Add what was done, and texts, the LaTeX made, to metrics"""
+        metrics = self.metrics
+        if metrics is None:
+            return
+        metrics['elements'] = sum(self.counts.values())
+        metrics['tags'] = dict(self.counts)
+        metrics['persdict_people'] = len(self.persdict)
+        metrics['persdict_cached'] = self.persdict_given
+        metrics['stages'].update(self.stages.durations())
+        metrics['latex_bytes'] = sum(len(t.encode('utf-8')) for t in texts)
+        if self.latexmk is not None:
+            seconds, passes = self.latexmk
+            metrics['latexmk_seconds'] = seconds
+            metrics['latexmk_passes'] = passes
+
+    def _persdict(self, personlistpath):
+        if self.persdict is None and self.person_db is not None:
+            self.persdict = self.person_database = \
+                self._opened.enter_context(PersonDatabase.build(
+                    personlistpath, self.person_db, self.errors))
+        elif self.persdict is None:
+            self.persdict = self._cached_persdict(personlistpath)
+        defined = isinstance(self.persdict, PersonDefinitions)
+        if self.define_persons and not defined:
+            self.persdict = PersonDefinitions(self.persdict)
+        return self.persdict
+
+    def _cached_persdict(self, personlistpath):
+        """The persdict of personlistpath, from the stage cache if it
+        has been made from the same personlist, config and code"""
+        if self.stage_cache is None:
+            return PersDict(personlistpath, self.errors)
+        key = self._persdict_key(personlistpath)
+        cached = self.stage_cache.get(key)
+        if cached is not None:
+            self.persdict_given = True
+            return PersDict.name_t_persdict(cached)
+        # The record of the last build of this personlist, whatever it
+        # held, is kept only here as it names the file in this checkout
+        record_key = digest(str(Path(personlistpath).abspath()),
+                            config_digest(), code_digest(), 'rebuild')
+        record = self.stage_cache.get(record_key, local=True)
+        people = None
+        if record is not None:
+            people = self.stage_cache.get(record['persdict'])
+        errors = len(self.errors or [])
+        persdict, record = PersDict.rebuild(
+            personlistpath, record if people is not None else None, people,
+            self.errors)
+        if len(self.errors or []) == errors:
+            self.stage_cache.put(key, persdict)
+            record['persdict'] = key
+            self.stage_cache.put(record_key, record, local=True)
+        return persdict
 
     @staticmethod
-    def latexify(bare_text, before, after):
+    def _persdict_key(personlistpath):
+        return digest(Path(personlistpath).bytes(), config_digest(),
+                      code_digest())
+
+    def _sort_keys(self, personlistpath):
+        """Index sort keys for the people of the persdict, kept in the
+        stage cache beside it. Of a person database, only those looked
+        up are given keys; the index makes those of others as it meets
+        them."""
+        if self.person_database is not None:
+            return PersonIndex.sort_keys(self.person_database.used())
+        if self.stage_cache is None:
+            return PersonIndex.sort_keys(self.persdict)
+        key = digest(self._persdict_key(personlistpath), 'sort_keys')
+        keys = self.stage_cache.get(key)
+        if keys is None:
+            keys = PersonIndex.sort_keys(self.persdict)
+            self.stage_cache.put(key, keys)
+        return keys
+
+    def _fragments(self, personlistpath):
+        return Fragments(self.persdict, personlistpath, self.fragment_cache,
+                         self.errors, self.jobs, self.counts,
+                         self.witnesses)
+
+    def _body(self, inputpath):
+        if self.selection:
+            body = DivisionRange(inputpath, *self.selection)
+        else:
+            body = parser.parse(inputpath).getroot().find('.//{*}body')
+            assert body is not None
+        # Noted before they are resolved, for the stage cache
+        self.has_includes = any(True for _ in body.iter(Fragments.include))
+        if not self.selection and not Fragments.includes(body):
+            body.getroottree().xinclude()
+        return body
+
+    @staticmethod
+    def stream(source, persdict, stream, errors=None):
+        """Transform the body of source, a path or file object, as it is
+        parsed, writing the text of each top-level element to stream as
+        soon as it is done, but for its last line, which may run on into
+        the next. Only one top-level element is held at once. The text
+        written is that of tree_text for the whole body."""
+        writer = TextWriter(stream)
+        body = None
+        for event, element in parser.iterparse(source, ('start', 'end'),
+                                               handlers=False):
+            if event == 'start':
+                if body is None and etree.QName(element).localname == 'body':
+                    body = element
+                continue
+            if body is None or element.getparent() is not body:
+                continue
+            if body.text:
+                writer.write_piece(body.text)
+                body.text = None
+            namespace = etree.QName(body).namespace
+            holder = parser.parser.makeelement('{%s}text' % namespace)
+            etree.SubElement(holder, body.tag).append(element)
+            # A copy made in holder's document gets tag handlers
+            chunk = copy.deepcopy(holder)[0]
+            writer.write(parser.transform_tree(chunk, persdict,
+                                               errors=errors))
+        writer.close()
+
+    @staticmethod
+    def tree_text(tree):
+        """The text of a transformed tree"""
+        return Transformer.raw_text(tree).strip()
+
+    @staticmethod
+    def raw_text(tree):
+        """The text of a transformed tree, with the whitespace at its
+        ends, as it runs on into the text after it"""
+        return '\n'.join(tree.itertext())
+
+    @classmethod
+    def latexify(cls, bare_text, before, after):
         """Wrap tex in preamble, intro, appendices, etc,
         and apply any replacements and substitutions"""
         text = '\n'.join([before, bare_text, after])
+        return cls.replacements(text)
+
+    @staticmethod
+    def replacements(text):
+        """Apply the string and regex replacements from config"""
         for fix in config['string_replacements']:
             text = text.replace(*fix)
         for fix in config['regex_replacements']:
             text = re.sub(*fix, text)
         return text
 
+    @classmethod
+    def write_parts(cls, parts, working_tex):
+        """Write each part to its own tex file beside working_tex,
+        leaving unchanged files alone so that latexmk can skip them"""
+        names = PartNames(working_tex.namebase)
+        for identifier, bare_text in parts:
+            path = working_tex.dirname().joinpath(names.add(identifier))
+            text = cls.replacements(bare_text)
+            if not path.exists() or path.text() != text:
+                path.write_text(text)
+                names.changed = True
+        return names
+
+    @staticmethod
+    def includes(names):
+        """Text \\including each part, in order"""
+        return '\n'.join('\\include{%s}' % n for n in names.values())
+
+    @classmethod
+    def includeonly(cls, before, names):
+        """Put an \\includeonly for names before the \\begin{document}
+        in before. All parts are typeset when names is None."""
+        if names is None:
+            return before
+        includeonly = '\\includeonly{%s}' % ','.join(names)
+        return cls.before_document(before, includeonly)
+
+    @staticmethod
+    def division_wrap(before):
+        """The text to wrap a division made a document of its own in:
+        the preamble of before, to its \\begin{document}, and the
+        separate: before and after from config. The front and back
+        matter of before and after, with their introduction and
+        appendices, are left to the whole edition."""
+        begin = '\\begin{document}'
+        if begin not in before:
+            raise ValueError('No %s to end the preamble at' % begin)
+        preamble = before[:before.index(begin) + len(begin)]
+        return ('%s\n%s' % (preamble, config['separate']['before']),
+                config['separate']['after'])
+
     @staticmethod
-    def make_pdf(latex, force, working_tex, working_pdf, out_pdf):
-        """Make a pdf"""
+    def before_document(before, text):
+        """Put text on its own lines before the \\begin{document}
+        in before"""
+        begin = '\\begin{document}'
+        if begin not in before:
+            raise ValueError('No %s to put text before' % begin)
+        return before.replace(begin, '%s\n%s' % (text, begin), 1)
+
+    @classmethod
+    def make_pdf(cls, latex, force, working_tex, working_pdf, out_pdf,
+                 index=None):
+        """Make a pdf. Returns the seconds latexmk took and the number
+        of latex passes it made, or None if it was not needed. With
+        index, a PersonIndex, the index is made by it, not makeindex.
+        With a shared cache configured, a pdf made from the same inputs
+        is copied from it instead, unless force."""
         missing = not working_pdf.exists() or not working_tex.exists()
+        made = None
         if force or missing or hash(working_tex.text()) != hash(latex):
             working_tex.write_text(latex)
-            call_cmd = config['caller_command']
-            latexmk = '{c} {w}'.format(c=call_cmd, w=working_tex).split()
-            subprocess.call(latexmk)
-        assert working_pdf.exists()
+            shared = SharedCache.configured('pdfs')
+            key = None
+            if shared is not None:
+                key = cls.pdf_key(latex, working_tex, index)
+            if key is None or force or not shared.get_file(key, working_pdf):
+                # So that a pdf left from an earlier run is not taken
+                # for one made from latex
+                working_pdf.remove_p()
+                call_cmd = config['caller_command']
+                latexmk = '{c} {w}'.format(c=call_cmd,
+                                           w=working_tex).split()
+                if index is None:
+                    made = cls.run_latexmk(latexmk)
+                else:
+                    made = cls.run_indexed(latexmk, index, working_tex)
+                if key is not None and working_pdf.exists():
+                    shared.put_file(key, working_pdf)
+        if not working_pdf.exists():
+            raise LatexError(['No pdf was made from %s' % working_tex])
         working_pdf.copy(out_pdf)
+        return made
+
+    included = re.compile(r'\\(?:include|input)\{([^}]*)\}')
+
+    @classmethod
+    def pdf_key(cls, latex, working_tex, index=None):
+        """Digest of everything the pdf of latex depends on: the text,
+        the files it includes and the bibliographies and index styles
+        beside it, the config and code, and latexmk and the engine"""
+        work_dir = working_tex.dirname()
+        paths = work_dir.files('*.bib') + work_dir.files('*.mst')
+        for name in cls.included.findall(latex):
+            path = work_dir.joinpath(name)
+            paths.append(path if path.ext else path + '.tex')
+        files = [part for path in sorted(set(paths)) if path.isfile()
+                 for part in (path.name, path.bytes())]
+        tools = [config['caller_command'].split()[0],
+                 config['preamble_format']['engine']]
+        return digest(latex, *files, config_digest(), code_digest(),
+                      *map(tool_digest, tools), str(index is not None))
+
+    @classmethod
+    def run_indexed(cls, latexmk, index, working_tex):
+        """Run latexmk with the index made by index, in place of
+        makeindex, so that latexmk decides when latex is to run again"""
+        keys = working_tex.stripext() + '.keys.json'
+        command = latexmk[:-1] + index.latexmk_options(keys) + latexmk[-1:]
+        return cls.run_latexmk(command)
+
+    latex_pass = re.compile(r"^Run number \d+ of rule '\w*latex'", re.MULTILINE)
+    # Errors after which a pass is not worth finishing
+    fatal = re.compile(r"^(! Undefined control sequence|Runaway argument\?"
+                       r"|! LaTeX Error: File `[^']*' not found"
+                       r"|! I can't find file|! Emergency stop"
+                       r"|! TeX capacity exceeded)")
+    # latex logs (name as it opens a file and ) as it closes it
+    file_paren = re.compile(r"\(([^\s()]*)|\)")
+    tex_line = re.compile(r"^l\.(\d+)")
+
+    @classmethod
+    def run_latexmk(cls, command):
+        """Run latexmk, passing its output through, and return the
+        seconds it took and the number of latex passes it made. At a
+        fatal error latexmk is killed, with the latex it is running,
+        and a LatexError raised with the output about it, and the .tex
+        file and line it was at."""
+        started = time.perf_counter()
+        # latex is not to wait at an error for input which never comes
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   universal_newlines=True, errors='replace',
+                                   start_new_session=hasattr(os, 'killpg'))
+        passes = 0
+        master = Path(command[-1])
+        opened = []
+        error = None
+        try:
+            with process.stdout:
+                for line in process.stdout:
+                    sys.stdout.write(line)
+                    if cls.latex_pass.match(line):
+                        passes += 1
+                        opened = []
+                    if error is None:
+                        cls._follow_files(line, opened, master.dirname())
+                    if error is None and cls.fatal.match(line):
+                        error = [line.rstrip('\n')]
+                        tex = cls._current_tex(opened, master)
+                    elif error is not None:
+                        error.append(line.rstrip('\n'))
+                        # The line of the .tex file, and the next, are last
+                        number = cls.tex_line.match(error[-2])
+                        if number or len(error) > 12:
+                            line = int(number.group(1)) if number else None
+                            raise LatexError(error, tex.normpath(), line)
+        except BaseException:
+            # In its own session latexmk gets no Ctrl-C of its own
+            cls._kill(process)
+            raise
+        process.wait()
+        if error is not None:
+            raise LatexError(error, tex.normpath())
+        return time.perf_counter() - started, passes
+
+    @classmethod
+    def _follow_files(cls, line, opened, directory):
+        """Follow the files latex opens and closes in line, a line of its
+        output, on the stack opened. Parentheses around anything but a
+        file push None, so that their ) closes nothing else."""
+        for match in cls.file_paren.finditer(line):
+            if match.group() == ')':
+                if opened:
+                    opened.pop()
+                continue
+            path = directory.joinpath(match.group(1))
+            opened.append(path if match.group(1) and path.isfile() else None)
+
+    @staticmethod
+    def _current_tex(opened, master):
+        """The innermost .tex file open, or master if none is"""
+        for path in reversed(opened):
+            if path is not None and path.ext == '.tex':
+                return path
+        return master
+
+    @staticmethod
+    def _kill(process):
+        """Kill process and what it started"""
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+    def make_pdfs(self, documents, force, jobs, join,
+                  working_tex, working_pdf, out_pdf):
+        """Make a pdf of each of documents, a list of (identifier, latex)
+        pairs, running at most jobs latexmks at once, and if join put
+        their pages together into out_pdf. Returns the total seconds
+        taken by the latexmks run and the passes they made, or None if
+        none ran."""
+        names = PartNames(working_tex.namebase + '-standalone')
+        jobs_made = []
+        for identifier, latex in documents:
+            tex = working_tex.dirname().joinpath(names.add(identifier))
+            pdf = out_pdf.stripext() + '-%s.pdf' % identifier
+            jobs_made.append((latex, tex, tex.stripext() + '.pdf', pdf))
+        with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+            futures = []
+            for latex, tex, pdf, out in jobs_made:
+                if self.preamble_format:
+                    # Named for working_tex, so all share one format
+                    latex = PreambleFormat(latex, working_tex)
+                futures.append(pool.submit(carry_config(self.make_pdf),
+                               latex, force, tex, pdf, out,
+                               index=self.index))
+            made = [future.result() for future in futures]
+        if join:
+            latex = self.joined([pdf for _, _, pdf, _ in jobs_made])
+            made.append(self.make_pdf(latex, force, working_tex,
+                                      working_pdf, out_pdf))
+        made = [m for m in made if m is not None]
+        if made:
+            return tuple(map(sum, zip(*made)))
+        return None
+
+    @staticmethod
+    def joined(pdfs):
+        """LaTeX putting together the pages of pdfs, made beside it,
+        with separate: join from config. Each is followed by a digest
+        of it, so that the LaTeX changes whenever one of them does."""
+        pages = '\n'.join('\\includepdf[pages=-]{%s} %% %s'
+                          % (pdf.basename(), file_digest(pdf))
+                          for pdf in pdfs)
+        return config['separate']['join'] % {'pages': pages}
+
+class PreambleFormat():
+
+    """Set up latex to load its preamble from a format file, so that the
+       packages it loads are not read again at every pass. The format is
+       kept in the work directory, named by the digest of the preamble,
+       the engine and what the engine gives for --version, and only made
+       again when one of them changes. Everything in the preamble before
+       the marker goes into the format. If the format cannot be made
+       latex is returned as it would be without one, and it is not tried
+       again for the same digest."""
+
+    marker = '\\endofdump'
+
+    def __new__(cls, latex, working_tex):
+        preamble, marker, _ = latex.partition(cls.marker)
+        if not marker:
+            return latex
+        without = latex.replace(cls.marker + '\n', '', 1)
+        engine = config['preamble_format']['engine']
+        version = tool_version(engine)
+        if version is None:
+            print('Could not run %s to make a format of the preamble;'
+                  ' compiling without one' % engine, file=sys.stderr)
+            return without
+        key = digest(engine, version, preamble)[:12]
+        name = '%s-preamble-%s' % (working_tex.namebase, key)
+        work_dir = working_tex.dirname()
+        failed = work_dir.joinpath(name + '.failed')
+        if failed.exists():
+            print('A format of the preamble could not be made (see %s.log);'
+                  ' compiling without one' % work_dir.joinpath(name),
+                  file=sys.stderr)
+            return without
+        if not work_dir.joinpath(name + '.fmt').exists():
+            cls._remove_stale(work_dir, working_tex.namebase)
+            if not cls._dump(preamble, name, work_dir):
+                print('Could not make a format of the preamble (see %s.log);'
+                      ' compiling without one until it changes'
+                      % work_dir.joinpath(name), file=sys.stderr)
+                failed.touch()
+                return without
+        return '%%&%s\n%s' % (name, latex)
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def _dump(cls, preamble, name, work_dir):
+        """Make name.fmt from preamble with mylatexformat"""
+        work_dir.joinpath(name + '.tex').write_text(
+            '%s%s\n\\begin{document}\n\\end{document}\n'
+            % (preamble, cls.marker))
+        engine = config['preamble_format']['engine']
+        command = [engine, '-ini', '-interaction=batchmode',
+                   '-jobname=' + name, '&' + engine,
+                   'mylatexformat.ltx', name + '.tex']
+        try:
+            returncode = subprocess.call(command, cwd=work_dir)
+        except FileNotFoundError:
+            return False
+        return returncode == 0 and work_dir.joinpath(name + '.fmt').exists()
+
+    @staticmethod
+    def _remove_stale(work_dir, basename):
+        for path in work_dir.files('%s-preamble-*' % basename):
+            path.remove()
+
+
+class Divisions():
+
+    """Split a body into one body per top-level division, so that
+       each can be transformed on its own; returns a list of
+       (identifier, body) pairs. Anything found between divisions
+       goes with the division before it. Divisions without an xml:id
+       are numbered from after start."""
+
+    def __new__(cls, body, start=0):
+        holder = body.makeelement(body.getparent().tag)
+        chunks = []
+        for child in list(body):
+            if child.localname == 'div' or not chunks:
+                chunk = etree.SubElement(holder, body.tag)
+                identifier = cls._identifier(child, start + len(chunks) + 1)
+                chunks.append((identifier, chunk))
+            chunks[-1][1].append(child)
+        if chunks and body.text:
+            chunks[0][1].text = body.text
+        return chunks
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def _identifier(div, number):
+        xml_id = div.get('{%s}id' % config['xml_namespace'])
+        return xml_id or 'part%d' % number
+
+
+class DivisionRange():
+
+    """Parse only as much of inputpath as is needed to find the divisions
+       from the one with xml:id first to the one with xml:id last, and
+       return a body containing just those, in copies of the divisions
+       they were in. Nothing is given proxies while parsing, divisions
+       before first are dropped as they end, and parsing stops at the
+       end of last; only the body returned has proxies. Either end may
+       be None to start from the beginning or go on to the end of the
+       text."""
+
+    def __new__(cls, inputpath, first=None, last=None):
+        selected = cls._select(inputpath, first, last)
+        if not selected:
+            raise KeyError('No divisions from xml:id %s to %s'
+                           % (first, last))
+        return cls._body(selected)
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def _select(cls, inputpath, first, last):
+        """The outermost divisions starting no earlier than first
+           and ending no later than last, in document order"""
+        xml_id = '{%s}id' % config['xml_namespace']
+        started = first is None
+        opened = []
+        selected = []
+        events = parser.iterparse(inputpath, ('start', 'end'), '{*}div',
+                                  handlers=False)
+        for event, div in events:
+            if event == 'start':
+                started = started or div.get(xml_id) == first
+                opened.append(started)
+                continue
+            if opened.pop():
+                while selected and cls._contains(div, selected[-1]):
+                    selected.pop()
+                selected.append(div)
+            elif not started:
+                div.clear()
+                while div.getprevious() is not None:
+                    del div.getparent()[0]
+            if last is not None and div.get(xml_id) == last:
+                return selected
+        if last is not None:
+            raise KeyError('No div with xml:id %s' % last)
+        return selected
+
+    @staticmethod
+    def _contains(div, other):
+        # Not `in`: tags compare equal by their number of descendants
+        return any(a is div for a in other.iterancestors('{*}div'))
+
+    @staticmethod
+    def _body(selected):
+        """Put selected into a new body, with tag handlers, recreating
+           the divisions that contained them without their contents"""
+        namespace = etree.QName(selected[0]).namespace
+        holder = parser.parser.makeelement('{%s}text' % namespace)
+        body = etree.SubElement(holder, '{%s}body' % namespace)
+        chain = []
+        for div in selected:
+            ancestors = list(div.iterancestors('{*}div'))[::-1]
+            shared = 0
+            for (original, _), ancestor in zip(chain, ancestors):
+                if original is not ancestor:
+                    break
+                shared += 1
+            del chain[shared:]
+            for ancestor in ancestors[shared:]:
+                parent = chain[-1][1] if chain else body
+                shell = etree.SubElement(parent, ancestor.tag,
+                                         dict(ancestor.attrib))
+                chain.append((ancestor, shell))
+            (chain[-1][1] if chain else body).append(div)
+        # A copy made in holder's document gets tag handlers
+        return copy.deepcopy(holder)[0]
+
+
+class Fragments():
+
+    """Transform a body whose top-level xi:includes each bring in a
+       fragment, such as a year or a letter, kept in a file of its own.
+       Fragments are parsed and transformed in parallel threads, each on
+       its own, and their text is cached by the digest of their content,
+       the personlist, config and code, so that only fragments which
+       have changed are done again. Any other xi:includes are resolved
+       in place. Fragments which record errors are not cached. If counts
+       (a Counter) is given, the tags in the text are counted in it.
+       With witnesses, readings name witnesses by its aliases."""
+
+    include = '{http://www.w3.org/2001/XInclude}include'
+
+    def __init__(self, persdict, personlistpath, cache_dir, errors=None,
+                 jobs=None, counts=None, witnesses=None):
+        self.persdict = persdict
+        self.errors = errors
+        self.jobs = jobs
+        self.counts = counts
+        self.witnesses = witnesses
+        self.cache = FileCache.configured(cache_dir, 'fragments')
+        numbered = None if witnesses is None else witnesses.numbered
+        self.context = digest(Path(personlistpath).bytes(), config_digest(),
+                              code_digest(), type(persdict).__name__,
+                              json.dumps(numbered))
+
+    @classmethod
+    def includes(cls, body):
+        """The xi:includes of body which bring in fragments"""
+        return [child for child in body.iterchildren(cls.include)
+                if child.get('parse', 'xml') == 'xml'
+                and child.get('xpointer') is None]
+
+    def __call__(self, body, divisions=False):
+        """(identifier, text) for each fragment and each run of other
+           content between them, or if divisions each top-level
+           division in it, in order"""
+        segments = self._segments(body)
+        with ThreadPoolExecutor(self.jobs or os.cpu_count()) as pool:
+            futures = [pool.submit(carry_config(self._fragment), segment)
+                       if isinstance(segment, Path) else None
+                       for segment in segments]
+            parts = []
+            for segment, future in zip(segments, futures):
+                if future is not None:
+                    fragment = future.result()
+                    for ref in fragment['defined']:
+                        self.persdict.define(ref)
+                    if self.counts is not None:
+                        self.counts.update(fragment['counts'])
+                    for siglum in fragment.get('witnesses', []):
+                        self.witnesses.alias(siglum)
+                    parts.append((fragment['identifier'], fragment['text']))
+                elif divisions:
+                    chunks = Divisions(segment, start=len(parts))
+                    parts.extend((identifier, self._text(chunk))
+                                 for identifier, chunk in chunks)
+                else:
+                    parts.append((None, self._text(segment)))
+        return parts
+
+    def _segments(self, body):
+        """The path of each fragment, and a body for each run of
+           other content, in order"""
+        included = self.includes(body)
+        holder = body.makeelement(body.getparent().tag)
+        segments = []
+        text = body.text
+        for child in list(body):
+            if any(child is include for include in included):
+                base = Path(child.base or '').dirname()
+                segments.append(base.joinpath(child.get('href')).abspath())
+                text = child.tail
+                body.remove(child)
+                continue
+            if not segments or isinstance(segments[-1], Path):
+                segments.append(etree.SubElement(holder, body.tag))
+                segments[-1].text = text
+            segments[-1].append(child)
+        if any(True for _ in holder.iter(self.include)):
+            etree.ElementTree(holder).xinclude()
+        return segments
+
+    def _text(self, body):
+        return Transformer.tree_text(parser.transform_tree(
+            body, self.persdict, errors=self.errors, counts=self.counts,
+            witnesses=self.witnesses))
+
+    @classmethod
+    def _contents(cls, path, seen=()):
+        """The bytes of path and of every file it includes, in order,
+           so that a change to any of them changes the key of the
+           fragment. A file that cannot be read gives b''."""
+        try:
+            data = path.bytes()
+        except OSError:
+            return [b'']
+        contents = [data]
+        namespace = etree.QName(cls.include).namespace.encode()
+        if namespace not in data or path in seen:
+            return contents
+        base = path.dirname()
+        for _, include in parser.iterparse(path, tag=cls.include,
+                                           handlers=False):
+            href = include.get('href')
+            if href:
+                contents.extend(cls._contents(
+                    base.joinpath(href).abspath(), seen + (path,)))
+        return contents
+
+    def _fragment(self, path):
+        """The identifier, text, refs defined and tag counts
+           of the fragment at path"""
+        key = digest(*self._contents(path), self.context)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        root = parser.parse(path, xinclude=True).getroot()
+        body = root.find('.//{*}body')
+        if body is None:
+            namespace = etree.QName(root).namespace
+            holder = root.makeelement('{%s}text' % namespace)
+            body = etree.SubElement(holder, '{%s}body' % namespace)
+            body.append(root)
+        persdict = self.persdict
+        if isinstance(persdict, PersonDefinitions):
+            persdict = PersonDefinitions(persdict.persdict)
+        errors = None if self.errors is None else ImplementationErrors()
+        counts = Counter()
+        # Witnesses first met here are merged in segment order by
+        # __call__, not added from this thread as they are met
+        witnesses = None
+        if self.witnesses is not None:
+            witnesses = self.witnesses.local()
+        text = Transformer.tree_text(parser.transform_tree(
+            body, persdict, errors=errors, counts=counts,
+            witnesses=witnesses))
+        identifier = (root.get('{%s}id' % config['xml_namespace'])
+                      or path.namebase)
+        fragment = {'identifier': identifier, 'text': text,
+                    'defined': list(getattr(persdict, 'defined', [])),
+                    'counts': counts,
+                    'witnesses': list(getattr(witnesses, 'unnumbered', []))}
+        if errors:
+            self.errors.extend(errors)
+        else:
+            self.cache.put(key, fragment)
+        return fragment
+
+
+class PartNames(OrderedDict):
+
+    """Filenames, without extension, of the parts of a split text,
+       keyed by the identifier of their division"""
+
+    def __init__(self, basename):
+        super().__init__()
+        self.basename = basename
+        self.changed = False
+
+    def add(self, identifier):
+        """Add a part and return its filename"""
+        self[identifier] = '%s-%s' % (self.basename, identifier)
+        return self[identifier] + '.tex'
+
+    def only(self, identifiers):
+        """Names for the given identifiers, or None if there are none"""
+        if not identifiers:
+            return None
+        unknown = [i for i in identifiers if i not in self]
+        if unknown:
+            raise KeyError('No top-level division with xml:id %s'
+                           % ', '.join(unknown))
+        return [self[i] for i in identifiers]
+
+
+class TextWriter():
+
+    """Write the text of transformed trees to a stream a piece at a time,
+       as tree_text would give it for one tree holding all of them, with
+       the replacements from config applied. Text is held back from the
+       last line break followed by text, so the output is the same as
+       for the whole text as long as no replacement matches across such
+       a line break, as none of the default ones do."""
+
+    line = re.compile(r'\n(?=\S)')
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.started = False
+        self.held = ''
+
+    def write(self, tree):
+        """Write the text of tree"""
+        self.write_piece(Transformer.raw_text(tree))
+        self.stream.flush()
+
+    def write_piece(self, piece):
+        """Write piece, which runs on from the text before it"""
+        self.held += piece
+        if not self.started:
+            self.held = self.held.lstrip()
+            self.started = bool(self.held)
+        ends = [match.start() for match in self.line.finditer(self.held)]
+        if ends:
+            self.stream.write(Transformer.replacements(
+                self.held[:ends[-1] + 1]))
+            self.held = self.held[ends[-1] + 1:]
+
+    def close(self):
+        if self.started:
+            self.stream.write(Transformer.replacements(self.held.rstrip())
+                              + '\n')
+        self.stream.flush()
+
 
 class Resources():
 
@@ -60,7 +1139,7 @@ class Resources():
         returns a namedtuple containing inputpaths for transformation,
         text for wrapping the transformed inputpaths in to make a tex file,
         and paths for writing temporary versions of tex and pdf, as well as the
-        final output pdf"""
+        final output pdf, and the bibliography to check references against"""
 
     def __new__(cls, inputpath, outname=None, standalone=False):
         r = cls._Resources(inputpath, outname, standalone)
@@ -77,11 +1156,11 @@ class Resources():
             self._processed_resources = self._process_resources()
 
         def _resources_by_classification_key(self, key):
-            return iter(self.processed_resources[key])
+            return iter(self._processed_resources[key])
 
         def parsepaths(self):
-            parsepath_resources = self._resources_by_classification_key('parsepaths')
-            return tuple(self.basepaths.inputpath, *parsepath_resources)
+            parsepath_resources = self._resources_by_classification_key('parsepath')
+            return (self.basepaths.inputpath, *parsepath_resources)
 
         def texts(self):
             before = self._resources_by_classification_key('before_text')
@@ -89,15 +1168,21 @@ class Resources():
             return map('\n'.join, [before, after])
 
         def workpaths(self):
-            return tuple(*self.basepaths.working_paths())
+            return tuple(self.basepaths.working_paths())
+
+        def references(self):
+            name = config['resources']['references']['name']
+            return self.basepaths.work_dir.joinpath(name)
 
         def freeze(self):
-            nt = namedtuple('Paths', ['inputpaths', 'textwraps', 'workfiles'])
-            return nt(self.parsepaths(), self.texts(), self.workpaths())
+            nt = namedtuple('Paths', ['inputpaths', 'textwraps',
+                                      'workfiles', 'references'])
+            return nt(self.parsepaths(), self.texts(), self.workpaths(),
+                      self.references())
 
         def _process_resources(self):
 
-            def _rp_args(self):
+            def _rp_args():
                 bp = self.basepaths
                 return bp.work_dir, bp.resource_dir, bp.basename
 
@@ -112,10 +1197,18 @@ class Resources():
                 self.work_dir = work_dir
                 self.resource_dir = resource_dir
                 self.standalone = standalone
+                self.basename = basename
                 self.resources = config['resources']
 
             def __call__(self, resource_name):
                 resource = self.resources[resource_name]
+                if resource.get('output') == 'path':
+                    compressed = self._compressed(resource)
+                    if compressed is not None:
+                        # Kept compressed, and decompressed as it is parsed
+                        target = self.work_dir.joinpath(compressed.name)
+                        self._replace(target, compressed.bytes())
+                        return target
                 name, text = self._read_resource(resource)
                 if resource.get('output') == 'read':
                     return text
@@ -125,13 +1218,19 @@ class Resources():
                 yield resource.get('name') or self.basename + resource['ext']
                 yield from map(resource.get, ['required', 'subst'])
 
+            def _compressed(self, resource):
+                name = next(self._resource_values(resource))
+                path = compression.find(self.resource_dir.joinpath(name))
+                return path if compression.opener(path) else None
+
             def _read_resource(self, resource):
                 name, required, subst = self._resource_values(resource)
                 try:
-                    text = self.resource_dir.joinpath(name).text()
+                    path = compression.find(self.resource_dir.joinpath(name))
+                    text = compression.read_text(path)
                 except FileNotFoundError as err:
                     no_sub = subst in [None, False]
-                    if self.required or no_sub:
+                    if required or no_sub:
                         raise err
                     text = self._substitute_resource(resource, subst)
                 return name, text
@@ -150,15 +1249,28 @@ class Resources():
 
             def _write_resource(self, name, text):
                 path = self.work_dir.joinpath(name)
-                path.write_text(text)
+                self._replace(path, text.encode('utf-8'))
                 return path
 
+            @staticmethod
+            def _replace(path, data):
+                """Write data to path, unless it already holds it, whole
+                   and renamed into place, so that another process
+                   reading it meanwhile never sees it half-written"""
+                if path.isfile() and path.bytes() == data:
+                    return
+                fd, temp = tempfile.mkstemp(dir=path.dirname(), suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(temp, path)
+
         class BasePathMaker():
 
             def __init__(self, inputpath, outname):
                 self.inputpath = Path(inputpath)
                 self.curdir = self._curdir()
-                self.basename = inputpath.namebase
+                self.basename = compression.uncompressed(
+                    self.inputpath).namebase
                 self.outname = outname or self.basename + '.pdf'
                 # properties
                 self._work_dir = None
@@ -193,13 +1305,101 @@ class Resources():
 
             def working_paths(self):
                 yield from map(self.extendbasename, ['.tex', '.pdf'])
-                yield outname
+                yield self.curdirjoin(self.outname)
+
+class PersonDefinitions(Mapping):
+
+    """A persdict which collects the people mentioned in the body,
+       so that each can be defined once, by \\defperson, rather
+       than described in full at every mention"""
+
+    def __init__(self, persdict):
+        self.persdict = persdict
+        self.defined = OrderedDict()
+
+    def __getitem__(self, ref):
+        return self.persdict[ref]
+
+    def __iter__(self):
+        return iter(self.persdict)
+
+    def __len__(self):
+        return len(self.persdict)
+
+    def define(self, ref):
+        """Note that ref needs defining"""
+        self.defined[ref] = self.persdict[ref]
+
+    def definitions(self):
+        """Text defining each person noted, in order of first mention"""
+        return '\n'.join('\\defperson{%s}{%s}{%s}'
+                         % (ref, person.indexname, person.description)
+                         for ref, person in self.defined.items())
+
+
+class WitnessDefinitions():
+
+    """Short aliases for the witnesses of an apparatus, so that each is
+       defined once, by \\defwitness, and readings name witnesses by
+       alias rather than by @wit. Witnesses in a listWit in tree, and
+       then any others named by its readings, are numbered in order. A
+       witness first met after that is its own alias: its xml:id, which
+       cannot be taken for a number."""
+
+    namespaces = {'tei': 'http://www.tei-c.org/ns/1.0'}
+    # Strings, not smart strings, so that no tags are given proxies
+    listed = etree.XPath('//tei:listWit//tei:witness/@xml:id',
+                         namespaces=namespaces, smart_strings=False)
+    named = etree.XPath('//tei:rdg/@wit', namespaces=namespaces,
+                        smart_strings=False)
+
+    def __init__(self, tree=None):
+        self.numbered = OrderedDict()
+        self.unnumbered = OrderedDict()
+        if tree is not None:
+            for siglum in self.listed(tree) + self.sigla(tree):
+                self.numbered.setdefault(siglum, str(len(self.numbered) + 1))
+
+    @classmethod
+    def sigla(cls, tree):
+        """Sigla named by the readings in tree, in order"""
+        return [cls._siglum(token) for wit in cls.named(tree)
+                for token in wit.split()]
+
+    @staticmethod
+    def _siglum(token):
+        return token.rpartition('#')[2]
+
+    def local(self):
+        """Definitions sharing the numbered witnesses of these, but
+           with unnumbered ones of their own"""
+        local = WitnessDefinitions()
+        local.numbered = self.numbered
+        return local
+
+    def alias(self, siglum):
+        """The alias of siglum"""
+        alias = self.numbered.get(siglum)
+        if alias is None:
+            self.unnumbered[siglum] = alias = siglum
+        return alias
+
+    def aliases(self, wit):
+        """The aliases of the witnesses in wit, a @wit, comma-separated"""
+        return ','.join(self.alias(self._siglum(t)) for t in wit.split())
+
+    def definitions(self):
+        """Text defining each alias numbered, and each other used"""
+        aliases = list(self.numbered.items()) + list(self.unnumbered.items())
+        return '\n'.join('\\defwitness{%s}{%s}' % (alias, siglum)
+                         for siglum, alias in aliases)
+
 
 class PersDict():
 
-    def __new__(cls, path):
+    def __new__(cls, path, errors=None):
         d = cls.people(path)
-        persdict = {x: p(d) for x, p in d.items()}
+        persdict = {x: p(d, errors) for x, p in d.items()}
         return cls.name_t_persdict(persdict)
 
     def __init__(self):
@@ -212,6 +1412,46 @@ class PersDict():
         return {p.xml_id: p for p in map(cls.Person, people)}
 
 
+    mentioned = etree.XPath('.//tei:trait//tei:persName/@ref',
+                            namespaces={'tei': 'http://www.tei-c.org/ns/1.0'},
+                            smart_strings=False)
+
+    @classmethod
+    def rebuild(cls, path, previous=None, people=None, errors=None):
+        """The persdict of path, and a record of it for the next rebuild:
+        a digest of each person's element, and whom their traits mention.
+        With previous, the record of an earlier build, and people, the
+        persdict it made, only people whose elements have changed, and
+        people whose traits mention them, are made again; the rest are
+        taken from people."""
+        if previous is None or people is None:
+            previous, people = {'hashes': {}, 'mentions': {}}, {}
+        personlist = parser.parse(path).getroot()
+        tags = OrderedDict()
+        hashes = {}
+        mentions = {}
+        for tag in personlist.iter('{*}person'):
+            xml_id = cls.Person._xml_id(tag)
+            tags[xml_id] = tag
+            hashes[xml_id] = hashlib.sha1(
+                etree.tostring(tag, with_tail=False)).hexdigest()
+            mentions[xml_id] = sorted({ref[1:] for ref in cls.mentioned(tag)})
+        changed = {x for x in set(hashes) | set(previous['hashes'])
+                   if hashes.get(x) != previous['hashes'].get(x)}
+        redo = {x for x in tags if x in changed or x not in people
+                or changed.intersection(mentions[x])}
+        kept = cls.name_t_persdict({x: people[x] for x in tags
+                                    if x not in redo})
+        remade = {x: cls.Person(tags[x]) for x in redo}
+        # Traits need only the index names of those they mention
+        d = dict(kept)
+        d.update(remade)
+        made = {x: remade[x](d, errors) for x in tags if x in remade}
+        persdict = cls.name_t_persdict(OrderedDict(
+            (x, made[x] if x in made else kept[x]) for x in tags))
+        record = {'hashes': hashes, 'mentions': mentions}
+        return persdict, record
+
     @staticmethod
     def name_t_persdict(d):
         p_tuple = namedtuple('Person',
@@ -229,11 +1469,12 @@ class PersDict():
             i_and_d = self._indexname_and_description(tag)
             self.indexname, self.description = i_and_d
 
-        def __call__(self, persdict):
+        def __call__(self, persdict, errors=None):
             """Update description by parsing using persdict."""
             description, trait = self.description
             if trait is not None:
-                parser.transform_tree(trait, persdict, in_body=False)
+                parser.transform_tree(trait, persdict, in_body=False,
+                                      errors=errors)
             trait = self._stripstring(trait)
             self.description = description(trait)
             return (self.xml_id, self.indexname,
@@ -294,13 +1535,34 @@ class PersDict():
                 return ''
 
 
+def tex_only(inputname, keep_going=False, stream=None):
+    """Write the LaTeX body of inputname, or of stdin if it is '-', to
+    stream or stdout as it is made, with the personlist and config of
+    the project it is in (for stdin, the current directory). Nothing
+    is written to a work directory and latexmk is not run. Returns a
+    summary of the errors recorded, if keep_going, or None."""
+    if inputname == '-':
+        source, curdir = sys.stdin.buffer, Path(os.curdir)
+    else:
+        source = Path(inputname)
+        curdir = Path(source.dirname() or os.curdir)
+    update_config(curdir)
+    personlist = config['resources']['personlist']['name']
+    errors = ImplementationErrors() if keep_going else None
+    personlistpath = compression.find(curdir.joinpath('resources', personlist))
+    persdict = PersDict(personlistpath, errors)
+    Transformer.stream(source, persdict, stream or sys.stdout, errors)
+    return errors.summary() if errors else None
+
+
 def main():
     """Parse arguments and transform."""
     import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument("inputname",
-                        help="TEI file to transform")
+                        help="TEI file to transform; - for stdin "
+                             "with --tex-only")
     parser.add_argument("-o", "--outputname",
                         help="Filename of the transformed file.",
                         default=None)
@@ -310,9 +1572,145 @@ def main():
     parser.add_argument('-s', '--standalone',
                         help="Do not include introduction or appendices",
                         action="store_true")
+    parser.add_argument('--split',
+                        help="Write each top-level division to its own "
+                             "file and \\include it",
+                        action="store_true")
+    parser.add_argument('--only',
+                        help="Comma-separated xml:ids of the top-level "
+                             "divisions to typeset; implies --split "
+                             "unless --separate is given",
+                        type=lambda s: s.split(','),
+                        default=None)
+    parser.add_argument('--separate',
+                        help="Make a separate pdf of each top-level "
+                             "division, in parallel",
+                        action="store_true")
+    parser.add_argument('-j', '--jobs',
+                        help="Number of latexmks to run at once with "
+                             "--separate; defaults to the number of CPUs",
+                        type=int,
+                        default=None)
+    parser.add_argument('--join',
+                        help="With --separate, also put the pages of the "
+                             "divisions together into one pdf",
+                        action="store_true")
+    parser.add_argument('--from',
+                        help="xml:id of the division to start from",
+                        dest="first",
+                        default=None)
+    parser.add_argument('--to',
+                        help="xml:id of the division to end with",
+                        dest="last",
+                        default=None)
+    parser.add_argument('--no-check',
+                        help="Do not check references before transforming",
+                        action="store_true")
+    parser.add_argument('--no-cache',
+                        help="Parse and transform again even if the text, "
+                             "personlist and config are unchanged",
+                        action="store_true")
+    parser.add_argument('--person-db',
+                        help="Look up people in an SQLite index of the "
+                             "personlist, made once, instead of loading "
+                             "them all",
+                        action="store_true")
+    parser.add_argument('--cache-stats',
+                        help="Report the hits and misses of the shared "
+                             "cache on stderr",
+                        action="store_true")
+    parser.add_argument('--define-persons',
+                        help="Define each person once with \\defperson "
+                             "and mention them with \\person{ref}{text}",
+                        action="store_true")
+    parser.add_argument('--define-witnesses',
+                        help="Define a short alias for each witness with "
+                             "\\defwitness, and give readings as "
+                             "\\cwit{text}{aliases}",
+                        action="store_true")
+    parser.add_argument('--python-index',
+                        help="Sort the index in Python instead of running "
+                             "makeindex",
+                        action="store_true")
+    parser.add_argument('--preamble-format',
+                        help="Load the preamble from a precompiled format, "
+                             "made again only when the preamble changes",
+                        action="store_true")
+    parser.add_argument('-k', '--keep-going',
+                        help="Report every unimplemented tag, leaving a "
+                             "placeholder for each, instead of stopping "
+                             "at the first",
+                        action="store_true")
+    parser.add_argument('--timings',
+                        help="Report how long each stage took, and the "
+                             "critical path, on stderr",
+                        action="store_true")
+    parser.add_argument('--metrics',
+                        help="Write metrics of the run to this file",
+                        default=None)
+    parser.add_argument('--metrics-format',
+                        help="jsonl (the default) appends a line of JSON "
+                             "for each run; openmetrics replaces the file",
+                        choices=RunMetrics.formats,
+                        default='jsonl')
+    parser.add_argument('--memory-report',
+                        help="Report the peak memory of each stage, and "
+                             "what took most, on stderr; stages then run "
+                             "one at a time",
+                        action="store_true")
+    parser.add_argument('--tex-only',
+                        help="Write the LaTeX body to stdout as it is made, "
+                             "without a work directory or latexmk",
+                        action="store_true")
     args = parser.parse_args(sys.argv[1:])
-    resources = Resources(args.inputname, args.outputname, args.standalone)
-    Transformer(args.force, *resources)
+    try:
+        Transformer.check_modes(args.split, args.only, args.separate,
+                                args.join)
+    except ValueError as err:
+        parser.error(str(err))
+    if args.tex_only and (args.split or args.only or args.separate):
+        parser.error('--tex-only writes the whole text, and cannot be used '
+                     'with --split, --only or --separate')
+    if args.tex_only:
+        sys.exit(tex_only(args.inputname, args.keep_going))
+    selection = None
+    if args.first or args.last:
+        selection = args.first, args.last
+    metrics = RunMetrics(args.inputname)
+    memory = MemoryReport().start() if args.memory_report else None
+    with metrics.stage('resources'), \
+            memory.stage('resources') if memory else contextlib.nullcontext():
+        resources = Resources(args.inputname, args.outputname,
+                              args.standalone)
+    if args.no_check:
+        resources = resources._replace(references=None)
+    try:
+        transformer = Transformer(args.force, *resources, split=args.split,
+                                  only=args.only, selection=selection,
+                                  keep_going=args.keep_going,
+                                  define_persons=args.define_persons,
+                                  define_witnesses=args.define_witnesses,
+                                  preamble_format=args.preamble_format,
+                                  separate=args.separate, jobs=args.jobs,
+                                  join=args.join,
+                                  metrics=metrics if args.metrics else None,
+                                  memory=memory, cache=not args.no_cache,
+                                  python_index=args.python_index,
+                                  person_db=args.person_db)
+    except LatexError as err:
+        sys.exit('LaTeX failed: %s' % err)
+    if memory:
+        memory.stop()
+        print(memory.report(), file=sys.stderr)
+    if args.metrics:
+        metrics.finish().write(args.metrics, args.metrics_format)
+    if args.timings:
+        print(transformer.stages.report(), file=sys.stderr)
+    shared = SharedCache.configured('pdfs')
+    if args.cache_stats and shared is not None:
+        print(shared.report(), file=sys.stderr)
+    if transformer.errors:
+        sys.exit(transformer.errors.summary())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+import io
+import shutil
+import tempfile
+import threading
+import unittest
+
+from path import Path
+
+from tei_transformer.api import transform
+from tei_transformer.config import config, update_config
+
+from xml_maker import xmlns
+
+
+class TestTransform(unittest.TestCase):
+
+    text = ('<TEI %s><text><body><p>'
+            '<foreign xml:lang="la">ita</foreign> '
+            '<persName ref="#jb">Joe</persName>'
+            '</p></body></text></TEI>' % xmlns).encode('utf-8')
+
+    personlist = ('<listPerson %s><person xml:id="jb"><persName>'
+                  '<forename>Joe</forename><surname>Bloggs</surname>'
+                  '</persName></person></listPerson>' % xmlns)
+
+    def make_project(self, language):
+        project = Path(tempfile.mkdtemp())
+        resources = project.joinpath('resources')
+        resources.mkdir()
+        resources.joinpath('personlist.xml').write_text(self.personlist)
+        resources.joinpath('references.bib').write_text('')
+        resources.joinpath('latex_preamble.tex').write_text('')
+        resources.joinpath('config.yaml').write_text(
+            'languages:\n  la: %s\n' % language)
+        self.addCleanup(shutil.rmtree, project)
+        return project
+
+    def test_threads_keep_their_projects_apart(self):
+        projects = {language: self.make_project(language)
+                    for language in ['latin', 'roman']}
+        results = []
+
+        def run(language):
+            for _ in range(20):
+                text = transform(io.BytesIO(self.text), projects[language])
+                results.append(('\\text%s{ita}' % language) in text)
+
+        threads = [threading.Thread(target=run, args=(language,))
+                   for language in projects for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 80)
+        self.assertTrue(all(results))
+
+    def test_update_config_is_per_thread(self):
+        project = self.make_project('roman')
+        before = config['languages']['la']
+        thread = threading.Thread(target=update_config, args=(project,))
+        thread.start()
+        thread.join()
+        self.assertEqual(config['languages']['la'], before)
@@ -0,0 +1,42 @@
+import shutil
+import tempfile
+import unittest
+
+from path import Path
+
+from tei_transformer.batch import Durations, order
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.paths = []
+        for name, size in [('small', 10), ('large', 1000), ('new', 400)]:
+            path = self.work_dir.joinpath(name + '.xml')
+            path.write_text('x' * size)
+            self.paths.append(path)
+
+    def test_record(self):
+        durations = Durations.of(self.paths)
+        self.assertIs(durations[self.paths[0]], durations[self.paths[1]])
+        durations[self.paths[0]].record(self.paths[0], {'transform': 1.0,
+                                                        'latexmk': 4.0})
+        durations[self.paths[0]].record(self.paths[0], {'transform': 2.0,
+                                                        'latexmk': None})
+        again = Durations.of(self.paths)[self.paths[0]]
+        self.assertEqual(again.expected(self.paths[0]), 6.0)
+        self.assertIsNone(again.expected(self.paths[2]))
+
+    def test_longest_first(self):
+        small, large, new = self.paths
+        self.assertEqual(order(self.paths, Durations.of(self.paths)),
+                         [(large, None), (new, None), (small, None)])
+        durations = Durations.of(self.paths)
+        # Small inputs can take longest, with many people or LaTeX passes
+        durations[small].record(small, {'transform': 50.0})
+        durations[large].record(large, {'transform': 10.0})
+        ranked = order(self.paths, durations)
+        self.assertEqual([path for path, _ in ranked], [new, small, large])
+        self.assertEqual(dict(ranked)[small], 50.0)
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from path import Path
+
+from tei_transformer.cache import FileCache, SharedCache
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def test_least_recently_used_removed(self):
+        cache = FileCache(self.work_dir, max_size=2500)
+        for n, key in enumerate(['a', 'b']):
+            cache.put(key, 'x' * 1000)
+            os.utime(cache._path(key), (n, n))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', 'x' * 1000)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_configured(self):
+        with mock.patch.dict(os.environ, {SharedCache.environ: ''}):
+            cache = FileCache.configured(self.work_dir, 'stages')
+        self.assertIsNone(cache.shared)
+        self.assertEqual(cache.max_size, 512 * 1024 * 1024)
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.directory = self.work_dir.joinpath('shared')
+
+    def test_configured(self):
+        with mock.patch.dict(os.environ, {SharedCache.environ: ''}):
+            self.assertIsNone(SharedCache.configured('stages'))
+        with mock.patch.dict(os.environ,
+                             {SharedCache.environ: self.directory}):
+            shared = SharedCache.configured('stages')
+        self.assertEqual(shared.directory, self.directory)
+
+    def test_shared_between_checkouts(self):
+        shared = SharedCache(self.directory, 'stages', 10 ** 6)
+        first, second = [FileCache(self.work_dir.joinpath(name),
+                                   shared=shared) for name in 'ab']
+        first.put('key', {'text': 'x'})
+        self.assertEqual(second.get('key'), {'text': 'x'})
+        self.assertIsNone(second.get('other'))
+        # Now kept locally too
+        self.assertEqual(second._read('key'), {'text': 'x'})
+        self.assertIn('stages: 1 hits, 1 misses (50%)', shared.report())
+
+    def test_local_not_shared(self):
+        shared = SharedCache(self.directory, 'stages', 10 ** 6)
+        first, second = [FileCache(self.work_dir.joinpath(name),
+                                   shared=shared) for name in 'ab']
+        first.put('key', {'text': 'x'}, local=True)
+        self.assertEqual(first.get('key', local=True), {'text': 'x'})
+        self.assertIsNone(second.get('key'))
+
+    def test_least_recently_used_removed(self):
+        shared = SharedCache(self.directory, 'pdfs', 2500)
+        source = self.work_dir.joinpath('made.pdf')
+        source.write_bytes(os.urandom(1000))
+        for n, key in enumerate(['a', 'b']):
+            shared.put_file(key, source)
+            os.utime(self.directory.joinpath(key + '.pdf'), (n, n))
+        target = self.work_dir.joinpath('copy.pdf')
+        self.assertTrue(shared.get_file('a', target))
+        self.assertEqual(target.bytes(), source.bytes())
+        shared.put_file('c', source)
+        self.assertTrue(shared.get_file('a', target))
+        self.assertFalse(shared.get_file('b', target))
+        self.assertTrue(shared.get_file('c', target))
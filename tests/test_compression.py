@@ -0,0 +1,53 @@
+import gzip
+import lzma
+import shutil
+import tempfile
+import unittest
+
+from path import Path
+
+from tei_transformer import compression
+from tei_transformer.cache import FileCache
+from tei_transformer.tags import parser
+
+xml = (b'<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body>'
+       b'<div xml:id="a"><p>A</p></div><div xml:id="b"><p>B</p></div>'
+       b'</body></text></TEI>')
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.paths = [self.work_dir.joinpath('ed.xml.gz'),
+                      self.work_dir.joinpath('ed.xml.xz')]
+        with gzip.open(self.paths[0], 'wb') as f:
+            f.write(xml)
+        with lzma.open(self.paths[1], 'wb') as f:
+            f.write(xml)
+
+    def test_parse(self):
+        for path in self.paths:
+            tree = parser.parse(path)
+            self.assertEqual(tree.getroot().localname, 'TEI')
+            self.assertEqual(tree.docinfo.URL, path)
+
+    def test_iterparse(self):
+        for path in self.paths:
+            divs = [div.get('{http://www.w3.org/XML/1998/namespace}id')
+                    for _, div in parser.iterparse(path, tag='{*}div')]
+            self.assertEqual(divs, ['a', 'b'])
+
+    def test_find(self):
+        plain = self.work_dir.joinpath('ed.xml')
+        self.assertEqual(compression.find(plain), self.paths[0])
+        self.assertEqual(compression.uncompressed(self.paths[1]), plain)
+
+    def test_compressed_cache(self):
+        cache = FileCache(self.work_dir.joinpath('cache'), compress=True)
+        cache.put('key', {'text': 'x' * 1000})
+        self.assertEqual(cache.get('key'), {'text': 'x' * 1000})
+        stored, = cache.directory.files()
+        self.assertEqual(stored.basename(), 'key.json.gz')
+        self.assertLess(stored.size, 1000)
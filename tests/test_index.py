@@ -0,0 +1,96 @@
+import shutil
+import subprocess
+import tempfile
+import unittest
+from collections import namedtuple
+
+from path import Path
+
+from tei_transformer.index import IndexStyle, PersonIndex, main, sort_key
+
+
+class TestPersonIndex(unittest.TestCase):
+
+    idx = ('\\indexentry{Eliot, T. S.}{2}\n'
+           '\\indexentry{Bloggs, Joe|innote}{12}\n'
+           '\\indexentry{\u00c9lan, Anne}{3}\n'
+           '\\indexentry{Bloggs, Joe}{4}\n'
+           '\\indexentry{Bloggs, Joe}{5}\n'
+           '\\indexentry{Bloggs, Joe}{6}\n'
+           '\\indexentry{Adams, John!letters}{7}\n'
+           '\\indexentry{Adams, John}{1}\n')
+
+    style = ('headings_flag 1\n'
+             'heading_prefix "{\\\\bfseries "\n'
+             'heading_suffix "}\\\\nopagebreak\\n"\n')
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.work_dir.joinpath('ed.idx').write_text(self.idx)
+        self.work_dir.joinpath('ed.mst').write_text(self.style)
+
+    def test_sort_key(self):
+        names = ['Eliot, T. S.', 'elan', '\u00c9lan, Anne', 'Smithson, A',
+                 'Smith, John', '1066', '\u00a7']
+        self.assertEqual(sorted(names, key=sort_key),
+                         ['\u00a7', '1066', 'elan', '\u00c9lan, Anne',
+                          'Eliot, T. S.', 'Smith, John', 'Smithson, A'])
+
+    def test_style(self):
+        style = IndexStyle(self.work_dir.joinpath('ed.mst'))
+        self.assertEqual(style['heading_suffix'], '}\\nopagebreak\n')
+        self.assertEqual(style['delim_0'], ', ')
+
+    def test_index(self):
+        person = namedtuple('Person', ['indexname'])
+        keys = PersonIndex.sort_keys({'jb': person('Bloggs, Joe')})
+        index = PersonIndex(keys, self.work_dir.joinpath('ed.mst'))
+        self.assertTrue(index.write(self.work_dir.joinpath('ed.idx'),
+                                    self.work_dir.joinpath('ed.ind')))
+        self.assertEqual(self.work_dir.joinpath('ed.ind').text(),
+                         '\\begin{theindex}\n'
+                         '{\\bfseries A}\\nopagebreak\n\n'
+                         '  \\item Adams, John, 1\n'
+                         '    \\subitem letters, 7\n\n'
+                         '  \\indexspace\n'
+                         '{\\bfseries B}\\nopagebreak\n\n'
+                         '  \\item Bloggs, Joe, 4--6, \\innote{12}\n\n'
+                         '  \\indexspace\n'
+                         '{\\bfseries E}\\nopagebreak\n\n'
+                         '  \\item \u00c9lan, Anne, 3\n'
+                         '  \\item Eliot, T. S., 2\n\n'
+                         '\\end{theindex}\n')
+        self.assertFalse(index.write(self.work_dir.joinpath('ed.idx'),
+                                     self.work_dir.joinpath('ed.ind')))
+
+    def test_quote_and_escape(self):
+        entries = PersonIndex.entries(
+            '\\indexentry{Zola, \\"Emile@Zola, \\"{E}mile}{3}\n'
+            '\\indexentry{a"!b!c"@d}{4}\n')
+        self.assertEqual(list(entries),
+                         [(('Zola, \\"Emile', 'Zola, \\"{E}mile'),),
+                          (('a!b', 'a!b'), ('c@d', 'c@d'))])
+
+    def test_for_latexmk(self):
+        person = namedtuple('Person', ['indexname'])
+        keys = PersonIndex.sort_keys({'jb': person('Bloggs, Joe')})
+        index = PersonIndex(keys, self.work_dir.joinpath('ed.mst'))
+        expected = index.text(self.work_dir.joinpath('ed.idx'))
+        option, makeindex = index.latexmk_options(
+            self.work_dir.joinpath('ed keys.json'))
+        self.assertEqual(option, '-e')
+        self.assertTrue(makeindex.startswith('$makeindex=q{'))
+        # As latexmk would run it, from elsewhere
+        command = makeindex[len('$makeindex=q{'):-1].replace(
+            '%O', '').replace('%D', 'ed.ind').replace('%S', 'ed.idx')
+        subprocess.check_call(command, shell=True, cwd=self.work_dir)
+        self.assertEqual(self.work_dir.joinpath('ed.ind').text(), expected)
+
+    def test_main(self):
+        keys = self.work_dir.joinpath('keys.json')
+        keys.write_text('{}')
+        main([keys, self.work_dir.joinpath('ed.idx'), '--style',
+              self.work_dir.joinpath('ed.mst')])
+        self.assertIn('Adams, John',
+                      self.work_dir.joinpath('ed.ind').text())
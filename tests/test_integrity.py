@@ -0,0 +1,99 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from path import Path
+
+from tei_transformer import integrity
+from tei_transformer.cache import FileCache
+from tei_transformer.integrity import (BibKeys, IntegrityError,
+                                       ReferenceCheck)
+
+from xml_maker import person_template, xmlns
+
+
+class TestReferenceCheck(unittest.TestCase):
+
+    text = """\
+<TEI %s><text><body>
+<div xml:id="a"><p><persName ref="#jbloggs">Joe</persName>
+<persName ref="#??">Someone</persName>
+<persName ref="#nobody">Nobody</persName>
+<ptr type="crossref" target="#a"/><ptr type="crossref" target="#b"/>
+<ptr type="bibliog" target="#known"/><ptr type="bibliog" target="#unknown"/>
+</p></div>
+</body></text></TEI>""" % xmlns
+
+    bib = """\
+@string{ed = "Editor"}
+@book{known,
+  title = {Known}}
+"""
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.paths = [self.tempdir.joinpath(name) for name in
+                      ['text.xml', 'personlist.xml', 'references.bib']]
+        person = person_template.format(xmlid='jbloggs', forename='Joe',
+                                        addName='', surname='Bloggs',
+                                        birth='', death='', description='')
+        personlist = '<listPerson %s>%s</listPerson>' % (xmlns, person)
+        for path, text in zip(self.paths, [self.text, personlist, self.bib]):
+            path.write_text(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_problems(self):
+        problems = ReferenceCheck(*self.paths).problems()
+        self.assertEqual([(line, message) for _, line, message in problems],
+                         [(4, 'person nobody is not in the personlist'),
+                          (5, 'crossref b is not the xml:id of anything '
+                              'in the text'),
+                          (6, 'bibliog unknown is not a key in the '
+                              'bibliography')])
+
+    def test_raises(self):
+        with self.assertRaises(IntegrityError):
+            ReferenceCheck(*self.paths)()
+
+    def test_fragments_cached(self):
+        xi = 'xmlns:xi="http://www.w3.org/2001/XInclude"'
+        self.paths[0].write_text(
+            '<TEI %s><text><body><xi:include %s href="a.xml"/>'
+            '<p><ptr type="crossref" target="#y"/></p></body></text></TEI>'
+            % (xmlns, xi))
+        fragment = self.tempdir.joinpath('a.xml')
+        fragment.write_text('<div %s xml:id="y"><p>\n<persName '
+                            'ref="#nobody">N</persName></p></div>' % xmlns)
+        cache = FileCache(self.tempdir.joinpath('cache'))
+
+        def problems():
+            with mock.patch.object(integrity.compression, 'parse',
+                                   wraps=integrity.compression.parse) as parse:
+                found = list(ReferenceCheck(*self.paths, cache).problems())
+            parsed = [Path(c[0][0]).name for c in parse.call_args_list]
+            return parsed, found
+
+        parsed, found = problems()
+        self.assertIn('a.xml', parsed)
+        self.assertEqual(found, [(fragment, 2, 'person nobody is not in '
+                                               'the personlist')])
+        parsed, found = problems()
+        self.assertNotIn('a.xml', parsed)
+        self.assertEqual(len(found), 1)
+        fragment.write_text('<div %s xml:id="z"/>' % xmlns)
+        parsed, found = problems()
+        self.assertIn('a.xml', parsed)
+        self.assertEqual([message for _, _, message in found],
+                         ['crossref y is not the xml:id of anything '
+                          'in the text'])
+
+    def test_bibkeys_cached(self):
+        bibpath = self.paths[2]
+        self.assertEqual(BibKeys(bibpath), {'known'})
+        self.assertTrue((bibpath + '.keys').exists())
+        self.assertEqual(BibKeys(bibpath), {'known'})
+        bibpath.write_text(self.bib + '@article{other, title={Other}}\n')
+        self.assertEqual(BibKeys(bibpath), {'known', 'other'})
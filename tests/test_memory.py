@@ -0,0 +1,28 @@
+import unittest
+
+from tei_transformer.memory import MemoryReport
+
+
+class TestMemoryReport(unittest.TestCase):
+
+    def setUp(self):
+        self.memory = MemoryReport().start()
+        self.addCleanup(self.memory.stop)
+
+    def test_peak_and_held(self):
+        with self.memory.stage('build'):
+            transient = [object() for _ in range(100000)]
+            del transient
+            self.held = bytearray(1000000)
+        stage = self.memory.stages['build']
+        self.assertGreater(stage['python_peak'], 1000000)
+        self.assertGreater(stage['python_held'], 1000000)
+        self.assertLess(stage['python_held'], stage['python_peak'])
+        site, size, count = stage['sites'][0]
+        self.assertIn('test_memory.py', site)
+        self.assertGreaterEqual(size, 1000000)
+
+    def test_report(self):
+        with self.memory.stage('parse'):
+            pass
+        self.assertTrue(self.memory.report().startswith('parse'))
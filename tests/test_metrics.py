@@ -0,0 +1,45 @@
+import json
+import shutil
+import tempfile
+import unittest
+
+from path import Path
+
+from tei_transformer.metrics import RunMetrics
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        inputpath = self.tempdir.joinpath('ed.xml')
+        inputpath.write_text('<TEI/>')
+        self.metrics = RunMetrics(inputpath)
+        with self.metrics.stage('parse'):
+            pass
+        self.metrics.update({'tags': {'p': 2}, 'persdict_cached': True})
+
+    def test_jsonl_appends(self):
+        path = self.tempdir.joinpath('metrics.jsonl')
+        self.metrics.finish().write(path)
+        self.metrics.write(path)
+        lines = [json.loads(line) for line in path.lines()]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['input_bytes'], 6)
+        self.assertIn('parse', lines[0]['stages'])
+
+    def test_openmetrics(self):
+        text = self.metrics.openmetrics()
+        label = 'input="%s"' % self.metrics['input']
+        self.assertIn('tei_transformer_input_bytes{%s} 6\n' % label, text)
+        self.assertIn('tei_transformer_tag_elements{%s,tag="p"} 2\n'
+                      % label, text)
+        self.assertIn('tei_transformer_persdict_cached{%s} 1\n' % label, text)
+        self.assertIn('tei_transformer_stage_seconds{%s,stage="parse"} '
+                      % label, text)
+        self.assertTrue(text.endswith('# EOF\n'))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self.metrics.write(self.tempdir.joinpath('m'), 'csv')
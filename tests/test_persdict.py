@@ -1,5 +1,20 @@
+import shutil
+import tempfile
 import unittest
-from tei_transformer import persdict, parser
+from unittest import mock
+
+from path import Path
+
+from tei_transformer.transform import PersDict
+
+personlist = ('<listPerson xmlns="http://www.tei-c.org/ns/1.0">'
+              '<person xml:id="jb"><persName><forename>Joe</forename>'
+              '<surname>Bloggs</surname></persName><birth>1850</birth>'
+              '<trait><p>Friend of <persName ref="#js">Soap</persName>'
+              '</p></trait></person>'
+              '<person xml:id="js" indexonly="true"><persName>'
+              '<forename>Joe</forename><surname>Soap</surname></persName>'
+              '</person></listPerson>')
 
 
 class TestPersDict(unittest.TestCase):
@@ -24,3 +39,30 @@ class TestPersonMaker(unittest.TestCase):
 
     def tearDown(self):
         pass
+
+
+class TestRebuild(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.path = self.work_dir.joinpath('personlist.xml')
+        self.path.write_text(personlist)
+
+    def test_only_changed_and_mentioning(self):
+        persdict, record = PersDict.rebuild(self.path)
+        self.assertEqual(sorted(record), ['hashes', 'mentions'])
+        self.assertEqual(record['mentions'], {'jb': ['js'], 'js': []})
+        changed = personlist.replace('<surname>Soap', '<surname>Sope')
+        self.path.write_text(changed)
+        with mock.patch.object(PersDict, 'Person',
+                               wraps=PersDict.Person) as person:
+            persdict, record = PersDict.rebuild(self.path, record, persdict)
+        self.assertEqual(person.call_count, 2)
+        self.assertEqual(persdict, PersDict(self.path))
+        self.path.write_text(changed.replace('1850', '1851'))
+        with mock.patch.object(PersDict, 'Person',
+                               wraps=PersDict.Person) as person:
+            persdict, _ = PersDict.rebuild(self.path, record, persdict)
+        self.assertEqual(person.call_count, 1)
+        self.assertEqual(persdict, PersDict(self.path))
@@ -0,0 +1,91 @@
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from path import Path
+
+from tei_transformer.persondb import PersonDatabase
+from tei_transformer.tags import ImplementationErrors
+from tei_transformer.transform import PersDict, Transformer
+
+personlist = ('<listPerson xmlns="http://www.tei-c.org/ns/1.0">'
+              '<person xml:id="jb"><persName><forename>Joe</forename>'
+              '<surname>Bloggs</surname></persName><birth>1850</birth>'
+              '<trait><p>Friend of <persName ref="#js">Soap</persName>'
+              '</p></trait></person>'
+              '<person xml:id="js" indexonly="true"><persName>'
+              '<forename>Joe</forename><surname>Soap</surname></persName>'
+              '</person></listPerson>')
+
+
+class TestPersonDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.personlistpath = self.work_dir.joinpath('personlist.xml')
+        self.personlistpath.write_text(personlist)
+        self.path = self.work_dir.joinpath('persons.sqlite')
+
+    def test_as_persdict(self):
+        persdict = PersDict(self.personlistpath)
+        db = PersonDatabase.build(self.personlistpath, self.path)
+        self.addCleanup(db.close)
+        self.assertEqual(sorted(db), sorted(persdict))
+        self.assertEqual(len(db), 2)
+        for ref in persdict:
+            self.assertEqual(tuple(db[ref]), tuple(persdict[ref]))
+        with self.assertRaises(KeyError):
+            db['zz']
+
+    def test_closed_by_with(self):
+        with PersonDatabase.build(self.personlistpath, self.path) as db:
+            db['js']
+            self.assertEqual(list(db.used()), ['js'])
+        with self.assertRaises(sqlite3.ProgrammingError):
+            len(db)
+
+    def test_used_by_transformer(self):
+        inputpath = self.work_dir.joinpath('ed.xml')
+        inputpath.write_text(
+            '<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body>'
+            '<p><persName ref="#js">Soap</persName></p></body></text></TEI>')
+        workfiles = [self.work_dir.joinpath(name) for name in
+                     ['ed.tex', 'ed.pdf', 'out.pdf']]
+        transformer = Transformer(False, (inputpath, self.personlistpath),
+                                  ('', ''), workfiles, pdf=False,
+                                  person_db=True, python_index=True)
+        self.assertEqual(list(transformer.index.keys), ['Soap, Joe'])
+        with self.assertRaises(sqlite3.ProgrammingError):
+            len(transformer.person_database)
+
+    def test_built_once(self):
+        PersonDatabase.build(self.personlistpath, self.path).close()
+        with mock.patch.object(PersonDatabase, '_fill') as fill:
+            db = PersonDatabase.build(self.personlistpath, self.path)
+            db.close()
+        fill.assert_not_called()
+        self.personlistpath.write_text(personlist.replace('Bloggs', 'Blogs'))
+        db = PersonDatabase.build(self.personlistpath, self.path)
+        self.addCleanup(db.close)
+        self.assertEqual(db['jb'].indexname, 'Blogs, Joe')
+
+    def test_built_again_after_errors(self):
+        self.personlistpath.write_text(personlist.replace(
+            'Friend of', '<choice><sic>Frend</sic></choice> of'))
+        errors = ImplementationErrors()
+        PersonDatabase.build(self.personlistpath, self.path, errors).close()
+        self.assertEqual(len(errors), 1)
+        errors = ImplementationErrors()
+        PersonDatabase.build(self.personlistpath, self.path, errors).close()
+        self.assertEqual(len(errors), 1)
+
+    def test_temp_removed_on_failure(self):
+        with mock.patch.object(PersonDatabase, '_fill',
+                               side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                PersonDatabase.build(self.personlistpath, self.path)
+        self.assertEqual(self.work_dir.files('*.tmp'), [])
+        self.assertFalse(self.path.exists())
@@ -0,0 +1,141 @@
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+from path import Path
+
+from tei_transformer.persontable import PersonTable
+from tei_transformer.service import Metrics, Service, Tables, work
+
+
+class TestService(unittest.TestCase):
+
+    def test_turns_away_when_full(self):
+        release = threading.Event()
+
+        def submit(work, request, submitted):
+            release.wait()
+            return mock.Mock(result=lambda: {'latex': '', 'metrics': {}})
+
+        service = Service(1, 0)
+        results = []
+        with mock.patch.object(service.pool, 'submit', submit):
+            first = threading.Thread(target=lambda: results.append(
+                service({'project': '.'})))
+            first.start()
+            while not service.metrics.counts['in_flight']:
+                pass
+            self.assertIsNone(service({'project': '.'}))
+            release.set()
+            first.join()
+        service.shutdown()
+        self.assertEqual(results[0]['latex'], '')
+        self.assertEqual(service.metrics.counts,
+                         {'accepted': 1, 'rejected': 1,
+                          'failed': 0, 'in_flight': 0})
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_report(self):
+        metrics = Metrics()
+        for seconds in [1.0, 3.0]:
+            metrics.start()
+            metrics.finish({'metrics': {'worker': seconds,
+                                        'persdict_cached': True}})
+        metrics.start()
+        metrics.finish({'error': 'x', 'metrics': {}})
+        report = metrics.report()
+        self.assertEqual(report['counts']['failed'], 1)
+        self.assertEqual(report['timings'],
+                         {'worker': {'count': 2, 'mean': 2.0, 'max': 3.0}})
+
+
+class TestTables(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.project)
+        self.resources = self.project.joinpath('resources')
+        self.resources.mkdir()
+        self.write_personlist('Bloggs')
+
+    def write_personlist(self, surname):
+        self.resources.joinpath('personlist.xml').write_text(
+            '<listPerson xmlns="http://www.tei-c.org/ns/1.0">'
+            '<person xml:id="jb"><persName><forename>Joe</forename>'
+            '<surname>%s</surname></persName></person>'
+            '<person xml:id="an" indexonly="true"><persName>'
+            '<forename>Anne</forename><surname>Émile</surname>'
+            '</persName></person>'
+            '</listPerson>' % surname)
+
+    def test_made_once_per_personlist(self):
+        tables = Tables()
+        path = tables(self.project)
+        self.assertEqual(tables(self.project), path)
+        table = PersonTable(path)
+        self.assertEqual(sorted(table), ['an', 'jb'])
+        self.assertEqual(table['jb'].indexname, 'Bloggs, Joe')
+        self.assertTrue(table['an'].indexonly)
+        self.assertEqual(table['an'].indexname, 'Émile, Anne')
+        with self.assertRaises(KeyError):
+            table['zz']
+        self.write_personlist('Soap')
+        changed = tables(self.project)
+        self.assertNotEqual(changed, path)
+        self.assertFalse(path.exists())
+        self.assertEqual(PersonTable(changed)['jb'].indexname, 'Soap, Joe')
+
+    def test_lock_per_project(self):
+        tables = Tables()
+        other = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, other)
+        self.assertIs(tables._project_lock(self.project),
+                      tables._project_lock(self.project))
+        self.assertIsNot(tables._project_lock(self.project),
+                         tables._project_lock(other))
+
+    def test_made_table_taken_without_lock(self):
+        tables = Tables()
+        path = tables(self.project)
+        with mock.patch.object(tables, '_project_lock',
+                               side_effect=AssertionError):
+            self.assertEqual(tables(self.project), path)
+
+
+class TestWork(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.project)
+        resources = self.project.joinpath('resources')
+        resources.mkdir()
+        resources.joinpath('personlist.xml').write_text(
+            '<listPerson xmlns="http://www.tei-c.org/ns/1.0"/>')
+        resources.joinpath('references.bib').write_text('')
+        resources.joinpath('latex_preamble.tex').write_text(
+            '\\documentclass{book}\n')
+
+    def test_concurrent_texts(self):
+        words = ['ALPHA%d' % n for n in range(10)] + \
+                ['BETA%d' % n for n in range(10)]
+        requests = [{'project': self.project,
+                     'tei': '<TEI xmlns="http://www.tei-c.org/ns/1.0">'
+                            '<text><body><p>%s</p></body></text></TEI>'
+                            % word} for word in words]
+        with ProcessPoolExecutor(2) as pool:
+            results = list(pool.map(work, requests,
+                                    [time.time()] * len(requests)))
+        for word, result in zip(words, results):
+            self.assertNotIn('error', result)
+            self.assertIn(word, result['latex'])
+            self.assertEqual(len(re.findall('ALPHA|BETA',
+                                            result['latex'])), 1)
+        work_dir = self.project.joinpath('working_directory')
+        self.assertEqual(work_dir.files('preview-*'), [])
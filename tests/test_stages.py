@@ -0,0 +1,43 @@
+import threading
+import time
+import unittest
+
+from tei_transformer.stages import Stages
+
+
+class TestStages(unittest.TestCase):
+
+    def test_independent_stages_overlap(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def meet(result):
+            barrier.wait()
+            return result
+
+        stages = Stages()
+        stages.add('a', lambda: meet('a'))
+        stages.add('b', lambda: meet('b'))
+        stages.add('c', lambda a, b: a + b, ['a', 'b'])
+        self.assertEqual(stages.run()['c'], 'ab')
+
+    def test_critical_path(self):
+        stages = Stages()
+        stages.add('slow', lambda: time.sleep(0.05))
+        stages.add('quick', lambda: None)
+        stages.add('last', lambda *_: None, ['quick', 'slow'])
+        stages.run()
+        self.assertEqual(stages.critical_path(), ['slow', 'last'])
+        self.assertIn('critical path: slow > last', stages.report())
+
+    def test_failure_raised_after_all_finish(self):
+        stages = Stages()
+        stages.add('bad', lambda: 1 / 0)
+        stages.add('good', lambda: 'done')
+        stages.add('after', lambda bad: bad, ['bad'])
+        with self.assertRaises(ZeroDivisionError):
+            stages.run()
+        self.assertEqual(set(stages.durations()), {'bad', 'good'})
+
+    def test_unknown_stage(self):
+        with self.assertRaises(KeyError):
+            Stages().add('a', lambda b: b, ['b'])
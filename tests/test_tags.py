@@ -1,5 +1,10 @@
 import unittest
 
+from lxml import etree
+
+from tei_transformer.tags import (parser, ImplementationError,
+                                  ImplementationErrors)
+
 class TestTeiTag(unittest.TestCase):
     pass
 
@@ -19,4 +24,38 @@ class TestReplaceMeWText(unittest.TestCase):
     pass
 
 class TestUnwrapMe(unittest.TestCase):
-    pass
\ No newline at end of file
+    pass
+
+class TestKeepGoing(unittest.TestCase):
+
+    xml = ('<text xmlns="http://www.tei-c.org/ns/1.0"><body>\n'
+           '<floatingText type="x">one</floatingText>\n'
+           '<add>two</add>\n'
+           '<del>three</del>\n'
+           '</body></text>')
+
+    def body(self):
+        return etree.fromstring(self.xml, parser.parser)[0]
+
+    def test_raises(self):
+        with self.assertRaises(ImplementationError):
+            parser.transform_tree(self.body(), {})
+
+    def test_records(self):
+        errors = ImplementationErrors()
+        body = parser.transform_tree(self.body(), {}, errors=errors)
+        self.assertEqual([(e['line'], e['tag']) for e in errors],
+                         [(2, 'floatingText'), (4, 'del')])
+        text = ''.join(body.itertext())
+        self.assertIn('\\texttt{floatingText}, line 2}one', text)
+        self.assertIn('\\addition{two}', text)
+
+    def test_unknown_tag_recorded(self):
+        errors = ImplementationErrors()
+        body = etree.fromstring('<text xmlns="http://www.tei-c.org/ns/1.0">'
+                                '<body><foo>x</foo></body></text>',
+                                parser.parser)[0]
+        body = parser.transform_tree(body, {}, errors=errors)
+        self.assertEqual([e['tag'] for e in errors], ['foo'])
+        self.assertIn('<foo> no handler for foo', errors.summary())
+        self.assertIn('\\texttt{foo}', ''.join(body.itertext()))
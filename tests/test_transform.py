@@ -0,0 +1,604 @@
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import textwrap
+import time
+from collections import namedtuple
+from unittest import mock
+
+from lxml import etree
+from path import Path
+
+from tei_transformer.config import config
+from tei_transformer.tags import parser
+from tei_transformer.transform import (Divisions, DivisionRange,
+                                       Fragments, LatexError, PartNames,
+                                       PersDict, PersonDefinitions,
+                                       PreambleFormat, TextWriter,
+                                       Transformer,
+                                       WitnessDefinitions)
+
+xml_ns = config['xml_namespace']
+
+
+def tei_maker(text):
+    return textwrap.dedent("""\
+        <TEI xmlns="http://www.tei-c.org/ns/1.0">
+        <text>
+        <body>%s</body>
+        </text>
+        </TEI>""") % text
+
+
+def body_maker(text):
+    root = etree.fromstring(tei_maker(text), parser.parser)
+    return root.find('.//{*}body')
+
+
+class TestDivisions(unittest.TestCase):
+
+    def test_one_body_per_division(self):
+        body = body_maker('<div xml:id="a"><p>A</p></div>'
+                          '<div><p>B</p></div>')
+        divisions = Divisions(body)
+        self.assertEqual([i for i, _ in divisions], ['a', 'part2'])
+        for _, chunk in divisions:
+            self.assertEqual(chunk.localname, 'body')
+            self.assertEqual(len(chunk), 1)
+        self.assertEqual(len(body), 0)
+
+    def test_between_divisions_goes_with_previous(self):
+        body = body_maker('<div xml:id="a"/><pb n="2"/><div xml:id="b"/>')
+        a, b = (chunk for _, chunk in Divisions(body))
+        self.assertEqual([t.localname for t in a], ['div', 'pb'])
+        self.assertEqual([t.localname for t in b], ['div'])
+
+    def test_joined_as_whole(self):
+        xml = ('<div type="year" n="1915"><p>A</p><pb n="2"/></div>'
+               '<div type="year" n="1916"><p>B</p></div>')
+        whole = Transformer.tree_text(parser.transform_tree(
+            body_maker(xml), {}))
+        joined = ''.join(Transformer.raw_text(parser.transform_tree(chunk, {}))
+                         for _, chunk in Divisions(body_maker(xml)))
+        self.assertEqual(joined.strip(), whole)
+
+
+class TestFragments(unittest.TestCase):
+
+    master = tei_maker('<div xml:id="intro"><p>Intro</p></div>'
+                       '<xi:include xmlns:xi="http://www.w3.org/2001/XInclude"'
+                       ' href="y1915.xml"/>'
+                       '<div><p>Nested <xi:include xmlns:xi="http://www.w3.org'
+                       '/2001/XInclude" href="note.xml"/></p></div>')
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        paths = {'master.xml': self.master,
+                 'personlist.xml': '<listPerson %s/>' % self.tei_ns,
+                 'note.xml': '<hi %s>note</hi>' % self.tei_ns}
+        for name, text in paths.items():
+            self.work_dir.joinpath(name).write_text(text)
+        self.write_fragment('First')
+
+    tei_ns = 'xmlns="http://www.tei-c.org/ns/1.0"'
+
+    def write_fragment(self, text):
+        self.work_dir.joinpath('y1915.xml').write_text(
+            '<div %s xml:id="y1915"><p>%s</p></div>' % (self.tei_ns, text))
+
+    def parts(self):
+        body = parser.parse(self.work_dir.joinpath('master.xml'))
+        fragments = Fragments({}, self.work_dir.joinpath('personlist.xml'),
+                              self.work_dir.joinpath('fragments'))
+        return fragments(body.getroot().find('.//{*}body'), divisions=True)
+
+    def test_parts(self):
+        parts = self.parts()
+        self.assertEqual([i for i, _ in parts], ['intro', 'y1915', 'part3'])
+        self.assertIn('First', parts[1][1])
+        self.assertIn('note', parts[2][1])
+
+    def test_cached_until_changed(self):
+        self.parts()
+        with mock.patch.object(parser, 'transform_tree') as transform_tree:
+            transform_tree.side_effect = AssertionError
+            with mock.patch.object(Fragments, '_text', return_value=''):
+                self.assertIn('First', self.parts()[1][1])
+        self.write_fragment('Second')
+        self.assertIn('Second', self.parts()[1][1])
+
+    def test_nested_include_changed(self):
+        self.write_fragment('<xi:include xmlns:xi="http://www.w3.org/2001/'
+                            'XInclude" href="n.xml"/>')
+        nested = self.work_dir.joinpath('n.xml')
+        nested.write_text('<hi %s>OLD</hi>' % self.tei_ns)
+        self.assertIn('OLD', self.parts()[1][1])
+        nested.write_text('<hi %s>NEW</hi>' % self.tei_ns)
+        self.assertIn('NEW', self.parts()[1][1])
+
+
+    def test_witnesses_in_segment_order(self):
+        xi = 'xmlns:xi="http://www.w3.org/2001/XInclude"'
+        self.work_dir.joinpath('master.xml').write_text(tei_maker(
+            '<xi:include %s href="a.xml"/><xi:include %s href="b.xml"/>'
+            % (xi, xi)))
+        for name, siglum in [('a', 'Slow'), ('b', 'Fast')]:
+            self.work_dir.joinpath(name + '.xml').write_text(
+                '<div %s><p><app><lem>x</lem><rdg wit="#%s">y</rdg></app>'
+                '</p></div>' % (self.tei_ns, siglum))
+        transform_tree = parser.transform_tree
+
+        def slow(body, *args, **kwargs):
+            if 'Slow' in etree.tostring(body, encoding=str):
+                time.sleep(0.2)
+            return transform_tree(body, *args, **kwargs)
+
+        body = parser.parse(self.work_dir.joinpath('master.xml'))
+        witnesses = WitnessDefinitions()
+        fragments = Fragments({}, self.work_dir.joinpath('personlist.xml'),
+                              self.work_dir.joinpath('fragments'),
+                              jobs=2, witnesses=witnesses)
+        with mock.patch.object(parser, 'transform_tree', side_effect=slow):
+            fragments(body.getroot().find('.//{*}body'))
+        self.assertEqual(list(witnesses.unnumbered), ['Slow', 'Fast'])
+
+
+class TestStageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.inputpaths = [self.work_dir.joinpath(name) for name in
+                           ['ed.xml', 'personlist.xml']]
+        self.inputpaths[0].write_text(tei_maker('<p>First</p>'))
+        self.inputpaths[1].write_text(
+            '<listPerson xmlns="http://www.tei-c.org/ns/1.0"/>')
+
+    def latex(self, before='before'):
+        workfiles = [self.work_dir.joinpath(name) for name in
+                     ['ed.tex', 'ed.pdf', 'out.pdf']]
+        return Transformer(False, self.inputpaths, (before, 'after'),
+                           workfiles, pdf=False).latex
+
+    def test_cached_until_input_changes(self):
+        self.assertIn('First', self.latex())
+        with mock.patch.object(parser, 'transform_tree') as transform_tree, \
+                mock.patch.object(parser, 'parse') as parse:
+            transform_tree.side_effect = parse.side_effect = AssertionError
+            latex = self.latex('changed')
+        self.assertTrue(latex.startswith('changed'))
+        self.assertIn('First', latex)
+        self.inputpaths[0].write_text(tei_maker('<p>Second</p>'))
+        self.assertIn('Second', self.latex())
+
+    def test_includes_not_cached(self):
+        self.work_dir.joinpath('n.xml').write_text(
+            '<hi xmlns="http://www.tei-c.org/ns/1.0">OLD</hi>')
+        self.inputpaths[0].write_text(tei_maker(
+            '<p>A <xi:include xmlns:xi="http://www.w3.org/2001/XInclude" '
+            'href="n.xml"/></p>'))
+        self.assertIn('OLD', self.latex())
+        self.work_dir.joinpath('n.xml').write_text(
+            '<hi xmlns="http://www.tei-c.org/ns/1.0">NEW</hi>')
+        self.assertIn('NEW', self.latex())
+
+    def test_persdict_rebuilt_from_record(self):
+        people = ('<listPerson xmlns="http://www.tei-c.org/ns/1.0">%s'
+                  '</listPerson>' % ''.join(
+                      '<person xml:id="p%d"><persName><surname>S%d'
+                      '</surname></persName><birth>%%d</birth></person>'
+                      % (n, n) for n in range(3)))
+        self.inputpaths[1].write_text(people % (1850, 1851, 1852))
+        self.latex()
+        self.inputpaths[1].write_text(people % (1850, 1861, 1852))
+        with mock.patch.object(PersDict, 'Person',
+                               wraps=PersDict.Person) as person:
+            self.latex()
+        self.assertEqual(person.call_count, 1)
+        records = [json.loads(path.text()) for path
+                   in self.work_dir.joinpath('stages').files('*.json')]
+        record, = [r for r in records if 'mentions' in r]
+        self.assertEqual(sorted(record), ['hashes', 'mentions', 'persdict'])
+
+
+class TestStream(unittest.TestCase):
+
+    xml = tei_maker('<div type="year" n="1915"><p>Some  text - .</p>'
+                    '<pb n="2"/><p>After <hi rend="italic">it</hi></p></div>'
+                    '<p>Loose <hi rend="super">x</hi> end</p>')
+
+    def test_as_whole_text(self):
+        out = io.StringIO()
+        source = io.BytesIO(self.xml.encode('utf-8'))
+        Transformer.stream(source, {}, out)
+        body = body_maker(self.xml[self.xml.index('<div'):
+                                   self.xml.index('</body>')])
+        whole = Transformer.replacements(
+            Transformer.tree_text(parser.transform_tree(body, {})))
+        self.assertEqual(out.getvalue(), whole + '\n')
+
+    def test_writer_strips_ends(self):
+        out = io.StringIO()
+        writer = TextWriter(out)
+        for piece in ['  ', ' a ', '', 'b  ', ' ']:
+            writer.write_piece(piece)
+        writer.close()
+        self.assertEqual(out.getvalue(), 'a b\n')
+
+    def test_writer_replaces_across_pieces(self):
+        pieces = ['a  \n', 'b ', '  c\n\n', '\nU.S.A.', ' Then \n']
+        out = io.StringIO()
+        writer = TextWriter(out)
+        for piece in pieces:
+            writer.write_piece(piece)
+        writer.close()
+        whole = Transformer.replacements(''.join(pieces).strip())
+        self.assertEqual(out.getvalue(), whole + '\n')
+
+
+class TestPartNames(unittest.TestCase):
+
+    def setUp(self):
+        self.names = PartNames('edition')
+        self.names.add('a')
+        self.names.add('b')
+
+    def test_add(self):
+        self.assertEqual(self.names.add('c'), 'edition-c.tex')
+
+    def test_only(self):
+        self.assertIsNone(self.names.only(None))
+        self.assertEqual(self.names.only(['b']), ['edition-b'])
+        with self.assertRaises(KeyError):
+            self.names.only(['c'])
+
+    def test_includeonly(self):
+        before = '\\documentclass{book}\n\\begin{document}\n'
+        text = Transformer.includeonly(before, self.names.only(['a']))
+        self.assertEqual(text, '\\documentclass{book}\n'
+                               '\\includeonly{edition-a}\n'
+                               '\\begin{document}\n')
+        with self.assertRaises(ValueError):
+            Transformer.includeonly('', ['edition-a'])
+
+
+class TestDivisionRange(unittest.TestCase):
+
+    xml = tei_maker('<div type="year" n="1915" xml:id="y">'
+                    '<div xml:id="a"><p>A</p></div>'
+                    '<div xml:id="b"><p>B</p></div>'
+                    '<div xml:id="c"><p>C</p></div>'
+                    '</div>')
+
+    def selected(self, first, last):
+        source = io.BytesIO(self.xml.encode('utf-8'))
+        body = DivisionRange(source, first, last)
+        year, = body
+        self.assertEqual(year.get('n'), '1915')
+        self.assertEqual(len(year.findall('{*}head')), 0)
+        return [div.get('{%s}id' % xml_ns) for div in year]
+
+    def test_single(self):
+        self.assertEqual(self.selected('b', 'b'), ['b'])
+
+    def test_range(self):
+        self.assertEqual(self.selected('a', 'b'), ['a', 'b'])
+        self.assertEqual(self.selected(None, 'b'), ['a', 'b'])
+        self.assertEqual(self.selected('b', None), ['b', 'c'])
+
+    def test_plain_until_selected(self):
+        source = io.BytesIO(self.xml.encode('utf-8'))
+        div, = DivisionRange._select(source, 'c', 'c')
+        self.assertIs(type(div), etree._Element)
+        # a is gone, and b emptied
+        self.assertEqual([len(d) for d in div.getparent()], [0, 1])
+        source = io.BytesIO(self.xml.encode('utf-8'))
+        year, = DivisionRange(source, 'c', 'c')
+        self.assertIsNot(type(year[0][0]), etree._Element)
+
+    def test_missing(self):
+        with self.assertRaises(KeyError):
+            self.selected('a', 'z')
+        with self.assertRaises(KeyError):
+            self.selected('z', None)
+
+
+class TestPersonDefinitions(unittest.TestCase):
+
+    def test_defined_once(self):
+        person = namedtuple('Person', ['xml_id', 'indexname',
+                                       'indexonly', 'description'])
+        persdict = PersonDefinitions({
+            'jb': person('jb', 'Bloggs, Joe', False, 'Joe Bloggs, a man'),
+            'js': person('js', 'Soap, Joe', True, 'Joe Soap'),
+            'jd': person('jd', 'Doe, Jane', False, 'Jane Doe')})
+        body = body_maker('<p><persName ref="#jb">Joe</persName> '
+                          '<persName ref="#js">Soap</persName> '
+                          '<persName ref="#jb">Bloggs</persName></p>')
+        text = Transformer.tree_text(parser.transform_tree(body, persdict))
+        self.assertEqual(text, '\\pstart  \\person{jb}{Joe}'
+                               '\\indexperson{Soap, Joe|innote}{Soap}'
+                               '\\person{jb}{Bloggs} \\pend')
+        self.assertEqual(persdict.definitions(),
+                         '\\defperson{jb}{Bloggs, Joe}{Joe Bloggs, a man}')
+
+
+class TestWitnessDefinitions(unittest.TestCase):
+
+    xml = ('<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader>'
+           '<listWit><witness xml:id="Douce"/><witness xml:id="Ashmole"/>'
+           '</listWit></teiHeader><text><body><p>'
+           '<app><lem>lemma</lem><rdg wit="#Ashmole #Rawl">one</rdg>'
+           '<rdg wit="#Douce">two</rdg></app></p></body></text></TEI>')
+
+    def test_compact_readings(self):
+        root = etree.fromstring(self.xml, parser.parser)
+        witnesses = WitnessDefinitions(root.getroottree())
+        body = root.find('.//{*}body')
+        text = Transformer.tree_text(parser.transform_tree(
+            body, {}, witnesses=witnesses))
+        self.assertIn('\\variants{lemma}{\\cwit{one}{2,3} \\cwit{two}{1}}',
+                      text)
+        self.assertEqual(witnesses.aliases('#Later'), 'Later')
+        self.assertEqual(witnesses.definitions(),
+                         '\\defwitness{1}{Douce}\n'
+                         '\\defwitness{2}{Ashmole}\n'
+                         '\\defwitness{3}{Rawl}\n'
+                         '\\defwitness{Later}{Later}')
+
+    def test_full_readings_by_default(self):
+        root = etree.fromstring(self.xml, parser.parser)
+        text = Transformer.tree_text(parser.transform_tree(
+            root.find('.//{*}body'), {}))
+        self.assertIn('\\wit{one}{#Ashmole #Rawl} \\wit{two}{#Douce}', text)
+
+
+class TestPreambleFormat(unittest.TestCase):
+
+    latex = ('\\documentclass{book}\n\\endofdump\n'
+             '\\includeonly{a}\n\\begin{document}\n')
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.working_tex = self.work_dir.joinpath('edition.tex')
+        version = mock.patch('tei_transformer.transform.tool_version',
+                             return_value='pdfTeX 3.14')
+        self.version = version.start()
+        self.addCleanup(version.stop)
+
+    def dump(self, command, cwd):
+        name = command[3][len('-jobname='):]
+        cwd.joinpath(name + '.fmt').write_text('')
+        return 0
+
+    def test_made_once_per_preamble(self):
+        with mock.patch('subprocess.call', side_effect=self.dump) as call:
+            first = PreambleFormat(self.latex, self.working_tex)
+            again = PreambleFormat(self.latex, self.working_tex)
+            self.assertEqual(call.call_count, 1)
+            changed = PreambleFormat(self.latex.replace('book', 'memoir'),
+                                     self.working_tex)
+            self.assertEqual(call.call_count, 2)
+        self.assertEqual(first, again)
+        self.assertTrue(first.startswith('%&edition-preamble-'))
+        self.assertTrue(first.endswith(self.latex))
+        self.assertNotEqual(first, changed)
+        self.assertEqual(len(self.work_dir.files('*.fmt')), 1)
+
+    def test_made_again_for_new_engine(self):
+        with mock.patch('subprocess.call', side_effect=self.dump) as call:
+            first = PreambleFormat(self.latex, self.working_tex)
+            self.version.return_value = 'pdfTeX 3.141'
+            upgraded = PreambleFormat(self.latex, self.working_tex)
+            self.assertEqual(call.call_count, 2)
+            config['preamble_format']['engine'] = 'xelatex'
+            self.addCleanup(config['preamble_format'].__setitem__,
+                            'engine', 'pdflatex')
+            other = PreambleFormat(self.latex, self.working_tex)
+            self.assertEqual(call.call_count, 3)
+        self.assertEqual(len({first, upgraded, other}), 3)
+
+    def test_without_format(self):
+        with mock.patch('subprocess.call', return_value=1) as call, \
+                mock.patch('sys.stderr', io.StringIO()):
+            latex = PreambleFormat(self.latex, self.working_tex)
+            again = PreambleFormat(self.latex, self.working_tex)
+        self.assertEqual(call.call_count, 1)
+        without = self.latex.replace('\\endofdump\n', '')
+        self.assertEqual(latex, without)
+        self.assertEqual(again, without)
+
+    def test_without_engine(self):
+        self.version.return_value = None
+        with mock.patch('subprocess.call') as call, \
+                mock.patch('sys.stderr', io.StringIO()):
+            latex = PreambleFormat(self.latex, self.working_tex)
+        call.assert_not_called()
+        self.assertEqual(latex, self.latex.replace('\\endofdump\n', ''))
+
+
+class TestSeparate(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def test_make_pdfs(self):
+        transformer = Transformer.__new__(Transformer)
+        transformer.preamble_format = False
+        transformer.index = None
+        workfiles = [self.work_dir.joinpath(name) for name in
+                     ['ed.tex', 'ed.pdf', 'out.pdf']]
+        documents = [('a', 'latex a'), ('b', 'latex b')]
+
+        def make_pdf(latex, force, tex, pdf, out, index=None):
+            pdf.write_text(latex)
+            return (1.0, 2)
+
+        with mock.patch.object(Transformer, 'make_pdf',
+                               side_effect=make_pdf) as made:
+            latexmk = transformer.make_pdfs(documents, False, 2, True,
+                                            *workfiles)
+        made = [c[0] for c in made.call_args_list]
+        self.assertEqual([(tex.basename(), out.basename())
+                          for _, _, tex, _, out in made],
+                         [('ed-standalone-a.tex', 'out-a.pdf'),
+                          ('ed-standalone-b.tex', 'out-b.pdf'),
+                          ('ed.tex', 'out.pdf')])
+        joined = made[-1][0]
+        self.assertIn('\\includepdf[pages=-]{ed-standalone-a.pdf}', joined)
+        self.assertIn('\\includepdf[pages=-]{ed-standalone-b.pdf}', joined)
+        self.assertEqual(latexmk, (3.0, 6))
+
+    def test_only(self):
+        inputpaths = [self.work_dir.joinpath(name) for name in
+                      ['ed.xml', 'personlist.xml']]
+        inputpaths[0].write_text(tei_maker(
+            ''.join('<div xml:id="d%d"><p>Text %d</p></div>' % (n, n)
+                    for n in range(3))))
+        inputpaths[1].write_text(
+            '<listPerson xmlns="http://www.tei-c.org/ns/1.0"/>')
+        workfiles = [self.work_dir.joinpath(name) for name in
+                     ['ed.tex', 'ed.pdf', 'out.pdf']]
+        textwraps = ('\\begin{document}', '\\end{document}')
+        transformer = Transformer(False, inputpaths, textwraps, workfiles,
+                                  separate=True, only=['d2', 'd0'],
+                                  pdf=False)
+        self.assertEqual([i for i, _ in transformer.documents], ['d0', 'd2'])
+        self.assertIn('Text 2', transformer.documents[1][1])
+        with self.assertRaises(KeyError):
+            Transformer(False, inputpaths, textwraps, workfiles,
+                        separate=True, only=['d3'], pdf=False)
+
+    def test_check_modes(self):
+        Transformer.check_modes(only=['a'], separate=True, join=True)
+        with self.assertRaises(ValueError):
+            Transformer.check_modes(split=True, separate=True)
+        with self.assertRaises(ValueError):
+            Transformer.check_modes(split=True, join=True)
+
+    def test_division_wrap(self):
+        before = ('\\documentclass{book}\n\\begin{document}\n'
+                  '\\tableofcontents\n\\include{introduction}\n'
+                  '\\beginnumbering')
+        start, end = Transformer.division_wrap(before)
+        self.assertTrue(start.startswith(
+            '\\documentclass{book}\n\\begin{document}\n'))
+        self.assertNotIn('introduction', start)
+        self.assertNotIn('tableofcontents', start)
+        self.assertIn('\\beginnumbering', start)
+        self.assertNotIn('appendices', end)
+        self.assertTrue(end.strip().endswith('\\end{document}'))
+
+
+class TestMakePdf(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def test_pdf_from_shared_cache(self):
+        directory = self.work_dir.joinpath('shared')
+        workfiles = [[self.work_dir.joinpath(checkout, name)
+                      for name in ['ed.tex', 'ed.pdf', 'out.pdf']]
+                     for checkout in ['a', 'b']]
+        for tex, _, _ in workfiles:
+            tex.dirname().makedirs_p()
+
+        def latexmk(command):
+            workfiles[0][1].write_text('pdf')
+            return 1.0, 1
+
+        with mock.patch.dict(os.environ, {'TEI_TRANSFORMER_CACHE': directory}):
+            with mock.patch.object(Transformer, 'run_latexmk',
+                                   side_effect=latexmk):
+                self.assertEqual(
+                    Transformer.make_pdf('latex', False, *workfiles[0]),
+                    (1.0, 1))
+            with mock.patch.object(Transformer, 'run_latexmk') as run:
+                made = Transformer.make_pdf('latex', False, *workfiles[1])
+        run.assert_not_called()
+        self.assertIsNone(made)
+        self.assertEqual(workfiles[1][2].text(), 'pdf')
+
+    def test_stale_pdf_not_taken(self):
+        workfiles = [self.work_dir.joinpath(name) for name in
+                     ['ed.tex', 'ed.pdf', 'out.pdf']]
+        workfiles[1].write_text('old')
+        with mock.patch.object(Transformer, 'run_latexmk',
+                               return_value=(1.0, 1)), \
+                self.assertRaises(LatexError):
+            Transformer.make_pdf('latex', False, *workfiles)
+        self.assertFalse(workfiles[2].exists())
+
+
+class TestRunLatexmk(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def test_latexmk_passes(self):
+        output = ("Run number 1 of rule 'pdflatex'\n"
+                  "Run number 1 of rule 'bibtex'\n"
+                  "Run number 2 of rule 'pdflatex'\n")
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            seconds, passes = Transformer.run_latexmk(['printf', output])
+        self.assertEqual(passes, 2)
+        self.assertEqual(stdout.getvalue(), output)
+
+    def test_fatal_error_stops_latexmk(self):
+        tex = self.work_dir.joinpath('ed.tex')
+        tex.write_text('\\begin{document}\n\\label{Jan1_1915}\n'
+                       'Text\n\\foo\n')
+        tei = self.work_dir.joinpath('ed.xml')
+        tei.write_text(tei_maker('\n<div xml:id="Jan1_1915"><p/></div>'))
+        output = ('(./ed.tex\n! Undefined control sequence.\n'
+                  'l.4 \\foo\n\n')
+        command = ['sh', '-c', 'printf %s "$1"; sleep 30', 'sh', output, tex]
+        started = time.perf_counter()
+        with mock.patch('sys.stdout', new_callable=io.StringIO), \
+                self.assertRaises(LatexError) as raised:
+            Transformer.run_latexmk(command)
+        self.assertLess(time.perf_counter() - started, 20)
+        err = raised.exception
+        self.assertEqual((err.tex, err.line), (tex, 4))
+        self.assertEqual(err.excerpt[0], '! Undefined control sequence.')
+        err.locate(tei)
+        self.assertEqual(err.identifier, 'Jan1_1915')
+        self.assertEqual(err.tei, '%s:4' % tei)
+
+    def test_error_after_include_in_master(self):
+        tex = self.work_dir.joinpath('ed.tex')
+        tex.write_text('')
+        self.work_dir.joinpath('ed-a.tex').write_text('')
+        output = ('(./ed.tex (/no/such.sty) (./ed-a.tex [1] (see p. 2))\n'
+                  'Overfull \\hbox (3.0pt too wide)\n'
+                  '! Undefined control sequence.\nl.9 \\foo\n\n')
+        command = ['printf', '%s', output, tex]
+        with mock.patch('sys.stdout', new_callable=io.StringIO), \
+                self.assertRaises(LatexError) as raised:
+            Transformer.run_latexmk(command)
+        self.assertEqual((raised.exception.tex, raised.exception.line),
+                         (tex, 9))
+
+    def test_interrupted_latexmk_killed(self):
+        started = []
+        Popen = subprocess.Popen
+
+        def popen(*args, **kwargs):
+            started.append(Popen(*args, **kwargs))
+            return started[-1]
+
+        interrupt = mock.patch('sys.stdout.write',
+                               side_effect=KeyboardInterrupt)
+        with mock.patch('subprocess.Popen', side_effect=popen), \
+                interrupt, self.assertRaises(KeyboardInterrupt):
+            Transformer.run_latexmk(['sh', '-c', 'echo x; sleep 30'])
+        self.assertIsNotNone(started[0].poll())